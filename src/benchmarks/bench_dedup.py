@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import click
+import logging
+from time import time
+
+import numpy as np
+
+from src.data.make_duplicates import MinHasher, band_keys, cluster, shingle_hashes
+from src.data.make_synthetic import make_tweets, words
+
+
+def make_near_duplicates(n_rows, dup_fraction=0.2, n_templates=50, seed=0):
+    """ Synthetic messages where a fraction are templated copies with one word changed. """
+    rng = np.random.RandomState(seed)
+    messages = list(make_tweets(n_rows, seed=seed).message)
+    templates = rng.choice(n_rows, n_templates, replace=False)
+    for i in np.flatnonzero(rng.rand(n_rows) < dup_fraction):
+        tokens = messages[templates[rng.randint(n_templates)]].split()
+        tokens[rng.randint(len(tokens))] = rng.choice(words)
+        messages[i] = ' '.join(tokens)
+    return messages
+
+
+def exact_pairs(hashes, offsets, threshold):
+    """ Baseline: exact Jaccard similarity of every pair of shingle sets. """
+    sets = [set(hashes[offsets[i]:offsets[i + 1]]) for i in range(len(offsets) - 1)]
+    pairs = set()
+    for i in range(len(sets)):
+        for j in range(i + 1, len(sets)):
+            union = len(sets[i] | sets[j])
+            if union and len(sets[i] & sets[j]) / union >= threshold:
+                pairs.add((i, j))
+    return pairs
+
+
+def cluster_pairs(labels):
+    """ Every pair of rows sharing a cluster label. """
+    pairs = set()
+    order = np.argsort(labels, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    for group in np.split(order, bounds):
+        group = np.sort(group)
+        pairs.update((int(a), int(b)) for k, a in enumerate(group) for b in group[k + 1:])
+    return pairs
+
+
+@click.command()
+@click.option('--rows', default=5000, type=click.IntRange(min=2),
+              help='Synthetic tweets compared pairwise.')
+@click.option('--threshold', default=0.8, type=float,
+              help='Jaccard similarity of near-duplicates.')
+@click.option('--num-perm', default=128, type=click.IntRange(min=1),
+              help='MinHash signature length.')
+@click.option('--bands', default=16, type=click.IntRange(min=1),
+              help='LSH bands.')
+def main(rows, threshold, num_perm, bands):
+    """ Compares MinHash/LSH clusters against exact pairwise Jaccard.
+
+    LSH clusters are transitive, so their pairs are scored against the exact
+    pairs: recall is the share of exact pairs found, precision the share of
+    clustered pairs that are exact near-duplicates.
+    """
+    if not 0 <= threshold <= 1:
+        raise click.BadParameter('--threshold must be between 0 and 1')
+    logger = logging.getLogger(__name__)
+    messages = make_near_duplicates(rows)
+    hashes, offsets = shingle_hashes(messages)
+
+    start = time()
+    exact = exact_pairs(hashes, offsets, threshold)
+    exact_secs = time() - start
+
+    start = time()
+    sigs = MinHasher(num_perm).signatures(hashes, offsets)
+    labels, _ = cluster(sigs, band_keys(sigs, bands), threshold)
+    lsh_secs = time() - start
+    found = cluster_pairs(labels)
+
+    hits = len(exact & found)
+    results = [
+        'exact jaccard: {} pairs in {:.2f} secs'.format(len(exact), exact_secs),
+        'minhash/lsh: {} pairs in {:.2f} secs ({:.0f}x faster)'.format(
+            len(found), lsh_secs, exact_secs / lsh_secs),
+        'recall {:.3f}, precision {:.3f}'.format(
+            hits / max(len(exact), 1), hits / max(len(found), 1)),
+    ]
+    for result in results:
+        logger.info(result)
+        click.echo(result)
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO,
+                    format=log_fmt, datefmt='%H:%M:%S',
+                    filename='reports/benchmark.dedup.log', filemode='a')
+
+    main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import click
+import logging
+import shutil
+import sys
+import tempfile
+from time import time
+
+import pandas as pd
+
+from src.data.make_dataset import import_cols
+from src.data.make_synthetic import write_csvs
+from src.data.schema import apply_schema, csv_options, ingest_dtypes, tweet_dtypes
+
+
+def read_ingest(csvs):
+    """ The COPY path: `ingest_dtypes`, int64 ids with object strings and float64. """
+    return pd.concat([pd.read_csv(csv, **csv_options(import_cols, ingest_dtypes))
+                      for csv in csvs], ignore_index=True)
+
+
+def read_schema(csvs):
+    """ The analysis loaders: `tweet_dtypes` plus interned usernames. """
+    return apply_schema(pd.concat([pd.read_csv(csv, **csv_options(import_cols, tweet_dtypes))
+                                   for csv in csvs], ignore_index=True))
+
+
+def column_bytes(series):
+    """ Bytes held by a column, counting a string shared by many rows once.
+
+    `memory_usage(deep=True)` sizes every element separately, which hides
+    what interning saves, so object columns are sized by distinct objects.
+    """
+    if series.dtype != object:
+        return series.memory_usage(index=False, deep=True)
+    shared = {id(v): v for v in series.values}
+    return series.memory_usage(index=False) + sum(sys.getsizeof(v) for v in shared.values())
+
+
+@click.command()
+@click.argument('csvs', nargs=-1, type=click.Path(exists=True))
+@click.option('--rows', default=300000, type=click.IntRange(min=1),
+              help='Synthetic tweets to read when no CSVs are given.')
+@click.option('--by-column', is_flag=True,
+              help='Also print bytes per row of every column.')
+def main(csvs, rows, by_column):
+    """ Compares bytes per row and read/serialise time of the tweet dtype plans. """
+    logger = logging.getLogger(__name__)
+    tmp_dir = None
+    if not csvs:
+        tmp_dir = tempfile.mkdtemp()
+        csvs = write_csvs(tmp_dir, 1, rows)
+
+    runs = [('ingest', read_ingest), ('schema', read_schema)]
+    try:
+        for name, read in runs:
+            start = time()
+            df = read(csvs)
+            read_secs = time() - start
+            start = time()
+            df[import_cols].to_csv(None, sep='\t', index=False, encoding='utf-8')
+            csv_secs = time() - start
+
+            usage = pd.Series({col: column_bytes(df[col]) for col in df.columns})
+            result = '{}: {:.0f} bytes/row, read {:.2f} secs, to_csv {:.2f} secs'.format(
+                name, usage.sum() / len(df), read_secs, csv_secs)
+            logger.info(result)
+            click.echo(result)
+            if by_column:
+                for col, n_bytes in usage.items():
+                    click.echo('\t{:10} {:7.1f} {}'.format(col, n_bytes / len(df), df[col].dtype))
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO,
+                    format=log_fmt, datefmt='%H:%M:%S',
+                    filename='reports/benchmark.dtypes.log', filemode='a')
+
+    main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import click
+import logging
+import shutil
+import tempfile
+from dotenv import find_dotenv, load_dotenv
+from time import time
+
+from sqlalchemy import create_engine
+
+from src.data import make_dataset
+from src.data.async_ingest import import_files_async
+from src.data.make_synthetic import write_csvs
+
+
+def load_direct(csvs, db):
+    """ COPYs every file straight into the logged `raw_tweets` table. """
+    return sum(make_dataset.import_file(csv, db) or 0 for csv in csvs)
+
+
+def load_staged(csvs, db, defer_indexes=False):
+    """ COPYs every file into the unlogged staging table, then moves the rows. """
+    for csv in csvs:
+        make_dataset.import_file(csv, db, table='raw_tweets_staging')
+    conn = db.raw_connection()
+    try:
+        return make_dataset.move_staged_rows(conn, defer_indexes=defer_indexes)
+    finally:
+        conn.close()
+
+
+@click.command()
+@click.argument('benchmark_url', envvar='BENCHMARK_URL')
+@click.option('--files', default=4, type=click.IntRange(min=1),
+              help='Synthetic CSV files loaded per run.')
+@click.option('--rows', default=250000, type=click.IntRange(min=1),
+              help='Tweets per synthetic file.')
+def main(benchmark_url, files, rows):
+    """ Compares rows/sec of direct, overlapped and staged loads on synthetic tweets.
+
+    BENCHMARK_URL must point at a scratch database created with createdb.sql,
+    every run appends rows to its `raw_tweets`.
+    """
+    logger = logging.getLogger(__name__)
+    db = create_engine(benchmark_url, client_encoding='utf8')
+    runs = [('direct', lambda csvs: load_direct(csvs, db)),
+            ('async', lambda csvs: import_files_async(csvs, db)),
+            ('staged', lambda csvs: load_staged(csvs, db)),
+            ('staged+deferred', lambda csvs: load_staged(csvs, db, defer_indexes=True))]
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for seed, (name, load) in enumerate(runs):
+            # Fresh tweetIDs per run so the loads don't collide
+            csvs = write_csvs(tmp_dir, files, rows, seed=seed * files)
+            start = time()
+            loaded = load(csvs)
+            elapsed = time() - start
+            result = '{}: {} rows in {:.2f} secs ({:.0f} rows/sec)'.format(
+                name, loaded, elapsed, loaded / elapsed)
+            logger.info(result)
+            click.echo(result)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO,
+                    format=log_fmt, datefmt='%H:%M:%S',
+                    filename='reports/benchmark.load.log', filemode='a')
+
+    load_dotenv(find_dotenv())
+
+    main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import click
+import logging
+import resource
+import shutil
+import tempfile
+from dotenv import find_dotenv, load_dotenv
+from multiprocessing import Pool
+from time import time
+
+import psycopg2 as pg
+from sqlalchemy import create_engine
+
+from src.data import make_dataset, make_filtered
+from src.data.database import stream_rows
+from src.data.make_synthetic import write_csvs
+from src.data.metrics import Run
+
+
+###############################################################################
+# Stages                                                                      #
+###############################################################################
+
+def bench_import(benchmark_url, csvs):
+    """ COPYs the synthetic CSVs into raw_tweets with `import_file`. """
+    db = create_engine(benchmark_url, client_encoding='utf8')
+    return sum(make_dataset.import_file(csv, db) or 0 for csv in csvs)
+
+
+def bench_filter(benchmark_url, csvs):
+    """ Runs the incremental filter stage over the rows just imported. """
+    conn = pg.connect(benchmark_url)
+    try:
+        curr = conn.cursor()
+        curr.execute("SELECT COALESCE((SELECT high_water FROM filter_state "
+                     "WHERE stage = 'filter_tweets'), 0), COALESCE(MAX(id), 0) FROM raw_tweets;")
+        low, high = curr.fetchone()
+    finally:
+        conn.close()
+    make_filtered.run_filter(benchmark_url)
+    return high - low
+
+
+def bench_features(benchmark_url, csvs):
+    """ Tokenizes and hashes every filtered tweet, as the feature stage does. """
+    from src.features.build_features import build_store, make_vectorizer, normalize_batch, SEP
+
+    vectorizer = make_vectorizer()
+
+    def batches(conn):
+        for rows in stream_rows(conn, 'SELECT id, message FROM filter_tweets;',
+                                itersize=100000, name='bench_features'):
+            ids, messages = zip(*rows)
+            vectorizer.transform(normalize_batch(messages).split(SEP))
+            yield ids, messages
+
+    conn = pg.connect(benchmark_url)
+    try:
+        store = build_store(batches(conn))
+    finally:
+        conn.close()
+    return len(store)
+
+
+stages = [('import', bench_import), ('filter', bench_filter), ('features', bench_features)]
+
+
+def run_stage(stage, benchmark_url, csvs):
+    """ Runs one stage, returning (rows, seconds, peak rss in MB).
+
+    Called in a fresh process per stage, so the peak resident memory
+    (ru_maxrss, KB on Linux) belongs to that stage alone.
+    """
+    start = time()
+    rows = dict(stages)[stage](benchmark_url, csvs)
+    return rows, time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+###############################################################################
+# Benchmark Suite                                                             #
+###############################################################################
+
+@click.command()
+@click.argument('benchmark_url', envvar='BENCHMARK_URL')
+@click.option('--files', default=4, type=click.IntRange(min=1),
+              help='Synthetic CSV files per run.')
+@click.option('--rows', default=250000, type=click.IntRange(min=1),
+              help='Tweets per synthetic file.')
+@click.option('--seed', default=0, type=int,
+              help='Seed of the first file, use a new one per run to avoid tweetID clashes.')
+@click.option('--stage', 'selected', multiple=True, type=click.Choice([s for s, _ in stages]),
+              help='Stages to run, all by default.')
+def main(benchmark_url, files, rows, seed, selected):
+    """ Times import, filter and feature building on synthetic tweets.
+
+    BENCHMARK_URL must point at a scratch Postgres created with createdb.sql.
+    Every stage runs in its own process and reports rows/sec and peak memory,
+    and the results are stored as a 'benchmark' run in pipeline_runs.
+    """
+    logger = logging.getLogger(__name__)
+    run = Run('benchmark')
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        start = time()
+        csvs = write_csvs(tmp_dir, files, rows, seed=seed, overlap=0.05)
+        logger.info('generated {} rows in {:.2f} secs'.format(files * rows, time() - start))
+
+        for stage, _ in stages:
+            if selected and stage not in selected:
+                continue
+            pool = Pool(1)
+            try:
+                n_rows, elapsed, peak_mb = pool.apply(run_stage, (stage, benchmark_url, csvs))
+            finally:
+                pool.close()
+                pool.join()
+            run.count(stage + '_rows', n_rows)
+            run.timers[stage] += elapsed
+            run.emit('stage', name=stage, rows=n_rows, elapsed=elapsed, peak_rss_mb=peak_mb)
+            result = '{}: {} rows in {:.2f} secs ({:.0f} rows/sec), peak rss {:.0f} MB'.format(
+                stage, n_rows, elapsed, n_rows / elapsed, peak_mb)
+            logger.info(result)
+            click.echo(result)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    conn = pg.connect(benchmark_url)
+    try:
+        run.finish(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO,
+                    format=log_fmt, datefmt='%H:%M:%S',
+                    filename='reports/benchmark.pipeline.log', filemode='a')
+
+    load_dotenv(find_dotenv())
+
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import click
+import logging
+from time import time
+
+import numpy as np
+
+from src.data.make_synthetic import make_tweets
+from src.models.predict_model import LexiconScorer, compare_textblob
+
+
+# Hand-written tweets exercising what the synthetic vocabulary lacks:
+# emoticons, exclamation marks, sarcasm, negations, contractions and links.
+sample_messages = [
+    "So proud of the protesters at JFK tonight!! #NoBanNoWall",
+    "This travel ban is absolutely disgusting :(",
+    "I can't believe this is happening... really sad day for America",
+    "Not a good look for the administration @POTUS https://t.co/abc123",
+    "Great news, the judge blocked the order! :D",
+    "Families separated at the airport. Heartbreaking.",
+    "Don't be fooled, this isn't about safety",
+    "love this country <3 but hate what's happening",
+    "Very very bad policy. Very unfair!",
+    "the court ruling is not bad at all ;)",
+    "Refugees welcome :-) #refugeeswelcome",
+    "Wow... just wow :/",
+    "Sad!",
+    "The movie was really terrible :(",
+    "Love it <3",
+    "Terrible, terrible, terrible (!)",
+    "i'm so angry right now >:(",
+]
+
+
+@click.command()
+@click.option('--rows', default=20000, type=click.IntRange(min=1),
+              help='Synthetic tweets scored next to the hand-written ones.')
+@click.option('--tolerance', default=0.01, type=float,
+              help='Largest allowed mean absolute polarity error.')
+@click.option('--max-off', default=0.01, type=float,
+              help='Largest allowed share of messages off by more than 0.05.')
+def main(rows, tolerance, max_off):
+    """ Checks LexiconScorer polarity against TextBlob, failing above tolerance.
+
+    The vectorized scorer only handles modifiers and negations directly
+    before a word, so a few messages differ; the mean error and the share of
+    messages off by more than 0.05 must stay within the given bounds.
+    """
+    logger = logging.getLogger(__name__)
+    messages = list(make_tweets(rows).message.fillna('')) + sample_messages
+
+    scorer = LexiconScorer()
+    start = time()
+    scorer.score(messages)
+    elapsed = time() - start
+    errors = compare_textblob(messages, scorer)
+
+    off = np.mean(errors > 0.05)
+    result = '{} tweets in {:.2f} secs ({:.0f} tweets/sec), polarity error mean {:.4f}, ' \
+             'max {:.3f}, {:.2%} off by more than 0.05'.format(
+                 len(messages), elapsed, len(messages) / elapsed, errors.mean(),
+                 errors.max(), off)
+    logger.info(result)
+    click.echo(result)
+    sample_errors = errors[-len(sample_messages):]
+    for i in np.flatnonzero(sample_errors > 0.05):
+        click.echo('\toff by {:.3f}: {}'.format(sample_errors[i], sample_messages[i]))
+    if errors.mean() > tolerance or off > max_off:
+        click.echo(click.style('polarity error above tolerance', fg='red'))
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO,
+                    format=log_fmt, datefmt='%H:%M:%S',
+                    filename='reports/benchmark.sentiment.log', filemode='a')
+
+    main()
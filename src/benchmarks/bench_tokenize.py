@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import click
+import logging
+from dotenv import find_dotenv, load_dotenv
+from time import time
+
+from src.data.make_synthetic import make_tweets
+from src.features.build_features import tokenize_batch, build_store
+
+
+def naive_tokenize(messages):
+    """ Baseline: one `nltk.word_tokenize` call per lowercased message. """
+    import nltk
+    return [nltk.word_tokenize(m.lower()) for m in messages]
+
+
+@click.command()
+@click.option('--rows', default=100000, type=click.IntRange(min=1),
+              help='Synthetic tweets to tokenize.')
+def main(rows):
+    """ Compares batch tokenization against per-row nltk.word_tokenize. """
+    logger = logging.getLogger(__name__)
+    # make_tweets leaves some messages missing, the pipeline reads them as ''
+    messages = list(make_tweets(rows).message.fillna(''))
+
+    runs = [('nltk.word_tokenize', lambda: naive_tokenize(messages)),
+            ('tokenize_batch', lambda: tokenize_batch(messages)),
+            ('build_store', lambda: build_store([(range(rows), messages)]))]
+    for name, run in runs:
+        start = time()
+        run()
+        elapsed = time() - start
+        result = '{}: {} tweets in {:.2f} secs ({:.0f} tweets/sec)'.format(
+            name, rows, elapsed, rows / elapsed)
+        logger.info(result)
+        click.echo(result)
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO,
+                    format=log_fmt, datefmt='%H:%M:%S',
+                    filename='reports/benchmark.tokenize.log', filemode='a')
+
+    load_dotenv(find_dotenv())
+
+    main()
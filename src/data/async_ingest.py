@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from src.data.make_dataset import (ChunkedCSVStream, copy_sql, hash_file, import_cols,
+                                   manifest_sql, manifest_tables, read_chunks)
+from src.data.metrics import Metrics
+
+
+###############################################################################
+# Overlapped Parse & COPY                                                     #
+###############################################################################
+
+# Queue item marking the end of the last file
+DONE = object()
+
+
+class QueueStream(ChunkedCSVStream):
+    """ COPY source pulling serialised chunks of one file from an asyncio.Queue.
+
+        `copy_expert` reads it on the copy thread while the event loop keeps
+        parsing, so a read only blocks when the parser has fallen behind. That
+        wait is added to the `parse_wait` timer.
+
+        Args:
+            queue (asyncio.Queue): Holds (tsv, rows) chunks, an exception raised
+                by the parser, or None after the last chunk of the file.
+            loop (asyncio.AbstractEventLoop): Loop running the parser.
+            metrics (src.data.metrics.Metrics): Receives the `parse_wait` time.
+    """
+    def __init__(self, queue, loop, metrics):
+        super(QueueStream, self).__init__([], import_cols, metrics)
+        self.queue = queue
+        self.loop = loop
+        self.done = False
+
+    def _next_chunk(self):
+        if self.done:
+            return False
+        with self.metrics.timer('parse_wait'):
+            item = asyncio.run_coroutine_threadsafe(self.queue.get(), self.loop).result()
+        if item is None:
+            self.done = True
+            return False
+        if isinstance(item, Exception):
+            self.done = True
+            raise item
+        self.buffer, rows = item
+        self.pos = 0
+        self.rows += rows
+        return True
+
+
+def parse_next(reader, header):
+    """ Parses and serialises the next chunk, returns (tsv, rows, secs) or None. """
+    start = time()
+    chunk = next(reader, None)
+    if chunk is None:
+        return None
+    tsv = chunk[import_cols].to_csv(None, sep='\t', header=header, index=False,
+                                    encoding='utf-8')
+    return tsv, len(chunk), time() - start
+
+
+def open_file(filepath, chunk_rows):
+    """ Returns (stat, sha1, reader) of a scrape, as `import_file` reads it. """
+    return os.stat(filepath), hash_file(filepath), read_chunks(filepath, chunk_rows)
+
+
+async def produce(csvs, queue, loop, parser, chunk_rows, metrics):
+    """ Parses files in order on the parser thread, filling the queue.
+
+        Each file is announced with (filepath, stat, sha1), followed by its
+        chunks and None. `queue.put` waits while the queue is full, so parsing
+        never runs more than the queue size ahead of the COPY.
+    """
+    log_import = logging.getLogger(__name__).getChild('produce')
+    for filepath in csvs:
+        try:
+            stat, sha1, reader = await loop.run_in_executor(parser, open_file, filepath,
+                                                            chunk_rows)
+        except Exception as e:
+            metrics.count('files_failed')
+            log_import.warning('error on read_csv of {}: {}'.format(filepath, e))
+            continue
+        await queue.put((filepath, stat, sha1))
+        header = True
+        try:
+            while True:
+                parsed = await loop.run_in_executor(parser, parse_next, reader, header)
+                if parsed is None:
+                    break
+                tsv, rows, secs = parsed
+                metrics.timers['parse'] += secs
+                metrics.count('rows_read', rows)
+                header = False
+                await queue.put((tsv, rows))
+        except Exception as e:
+            # The COPY of this file fails with the parser's error
+            await queue.put(e)
+            continue
+        finally:
+            reader.close()
+        await queue.put(None)
+    await queue.put(DONE)
+
+
+def copy_file(conn, stream, table, filepath, stat, sha1, start):
+    """ COPYs one file's chunks from `stream` and records it in the manifest. """
+    curr = conn.cursor()
+    try:
+        curr.copy_expert(copy_sql.format(table), stream, size=1 << 16)
+        curr.execute(manifest_sql.format(manifest_tables[table]),
+                     (os.path.abspath(filepath), stat.st_size, stat.st_mtime, sha1,
+                      stream.rows, time() - start))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        curr.close()
+    return stream.rows
+
+
+async def consume(queue, loop, copier, conn, table, metrics):
+    """ Streams each announced file into one COPY on the copy thread. """
+    log_import = logging.getLogger(__name__).getChild('consume')
+    while True:
+        announced = await queue.get()
+        if announced is DONE:
+            break
+        filepath, stat, sha1 = announced
+        log_file = log_import.getChild(filepath.split('/')[-1])
+        start = time()
+        wait_before = metrics.timers['parse_wait']
+        stream = QueueStream(queue, loop, metrics)
+        try:
+            rows = await loop.run_in_executor(copier, copy_file, conn, stream, table,
+                                              filepath, stat, sha1, start)
+        except Exception as e:
+            metrics.count('files_failed')
+            log_file.warning('error while copying to database: {}'.format(e))
+            # Skip whatever the parser still queues for this file
+            while not stream.done:
+                item = await queue.get()
+                stream.done = item is None or isinstance(item, Exception)
+            continue
+        finally:
+            metrics.timers['db'] += time() - start - (metrics.timers['parse_wait'] - wait_before)
+        metrics.count('files')
+        metrics.count('rows_copied', rows)
+        metrics.count('bytes', stat.st_size)
+        log_file.info('finished {} rows ({:.2f})'.format(rows, time() - start))
+
+
+async def run_pipeline(csvs, loop, parser, copier, conn, chunk_rows, table, queue_chunks,
+                       metrics):
+    """ Runs the producer and the consumer until every file is copied. """
+    # Created inside the loop so it binds to it on every Python version
+    queue = asyncio.Queue(maxsize=queue_chunks)
+    producer = loop.create_task(produce(csvs, queue, loop, parser, chunk_rows, metrics))
+    try:
+        await consume(queue, loop, copier, conn, table, metrics)
+    finally:
+        # Only still running if the consumer failed, e.g. on a lost connection
+        if not producer.done():
+            producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+
+
+def import_files_async(csvs, db, chunk_rows=100000, table='raw_tweets', queue_chunks=4,
+                       metrics=None):
+    """ Imports files with parsing overlapped with the COPY of earlier chunks.
+
+        One thread parses and serialises chunks, file after file, while another
+        streams them to the server over a single connection, one COPY and one
+        transaction per file as in `import_file`. Both release the GIL for much
+        of their work (the C parser, socket I/O), so wall time approaches the
+        slower of the two rather than their sum. At most `queue_chunks` parsed
+        chunks wait in memory.
+
+        psycopg2's asynchronous connections cannot COPY, so the blocking
+        `copy_expert` runs on its own thread instead.
+
+        Args:
+            csvs (list[str]): Files to import, in order.
+            db (sqlalchemy.Engine): Database connection from SQLAlchemy.
+            chunk_rows (int): Number of CSV rows parsed and sent per chunk.
+            table (str): Table receiving the rows, `raw_tweets` or `raw_tweets_staging`.
+            queue_chunks (int): Parsed chunks buffered ahead of the COPY.
+            metrics (src.data.metrics.Metrics): Optional metrics receiving parse,
+                parse wait and database time, and row and byte counts.
+
+        Returns:
+            rows (int): Rows copied across all files.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    rows_before = metrics.counters['rows_copied']
+    loop = asyncio.new_event_loop()
+    parser = ThreadPoolExecutor(1)
+    copier = ThreadPoolExecutor(1)
+    conn = db.raw_connection()
+    try:
+        loop.run_until_complete(run_pipeline(csvs, loop, parser, copier, conn, chunk_rows,
+                                             table, queue_chunks, metrics))
+    finally:
+        conn.close()
+        parser.shutdown()
+        copier.shutdown()
+        loop.close()
+    return metrics.counters['rows_copied'] - rows_before
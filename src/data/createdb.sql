@@ -8,8 +8,30 @@ CREATE TABLE IF NOT EXISTS "raw_tweets" (
     "language" VARCHAR(10),
     "longitude" FLOAT,
     "latitude" FLOAT,
-    "retweet" TEXT,
-    CONSTRAINT raw_tweets_pk PRIMARY KEY ("id")
+    "retweet" TEXT
+) PARTITION BY RANGE ("date");
+CREATE TABLE IF NOT EXISTS "raw_tweets_2016_12" PARTITION OF "raw_tweets"
+    FOR VALUES FROM ('2016-12-01') TO ('2017-01-01');
+CREATE TABLE IF NOT EXISTS "raw_tweets_2017_01" PARTITION OF "raw_tweets"
+    FOR VALUES FROM ('2017-01-01') TO ('2017-02-01');
+CREATE TABLE IF NOT EXISTS "raw_tweets_2017_02" PARTITION OF "raw_tweets"
+    FOR VALUES FROM ('2017-02-01') TO ('2017-03-01');
+CREATE TABLE IF NOT EXISTS "raw_tweets_default" PARTITION OF "raw_tweets" DEFAULT;
+CREATE INDEX IF NOT EXISTS "raw_tweets_id_idx" ON "raw_tweets" ("id");
+CREATE INDEX IF NOT EXISTS "raw_tweets_date_brin" ON "raw_tweets" USING BRIN ("date");
+CREATE INDEX IF NOT EXISTS "raw_tweets_tweetID_idx" ON "raw_tweets" ("tweetID");
+CREATE INDEX IF NOT EXISTS "raw_tweets_en_geo_idx" ON "raw_tweets" ("id")
+    WHERE (message IS NOT NULL) AND (retweet IS NULL) AND (LEFT(language, 2) LIKE 'en') AND (latitude IS NOT NULL) AND (longitude IS NOT NULL);
+CREATE UNLOGGED TABLE IF NOT EXISTS "raw_tweets_staging" (
+    "tweetID" BIGINT NOT NULL,
+    "date" TIMESTAMP,
+    "message" TEXT,
+    "username" TEXT,
+    "userID" BIGINT NOT NULL,
+    "language" VARCHAR(10),
+    "longitude" FLOAT,
+    "latitude" FLOAT,
+    "retweet" TEXT
 ) WITH ( OIDS=FALSE );
 CREATE TABLE IF NOT EXISTS "filter_tweets" (
     "id" SERIAL NOT NULL,
@@ -23,4 +45,95 @@ CREATE TABLE IF NOT EXISTS "filter_tweets" (
     "latitude" FLOAT,
     "retweet" TEXT
 ) WITH ( OIDS=FALSE );
-ALTER TABLE "filter_tweets" ADD CONSTRAINT "filter_fk0" FOREIGN KEY ("id") REFERENCES "raw_tweets"("id");
+CREATE UNIQUE INDEX IF NOT EXISTS "filter_tweets_tweetID_idx" ON "filter_tweets" ("tweetID");
+CREATE INDEX IF NOT EXISTS "filter_tweets_date_brin" ON "filter_tweets" USING BRIN ("date");
+ALTER TABLE "filter_tweets" ADD COLUMN IF NOT EXISTS "state" TEXT, ADD COLUMN IF NOT EXISTS "county" TEXT;
+CREATE TABLE IF NOT EXISTS "import_manifest" (
+    "path" TEXT NOT NULL,
+    "size" BIGINT NOT NULL,
+    "mtime" DOUBLE PRECISION NOT NULL,
+    "sha1" CHAR(40) NOT NULL,
+    "rows" BIGINT,
+    "duration" FLOAT,
+    "loaded_at" TIMESTAMP NOT NULL DEFAULT now(),
+    CONSTRAINT import_manifest_pk PRIMARY KEY ("path")
+) WITH ( OIDS=FALSE );
+CREATE TABLE IF NOT EXISTS "filter_state" (
+    "stage" TEXT NOT NULL,
+    "high_water" BIGINT NOT NULL DEFAULT 0,
+    "updated_at" TIMESTAMP NOT NULL DEFAULT now(),
+    CONSTRAINT filter_state_pk PRIMARY KEY ("stage")
+) WITH ( OIDS=FALSE );
+ALTER TABLE "filter_state" ADD COLUMN IF NOT EXISTS "rebuilt_at" TIMESTAMP NOT NULL DEFAULT now();
+CREATE SEQUENCE IF NOT EXISTS "filter_stats_run_seq";
+CREATE TABLE IF NOT EXISTS "filter_stats" (
+    "run_id" BIGINT NOT NULL,
+    "run_at" TIMESTAMP NOT NULL DEFAULT now(),
+    "low_id" BIGINT NOT NULL,
+    "high_id" BIGINT NOT NULL,
+    "filter" TEXT NOT NULL,
+    "cumulative" BOOLEAN NOT NULL,
+    "count" BIGINT NOT NULL,
+    CONSTRAINT filter_stats_pk PRIMARY KEY ("run_id", "filter", "cumulative")
+) WITH ( OIDS=FALSE );
+CREATE TABLE IF NOT EXISTS "tweet_sentiment" (
+    "id" BIGINT NOT NULL,
+    "tweetID" BIGINT NOT NULL,
+    "polarity" REAL NOT NULL,
+    "subjectivity" REAL NOT NULL,
+    CONSTRAINT tweet_sentiment_pk PRIMARY KEY ("id")
+) WITH ( OIDS=FALSE );
+CREATE TABLE IF NOT EXISTS "geo_bins" (
+    "precision" SMALLINT NOT NULL,
+    "cell" BIGINT NOT NULL,
+    "geohash" VARCHAR(12) NOT NULL,
+    "day" DATE NOT NULL,
+    "count" BIGINT NOT NULL,
+    "n_scored" BIGINT NOT NULL,
+    "mean_polarity" DOUBLE PRECISION,
+    "var_polarity" DOUBLE PRECISION,
+    CONSTRAINT geo_bins_pk PRIMARY KEY ("precision", "cell", "day")
+) WITH ( OIDS=FALSE );
+CREATE TABLE IF NOT EXISTS "sentiment_rollups" (
+    "grain" VARCHAR(4) NOT NULL,
+    "bucket" TIMESTAMP NOT NULL,
+    "language" TEXT NOT NULL,
+    "state" TEXT NOT NULL,
+    "count" BIGINT NOT NULL,
+    "n_scored" BIGINT NOT NULL,
+    "sum_polarity" DOUBLE PRECISION NOT NULL,
+    "sum_sq_polarity" DOUBLE PRECISION NOT NULL,
+    CONSTRAINT sentiment_rollups_pk PRIMARY KEY ("grain", "bucket", "language", "state")
+) WITH ( OIDS=FALSE );
+CREATE TABLE IF NOT EXISTS "tweet_duplicates" (
+    "id" BIGINT NOT NULL,
+    "cluster" BIGINT NOT NULL,
+    "cluster_size" INTEGER NOT NULL,
+    CONSTRAINT tweet_duplicates_pk PRIMARY KEY ("id")
+) WITH ( OIDS=FALSE );
+CREATE INDEX IF NOT EXISTS "tweet_duplicates_cluster_idx" ON "tweet_duplicates" ("cluster");
+CREATE TABLE IF NOT EXISTS "user_stats" (
+    "userID" BIGINT NOT NULL,
+    "username" TEXT,
+    "n_tweets" BIGINT NOT NULL,
+    "first_date" TIMESTAMP,
+    "last_date" TIMESTAMP,
+    "n_scored" BIGINT NOT NULL DEFAULT 0,
+    "sum_polarity" DOUBLE PRECISION NOT NULL DEFAULT 0,
+    CONSTRAINT user_stats_pk PRIMARY KEY ("userID")
+) WITH ( OIDS=FALSE );
+CREATE INDEX IF NOT EXISTS "user_stats_n_tweets_idx" ON "user_stats" ("n_tweets");
+CREATE INDEX IF NOT EXISTS "filter_tweets_userID_idx" ON "filter_tweets" ("userID");
+CREATE TABLE IF NOT EXISTS "pipeline_runs" (
+    "run_id" TEXT NOT NULL,
+    "stage" TEXT NOT NULL,
+    "started_at" TIMESTAMP NOT NULL,
+    "elapsed" DOUBLE PRECISION NOT NULL,
+    "counters" JSONB NOT NULL,
+    "timers" JSONB NOT NULL,
+    CONSTRAINT pipeline_runs_pk PRIMARY KEY ("run_id")
+) WITH ( OIDS=FALSE );
+CREATE INDEX IF NOT EXISTS "pipeline_runs_stage_idx" ON "pipeline_runs" ("stage", "started_at");
+CREATE UNLOGGED TABLE IF NOT EXISTS "import_manifest_staging" (
+    LIKE "import_manifest" INCLUDING ALL
+) WITH ( OIDS=FALSE );
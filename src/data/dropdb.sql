@@ -1,3 +1,14 @@
-ALTER TABLE "filter_tweets" DROP CONSTRAINT "filter_fk0";
+DROP TABLE IF EXISTS "import_manifest_staging";
+DROP TABLE IF EXISTS "pipeline_runs";
+DROP TABLE IF EXISTS "user_stats";
+DROP TABLE IF EXISTS "tweet_duplicates";
+DROP TABLE IF EXISTS "sentiment_rollups";
+DROP TABLE IF EXISTS "geo_bins";
+DROP TABLE IF EXISTS "tweet_sentiment";
+DROP TABLE IF EXISTS "filter_stats";
+DROP SEQUENCE IF EXISTS "filter_stats_run_seq";
+DROP TABLE IF EXISTS "filter_state";
+DROP TABLE IF EXISTS "import_manifest";
 DROP TABLE IF EXISTS "filter_tweets";
+DROP TABLE IF EXISTS "raw_tweets_staging";
 DROP TABLE IF EXISTS "raw_tweets";
\ No newline at end of file
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import click
+import shutil
+import logging
+from datetime import timedelta
+from dotenv import find_dotenv, load_dotenv
+from time import time
+
+import numpy as np
+import pandas as pd
+
+from src.data.database import checkout, release
+from src.data.schema import apply_schema
+
+
+###############################################################################
+# Cache Layout                                                                #
+###############################################################################
+
+# One directory per day of tweets, one file per column. Numeric columns are
+# plain .npy arrays, text columns are a UTF-8 blob with int64 offsets, so every
+# column can be memory mapped without parsing. Tweets without a date have their
+# own `date=null` directory.
+cache_dir = os.path.join('data', 'processed', 'filter_tweets')
+
+numeric_cols = {
+    'id': np.int64,
+    'tweetID': np.int64,
+    'date': 'datetime64[us]',
+    'userID': np.int64,
+    'longitude': np.float64,
+    'latitude': np.float64,
+}
+text_cols = ['message', 'username', 'language', 'retweet']
+cols = ['id', 'tweetID', 'date', 'message', 'username', 'userID', 'language',
+        'longitude', 'latitude', 'retweet']
+
+
+def day_dir(root, day):
+    return os.path.join(root, 'date={}'.format(
+        day.strftime('%Y-%m-%d') if day is not None else 'null'))
+
+
+def write_text(path, values):
+    """ Writes a column of strings as a UTF-8 blob, offsets and a null mask. """
+    nulls = np.array([v is None for v in values], dtype=bool)
+    encoded = [b'' if v is None else v.encode('utf-8') for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    with open(path + '.utf8', 'wb') as f:
+        f.write(b''.join(encoded))
+    np.save(path + '.offsets.npy', offsets)
+    np.save(path + '.null.npy', nulls)
+
+
+def read_text(path):
+    """ Reads a text column written by `write_text` into an object array. """
+    offsets = np.load(path + '.offsets.npy', mmap_mode='r')
+    nulls = np.load(path + '.null.npy', mmap_mode='r')
+    blob = np.memmap(path + '.utf8', dtype=np.uint8, mode='r') \
+        if offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+    values = np.empty(len(nulls), dtype=object)
+    for i in range(len(nulls)):
+        if not nulls[i]:
+            values[i] = blob[offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+    return values
+
+
+def write_day(root, day, rows):
+    """ Writes one day of `filter_tweets` rows as column files. """
+    path = day_dir(root, day)
+    os.makedirs(path)
+    columns = list(zip(*rows))
+    for i, col in enumerate(cols):
+        if col in text_cols:
+            write_text(os.path.join(path, col), columns[i])
+        else:
+            values = [np.nan if v is None else v for v in columns[i]] \
+                if numeric_cols[col] is np.float64 else columns[i]
+            np.save(os.path.join(path, col + '.npy'),
+                    np.array(values, dtype=numeric_cols[col]))
+
+
+###############################################################################
+# Cache Freshness                                                             #
+###############################################################################
+
+def read_meta(root=cache_dir):
+    """ Returns the cache metadata, or None if no cache has been written. """
+    try:
+        with open(os.path.join(root, '_meta.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def get_version(curr):
+    """ Returns the filter stage (high-water mark, rebuild time) the cache is versioned on.
+
+    `make_filtered --full` refills filter_tweets up to the same mark, so the
+    time the state row was (re)created tells a rebuild apart.
+    """
+    curr.execute("SELECT high_water, rebuilt_at FROM filter_state WHERE stage = 'filter_tweets';")
+    row = curr.fetchone()
+    return (row[0], str(row[1])) if row is not None else (0, None)
+
+
+def is_fresh(curr, root=cache_dir):
+    """ True if the cache was built from the current filter_tweets version. """
+    meta = read_meta(root)
+    return meta is not None and \
+        (meta['high_water'], meta.get('rebuilt_at')) == get_version(curr)
+
+
+###############################################################################
+# Cache Loader                                                                #
+###############################################################################
+
+def read_partition(root, day, columns):
+    """ Reads columns of one day directory, `day` None for tweets without a date. """
+    path = day_dir(root, day)
+    data = {}
+    for col in columns:
+        col_path = os.path.join(path, col)
+        if col in text_cols:
+            data[col] = read_text(col_path)
+        else:
+            data[col] = np.load(col_path + '.npy', mmap_mode='r')
+    return data
+
+
+def load_null_dates(columns=None, root=cache_dir):
+    """ Loads the filtered tweets that have no date, see `load_tweets`. """
+    meta = read_meta(root)
+    if meta is None:
+        raise IOError('no tweet cache found in {}, run make_cache.py'.format(root))
+    columns = list(columns or cols)
+    if not meta.get('null_rows'):
+        return apply_schema(pd.DataFrame(columns=columns))
+    return apply_schema(pd.DataFrame(read_partition(root, None, columns), columns=columns))
+
+
+def load_tweets(columns=None, start=None, end=None, root=cache_dir):
+    """ Loads filtered tweets from the columnar cache.
+
+    Only the requested columns of the days overlapping [start, end) are read,
+    numeric columns through memory maps. Tweets without a date are included
+    only when neither `start` nor `end` is given.
+
+    Args:
+        columns (list[str]): Columns to load, all columns if None.
+        start (str/datetime): First timestamp to include.
+        end (str/datetime): Timestamp to stop before.
+        root (str): Cache directory.
+
+    Returns:
+        df (pandas.DataFrame): Tweets with the requested columns, typed by
+            `src.data.schema.tweet_dtypes`.
+    """
+    meta = read_meta(root)
+    if meta is None:
+        raise IOError('no tweet cache found in {}, run make_cache.py'.format(root))
+
+    columns = list(columns or cols)
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+
+    # The date column is needed to trim partial days
+    read_cols = columns + ([] if 'date' in columns else ['date'])
+    frames = []
+    for day in meta['days']:
+        day_start = pd.Timestamp(day)
+        if (start is not None and day_start + timedelta(days=1) <= start) or \
+           (end is not None and day_start >= end):
+            continue
+
+        data = read_partition(root, day_start, read_cols)
+        mask = np.ones(len(data['date']), dtype=bool)
+        if start is not None:
+            mask &= data['date'] >= start.to_datetime64()
+        if end is not None:
+            mask &= data['date'] < end.to_datetime64()
+        frames.append(pd.DataFrame({c: data[c][mask] for c in columns},
+                                   columns=columns))
+
+    if start is None and end is None and meta.get('null_rows'):
+        frames.append(load_null_dates(columns, root))
+    if not frames:
+        return apply_schema(pd.DataFrame(columns=columns))
+    return apply_schema(pd.concat(frames, ignore_index=True))
+
+
+###############################################################################
+# Cache Export                                                                #
+###############################################################################
+
+def export_cache(conn, root=cache_dir, itersize=50000):
+    """ Rebuilds the cache from `filter_tweets`, one day at a time.
+
+    Each day is streamed through a named (server-side) cursor so only one
+    day of rows is held in memory. Rows without a date are written last, to
+    their own directory. The cache is written next to `root` and swapped in
+    once complete.
+
+    Returns:
+        n_rows (int): Rows written to the cache.
+    """
+    log_cache = logging.getLogger(__name__).getChild('export')
+    curr = conn.cursor()
+    high_water, rebuilt_at = get_version(curr)
+    curr.execute("SELECT date_trunc('day', MIN(date)), MAX(date) FROM filter_tweets;")
+    first_day, last = curr.fetchone()
+    curr.close()
+
+    tmp_root = root + '.tmp'
+    shutil.rmtree(tmp_root, ignore_errors=True)
+    os.makedirs(tmp_root)
+
+    def fetch(where, params=None):
+        curr = conn.cursor(name='export_cache')
+        curr.itersize = itersize
+        curr.execute('SELECT {} FROM filter_tweets WHERE {};'.format(
+            ', '.join('"{}"'.format(c) for c in cols), where), params)
+        rows = list(curr)
+        curr.close()
+        return rows
+
+    days = []
+    n_rows = 0
+    day = first_day
+    while day is not None and day <= last:
+        next_day = day + timedelta(days=1)
+        rows = fetch('date >= %s AND date < %s', (day, next_day))
+
+        if rows:
+            write_day(tmp_root, day, rows)
+            days.append(day.strftime('%Y-%m-%d'))
+            n_rows += len(rows)
+            log_cache.info('{}: {} rows'.format(days[-1], len(rows)))
+        day = next_day
+
+    null_rows = fetch('date IS NULL')
+    if null_rows:
+        write_day(tmp_root, None, null_rows)
+        n_rows += len(null_rows)
+        log_cache.info('no date: {} rows'.format(len(null_rows)))
+
+    with open(os.path.join(tmp_root, '_meta.json'), 'w') as f:
+        json.dump({'high_water': high_water, 'rebuilt_at': rebuilt_at, 'days': days,
+                   'null_rows': len(null_rows), 'rows': n_rows}, f)
+
+    # Swap the finished cache in
+    shutil.rmtree(root, ignore_errors=True)
+    os.rename(tmp_root, root)
+    return n_rows
+
+
+@click.command()
+@click.argument('database_url', envvar='DATABASE_URL')
+@click.option('--force', is_flag=True, help='Rebuild even if the cache is fresh.')
+@click.option('--itersize', default=50000, type=click.IntRange(min=1),
+              help='Rows fetched per round trip from the server-side cursor.')
+def main(database_url, force, itersize):
+    """ Exports filter_tweets into the columnar cache under data/processed.
+
+    The cache is rebuilt only when the filter stage high-water mark has moved,
+    or filter_tweets was rebuilt, since the last export.
+    """
+    logger = logging.getLogger(__name__)
+    start = time()
+    conn = checkout(database_url)
+    try:
+        if not force and is_fresh(conn.cursor()):
+            logger.info('cache is fresh, nothing to export')
+            return
+        n_rows = export_cache(conn, itersize=itersize)
+        logger.info('exported {} rows in {:.2f} secs'.format(n_rows, time() - start))
+    finally:
+        release(conn, database_url)
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO,
+                    format=log_fmt, datefmt='%H:%M:%S',
+                    filename='reports/pipeline.cache.log', filemode='a')
+
+    # Load our dot environment
+    load_dotenv(find_dotenv())
+
+    main()
@@ -4,18 +4,61 @@ import click
 import logging
 from dotenv import find_dotenv, load_dotenv
 
-import numpy as np
+import hashlib
 import pandas as pd
 from sqlalchemy import create_engine
-from io import StringIO
 from time import time
+from multiprocessing import Pool, BoundedSemaphore
 
+from src.data.metrics import Metrics, Run
+from src.data.schema import csv_options, ingest_dtypes
 
-def get_twitter_files(input_filepath):
+
+def hash_file(filepath, block_size=1 << 20):
+    """ Function that returns the SHA-1 hex digest of a file's contents.
+
+        Args:
+            filepath (str): Valid path to a file.
+            block_size (int): Bytes read per iteration.
+
+        Returns:
+            digest (str): Hex encoded SHA-1 of the file.
+    """
+    sha = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def read_manifest(db):
+    """ Function that returns the ingest manifest as a dict keyed by file path.
+
+        Args:
+            db (sqlalchemy.Engine): Database connection from SQLAlchemy.
+
+        Files staged but not yet moved count as loaded, their rows are moved
+        with the next `--staged` run.
+
+        Returns:
+            manifest (dict): path -> (size, mtime, sha1) of every loaded file.
+    """
+    rows = db.execute('SELECT "path", "size", "mtime", "sha1" FROM "import_manifest" '
+                      'UNION ALL '
+                      'SELECT "path", "size", "mtime", "sha1" FROM "import_manifest_staging";')
+    return {r[0]: (r[1], r[2], r[3]) for r in rows}
+
+
+def get_twitter_files(input_filepath, db=None, force=False):
     """ Function that returns a list of all *.csv files in a directory.
 
+        When a database is passed, files recorded in `import_manifest` with the
+        same size and mtime (or, failing that, the same content hash) are skipped.
+
         Args:
             input_filepath (str):  File path to directory containing raw twitter scrapes.
+            db (sqlalchemy.Engine): Optional database used to look up the manifest.
+            force (bool): Return every file, ignoring the manifest.
         
         Returns:
             filtered_files (list): List of formatted filepaths pointing to .csv files.
@@ -35,7 +78,26 @@ def get_twitter_files(input_filepath):
             (f.endswith('.csv') and not f.startswith('.'))]
 
         # Create file paths by combining it with our passed directory
-        filtered_files = [os.path.join(input_filepath, f) for f in filtered_files]
+        filtered_files = [os.path.abspath(os.path.join(input_filepath, f))
+                          for f in filtered_files]
+
+        # Drop files already loaded and unchanged since
+        if db is not None and not force:
+            manifest = read_manifest(db)
+            new_files = []
+            for f in filtered_files:
+                stat = os.stat(f)
+                loaded = manifest.get(f)
+                if loaded is None:
+                    new_files.append(f)
+                elif (loaded[0], loaded[1]) == (stat.st_size, stat.st_mtime):
+                    continue
+                elif loaded[2] != hash_file(f):
+                    log_files.warning('{} changed since last import'.format(f))
+                    new_files.append(f)
+            log_files.info('Skipping {} previously imported files.'.format(
+                len(filtered_files) - len(new_files)))
+            filtered_files = new_files
 
     except Exception as error:
         print ('\tCould not find directory!')
@@ -45,15 +107,137 @@ def get_twitter_files(input_filepath):
         return filtered_files
 
 
-def import_file(filepath, db):
+class ChunkedCSVStream(object):
+    """ File-like adapter that serialises DataFrame chunks to TSV on demand.
+
+        `copy_expert` pulls from `read` until it returns an empty string, so only
+        one chunk of the CSV is held in memory (as a frame and as text) at once.
+
+        With `slots` a slot is held only while a parsed chunk is handed to the
+        COPY, and given back while the next chunk is parsed, so the semaphore
+        caps concurrent network COPYs without serialising CSV parsing.
+
+        Args:
+            chunks (iterable): DataFrames, e.g. from `pd.read_csv(..., chunksize=n)`.
+            cols (list[str]): Columns to write, in COPY order.
+            metrics (src.data.metrics.Metrics): Optional metrics receiving the
+                `parse` and `copy_wait` time and `rows_read` count.
+            slots (multiprocessing.BoundedSemaphore): Optional COPY slots.
+    """
+    def __init__(self, chunks, cols, metrics=None, slots=None):
+        self.chunks = iter(chunks)
+        self.cols = cols
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.slots = slots
+        self.holding = False
+        self.buffer = ''
+        self.pos = 0
+        self.header = True
+        self.rows = 0
+
+    def acquire(self):
+        if self.slots is not None and not self.holding:
+            with self.metrics.timer('copy_wait'):
+                self.slots.acquire()
+            self.holding = True
+
+    def release(self):
+        if self.holding:
+            self.slots.release()
+            self.holding = False
+
+    def _next_chunk(self):
+        # Parsing happens lazily here, so this is the CSV side of the COPY
+        self.release()
+        with self.metrics.timer('parse'):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return False
+            self.buffer = chunk[self.cols].to_csv(None, sep='\t', header=self.header,
+                                                  index=False, encoding='utf-8')
+        self.acquire()
+        self.metrics.count('rows_read', len(chunk))
+        self.pos = 0
+        self.header = False
+        self.rows += len(chunk)
+        return True
+
+    def read(self, size=-1):
+        # Refill from the next chunk once the current text is consumed
+        while self.pos >= len(self.buffer):
+            if not self._next_chunk():
+                return ''
+        if size is None or size < 0:
+            end = len(self.buffer)
+        else:
+            end = self.pos + size
+        data = self.buffer[self.pos:end]
+        self.pos = end
+        return data
+
+    def readline(self, size=-1):
+        while self.pos >= len(self.buffer):
+            if not self._next_chunk():
+                return ''
+        end = self.buffer.find('\n', self.pos) + 1 or len(self.buffer)
+        if size is not None and size >= 0:
+            end = min(end, self.pos + size)
+        data = self.buffer[self.pos:end]
+        self.pos = end
+        return data
+
+
+import_cols = ['tweetID', 'date', 'message', 'username', 'userID', 'language',
+               'longitude', 'latitude', 'retweet']
+
+copy_sql = """COPY "{}" ("tweetID", "date", "message", "username", "userID", "language", "longitude", "latitude", "retweet") 
+FROM STDIN 
+WITH (FORMAT CSV, HEADER TRUE, DELIMITER '\t');
+"""
+
+# Files copied into the staging table are recorded in the unlogged staging
+# manifest, and only enter import_manifest when their rows are moved.
+manifest_tables = {'raw_tweets': 'import_manifest',
+                   'raw_tweets_staging': 'import_manifest_staging'}
+
+manifest_sql = """INSERT INTO "{}" ("path", "size", "mtime", "sha1", "rows", "duration")
+VALUES (%s, %s, %s, %s, %s, %s)
+ON CONFLICT ("path") DO UPDATE SET
+    "size" = EXCLUDED."size", "mtime" = EXCLUDED."mtime", "sha1" = EXCLUDED."sha1",
+    "rows" = EXCLUDED."rows", "duration" = EXCLUDED."duration", "loaded_at" = now();
+"""
+
+
+def read_chunks(filepath, chunk_rows=100000):
+    """ Function that returns a lazy reader of `chunk_rows` row DataFrames of a scrape.
+
+        Only the ids are typed, by the shared `ingest_dtypes`, since the rows
+        are re-serialised for COPY straight away.
+    """
+    return pd.read_csv(filepath, engine='c', chunksize=chunk_rows,
+                       **csv_options(import_cols, ingest_dtypes))
+
+
+def import_file(filepath, db, copy_slots=None, chunk_rows=100000, table='raw_tweets',
+                metrics=None):
     """ Function that imports a CSV into our database using the native PostgreSQL COPY command. 
 
+        The file is read `chunk_rows` rows at a time and streamed into a single
+        COPY, so peak memory depends on the chunk size rather than the file size.
+
         Args:
             filepath (str): Valid path to a .csv file
             db (sqlalchemy.Engine): Database connection from SQLAlchemy.
+            copy_slots (multiprocessing.BoundedSemaphore): Optional semaphore held while
+                chunks stream to the server, capping concurrent COPYs across workers.
+            chunk_rows (int): Number of CSV rows parsed and sent per chunk.
+            table (str): Table receiving the rows, `raw_tweets` or `raw_tweets_staging`.
+            metrics (src.data.metrics.Metrics): Optional metrics receiving parse,
+                hash, COPY wait and database time, and row and byte counts.
         
         Returns:
-            None: But will write file upload success/failure and stats to a log file.
+            rows (int): Rows copied, or None on failure. Upload success/failure and
+                stats are also written to a log file.
     """
     # Logging
     log_main = logging.getLogger(__name__)
@@ -61,95 +245,339 @@ def import_file(filepath, db):
     log_import = log_import.getChild(filepath.split('/')[-1])
     log_import.info('started')
     start = time()
+    metrics = metrics if metrics is not None else Metrics()
 
     # Variables used in data processing
-    memory_buff = StringIO()
     curr        = None
-    cols        = ['tweetID', 'date', 'message', 'username', 'userID', 'language',
-                    'longitude', 'latitude', 'retweet']
-    sql = """COPY "raw_tweets" ("tweetID", "date", "message", "username", "userID", "language", "longitude", "latitude", "retweet") 
-    FROM STDIN 
-    WITH (FORMAT CSV, HEADER TRUE, DELIMITER '\t');
-    """
+    conn        = None
+    cols        = import_cols
+    sql         = copy_sql.format(table)
     
-    # Try reading the file
+    # Try opening the file, chunks are parsed lazily while copying
     try:
-        df = pd.read_csv(filepath, 
-                        usecols=cols, engine='c', 
-                        memory_map=True, low_memory=False,
-                        dtype={'userID': np.int64, 'tweetID': np.int64})
+        stat = os.stat(filepath)
+        with metrics.timer('hash'):
+            sha1 = hash_file(filepath)
+        reader = read_chunks(filepath, chunk_rows)
+        stream = ChunkedCSVStream(reader, cols, metrics, copy_slots)
     except Exception as e:
+        metrics.count('files_failed')
         log_import.warn('error on read_csv')
-        memory_buff.close()
         print (e)
         return
 
-    # Attempt to open up a connection to database.
+    # Check out a connection from the engine's pool, returned by `conn.close()`.
     try:
-        connn = db.connect()
         conn = db.raw_connection()
         curr = conn.cursor()
     except (Exception) as e:
+        metrics.count('files_failed')
         log_import.warn('error on server connection')
-        memory_buff.close()
+        reader.close()
         if curr is not None:
             curr.close()
+        if conn is not None:
+            conn.close()
         print (e)
         return
 
     # Try copying the files to table.
     try:
-        # Save to our buffer
-        df[cols].to_csv(memory_buff, sep='\t',
-                        header=True, index=False, encoding='utf-8')
+        # Copy records using native Postgres COPY command (FAST)
+        copy_start = time()
+        parse_before = metrics.timers['parse']
+        wait_before = metrics.timers['copy_wait']
+        try:
+            curr.copy_expert(sql, stream, size=1 << 16)
+        finally:
+            stream.release()
 
-        # Point buffer to start of memory block
-        memory_buff.seek(0)
+        # COPY time not spent parsing chunks or waiting for a slot is spent on the server
+        metrics.timers['db'] += time() - copy_start - \
+            (metrics.timers['parse'] - parse_before) - \
+            (metrics.timers['copy_wait'] - wait_before)
 
-        # Copy records using native Postgres COPY command (FAST)
-        curr.copy_expert(sql, memory_buff)
+        # Record the file in the manifest within the same transaction
+        curr.execute(manifest_sql.format(manifest_tables[table]),
+                     (os.path.abspath(filepath), stat.st_size, stat.st_mtime, sha1,
+                      stream.rows, time() - start))
 
         # Save transaction and commit to DB
-        conn.commit()
+        with metrics.timer('db'):
+            conn.commit()
     except (Exception) as e:
+        metrics.count('files_failed')
         log_import.warn('error while copying to database')
-        memory_buff.close()
-        if curr is not None:
-            curr.close()
+        conn.rollback()
         print (e)
         return
     finally:
-        memory_buff.close()
+        reader.close()
         if curr is not None:
             curr.close()
-    log_import.info('finished ({:.2f})'.format(time() - start))
-    return
+        conn.close()
+    metrics.count('files')
+    metrics.count('rows_copied', stream.rows)
+    metrics.count('bytes', stat.st_size)
+    log_import.info('finished {} rows ({:.2f})'.format(stream.rows, time() - start))
+    return stream.rows
+
+
+###############################################################################
+# Staged Bulk Loads                                                           #
+###############################################################################
+
+def drop_indexes(conn, table='raw_tweets'):
+    """ Drops every index on a table, returning their definitions for `create_indexes`.
+
+        Args:
+            conn (psycopg2.connection): Raw database connection.
+            table (str): Table to drop indexes from.
+
+        Returns:
+            index_defs (list[str]): `CREATE INDEX` statements for the dropped indexes.
+    """
+    curr = conn.cursor()
+    curr.execute('SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s;',
+                 (table,))
+    indexes = curr.fetchall()
+    for name, _ in indexes:
+        curr.execute('DROP INDEX IF EXISTS "{}";'.format(name))
+    conn.commit()
+    curr.close()
+    return [indexdef for _, indexdef in indexes]
+
+
+def create_indexes(conn, index_defs):
+    """ Rebuilds indexes dropped by `drop_indexes`, one set-based build each. """
+    curr = conn.cursor()
+    for indexdef in index_defs:
+        # Partitioned indexes are reported `ON ONLY`, which would skip partitions
+        curr.execute(indexdef.replace(' ON ONLY ', ' ON ', 1))
+    conn.commit()
+    curr.close()
+
+
+move_manifest_sql = """INSERT INTO "import_manifest" ("path", "size", "mtime", "sha1", "rows", "duration")
+SELECT "path", "size", "mtime", "sha1", "rows", "duration" FROM "import_manifest_staging"
+ON CONFLICT ("path") DO UPDATE SET
+    "size" = EXCLUDED."size", "mtime" = EXCLUDED."mtime", "sha1" = EXCLUDED."sha1",
+    "rows" = EXCLUDED."rows", "duration" = EXCLUDED."duration", "loaded_at" = now();
+"""
+
+
+def move_staged_rows(conn, defer_indexes=False):
+    """ Moves every row from the unlogged staging table into `raw_tweets`.
+
+        The insert, the manifest rows of the staged files and the truncate of
+        both staging tables share one transaction, so files only count as
+        imported once their rows are in `raw_tweets`. With `defer_indexes` the
+        indexes on `raw_tweets` are dropped first and rebuilt once the rows are
+        in (or the move is rolled back), instead of being maintained row by row.
+
+        Args:
+            conn (psycopg2.connection): Raw database connection.
+            defer_indexes (bool): Drop and rebuild `raw_tweets` indexes around the move.
+
+        Returns:
+            rows (int): Number of rows moved.
+    """
+    cols = '"tweetID", "date", "message", "username", "userID", "language", ' \
+           '"longitude", "latitude", "retweet"'
+    index_defs = drop_indexes(conn) if defer_indexes else []
+
+    curr = conn.cursor()
+    try:
+        curr.execute('INSERT INTO "raw_tweets" ({0}) SELECT {0} FROM "raw_tweets_staging";'
+                     .format(cols))
+        rows = curr.rowcount
+        curr.execute(move_manifest_sql)
+        curr.execute('TRUNCATE "raw_tweets_staging", "import_manifest_staging";')
+        conn.commit()
+    except Exception:
+        # Rebuilding needs a live transaction, the move's error is raised after
+        conn.rollback()
+        try:
+            create_indexes(conn, index_defs)
+        except Exception as error:
+            conn.rollback()
+            logging.getLogger(__name__).error(
+                'could not rebuild raw_tweets indexes: {}'.format(error))
+        raise
+    finally:
+        curr.close()
+    create_indexes(conn, index_defs)
+    return rows
+
+
+###############################################################################
+# Worker Pool                                                                 #
+###############################################################################
+
+# Per-process state, set once by `init_worker` when the pool starts.
+worker_engine = None
+worker_options = {}
+
+
+def init_worker(import_url, copy_slots, options):
+    """ Pool initializer giving each worker process its own database engine.
+
+        Args:
+            import_url (str): SQLAlchemy database URL.
+            copy_slots (multiprocessing.BoundedSemaphore): Semaphore shared by all
+                workers, limiting how many COPY streams run at once.
+            options (dict): Keyword arguments passed on to `import_file`.
+    """
+    global worker_engine, worker_options
+    worker_engine = create_engine(import_url, client_encoding='utf8')
+    worker_options = dict(options, copy_slots=copy_slots)
+
+
+def import_file_worker(filepath):
+    """ Imports a single file using the worker's engine.
+
+        Returns:
+            (filepath, metrics): The file and its `Metrics.as_dict()`, merged
+                into the run by the parent process.
+    """
+    metrics = Metrics()
+    import_file(filepath, worker_engine, metrics=metrics, **worker_options)
+    return filepath, metrics.as_dict()
+
+
+def import_serial(csvs, db_engine, run, options):
+    """ Imports files one after another on a single engine.
+
+        Args:
+            csvs (list[str]): Files to import.
+            db_engine (sqlalchemy.engine.Engine): Database engine.
+            run (src.data.metrics.Run): Run receiving each file's metrics.
+            options (dict): Keyword arguments passed on to `import_file`.
+    """
+    with click.progressbar(csvs, label='CSV Imports: ') as csv_progress:
+        for csv in csv_progress:
+            metrics = Metrics()
+            import_file(csv, db_engine, metrics=metrics, **options)
+            run.merge(metrics)
+            run.emit('file', path=csv, **metrics.as_dict())
+
+
+def import_parallel(csvs, import_url, run, options, workers, max_copies=None):
+    """ Imports files with a pool of `workers` processes.
+
+        Args:
+            csvs (list[str]): Files to import.
+            import_url (str): SQLAlchemy database URL, one engine per worker.
+            run (src.data.metrics.Run): Run receiving each file's metrics.
+            options (dict): Keyword arguments passed on to `import_file`.
+            workers (int): Number of worker processes.
+            max_copies (int): Concurrent COPY streams, `workers` if None.
+    """
+    log_import = logging.getLogger(__name__).getChild('import_files')
+    copy_slots = BoundedSemaphore(max_copies or workers)
+    log_import.info('Using {} workers, {} concurrent copies'.format(
+        workers, max_copies or workers))
+    pool = Pool(workers, initializer=init_worker,
+                initargs=(import_url, copy_slots, options))
+    try:
+        # Progress is advanced as each worker finishes a file
+        with click.progressbar(length=len(csvs), label='CSV Imports: ') as csv_progress:
+            for csv, metrics in pool.imap_unordered(import_file_worker, csvs):
+                run.merge(metrics)
+                run.emit('file', path=csv, **metrics)
+                csv_progress.update(1)
+        pool.close()
+    except (Exception, KeyboardInterrupt):
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def move_staged(db_engine, run, defer_indexes=False):
+    """ Moves staged rows into `raw_tweets` in one set-based step, see
+        `move_staged_rows`, recording the `move` time and `rows_moved`.
+    """
+    log_import = logging.getLogger(__name__).getChild('import_files')
+    log_import.info('moving staged rows into raw_tweets')
+    conn = db_engine.raw_connection()
+    try:
+        with run.timer('move'):
+            moved = move_staged_rows(conn, defer_indexes=defer_indexes)
+    finally:
+        conn.close()
+    run.count('rows_moved', moved)
+    log_import.info('moved {} staged rows'.format(moved))
 
 
 @click.command()
 @click.argument('input_filepath', type=click.Path(exists=True), envvar='DATA_DIR')
 @click.argument('import_url', envvar='IMPORT_URL')
-def main(input_filepath, import_url):
+@click.option('--workers', default=1, type=click.IntRange(min=1),
+              help='Number of processes importing files in parallel.')
+@click.option('--max-copies', default=None, type=click.IntRange(min=1),
+              help='Maximum concurrent COPY streams (defaults to --workers).')
+@click.option('--chunk-rows', default=100000, type=click.IntRange(min=1),
+              help='CSV rows held in memory per streamed COPY chunk.')
+@click.option('--force', is_flag=True,
+              help='Import every file, even those already in the manifest.')
+@click.option('--staged', is_flag=True,
+              help='COPY into the unlogged staging table, then move rows in one step.')
+@click.option('--defer-indexes', is_flag=True,
+              help='With --staged, rebuild raw_tweets indexes after the move.')
+@click.option('--async-copy', is_flag=True,
+              help='Parse the next chunks while the current ones COPY (single worker).')
+@click.option('--queue-chunks', default=4, type=click.IntRange(min=1),
+              help='With --async-copy, parsed chunks buffered ahead of the COPY.')
+def main(input_filepath, import_url, workers, max_copies, chunk_rows, force,
+         staged, defer_indexes, async_copy, queue_chunks):
     """ Runs data processing scripts to turn raw data from (../raw) into
         cleaned data ready to be analyzed (saved in ../processed).
+
+        With `--workers N` files are parsed by N processes, each holding its
+        own connection, while at most `--max-copies` of them COPY at a time.
+
+        With `--staged` files are copied into the unlogged `raw_tweets_staging`
+        table, skipping WAL, and moved into `raw_tweets` once all files are in.
+
+        With `--async-copy` a single connection COPYs while the next chunks,
+        and the next files, are parsed, see `async_ingest.import_files_async`.
     """
     # Logging set up
     start = time()
+    run = Run('import')
     logger = logging.getLogger(__name__)
     log_import = logger.getChild('import_files')
     logger.info('Importing from raw data')
     
     # Dataset variables
     db_engine = create_engine(import_url, client_encoding='utf8')
-    csvs = get_twitter_files(input_filepath)
+    csvs = get_twitter_files(input_filepath, db=db_engine, force=force)
+    options = {'chunk_rows': chunk_rows,
+               'table': 'raw_tweets_staging' if staged else 'raw_tweets'}
     
     # Upload data
     log_import.info('Starting to upload {} csvs...'.format(len(csvs)))
-    with click.progressbar(csvs, label='CSV Imports: ') as csv_progress:
-        for csv in csv_progress:
-            import_file(csv, db_engine)
+    if async_copy:
+        from src.data.async_ingest import import_files_async
+        if workers > 1:
+            log_import.warning('--async-copy uses a single connection, ignoring --workers')
+        import_files_async(csvs, db_engine, queue_chunks=queue_chunks, metrics=run, **options)
+    elif workers == 1:
+        import_serial(csvs, db_engine, run, options)
+    else:
+        import_parallel(csvs, import_url, run, options, workers, max_copies)
+
+    # Move staged rows into the final table in one set-based step
+    if staged:
+        move_staged(db_engine, run, defer_indexes=defer_indexes)
 
     log_import.info('{} files done in {:.2f} secs.'.format(len(csvs), time() - start))
+    conn = db_engine.raw_connection()
+    try:
+        run.finish(conn)
+    finally:
+        conn.close()
 
 if __name__ == '__main__':
     # Configure logging
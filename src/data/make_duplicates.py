@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+import os
+import zlib
+import click
+import logging
+from dotenv import find_dotenv, load_dotenv
+from io import StringIO
+from multiprocessing import Pool
+from time import time
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from src.data.database import checkout, release, stream_rows
+from src.features.build_features import tokenize_batch
+
+
+###############################################################################
+# Shingles & MinHash Signatures                                               #
+###############################################################################
+
+work_dir = os.path.join('data', 'interim', 'minhash')
+
+MAX_HASH = np.uint32(0xFFFFFFFF)
+
+
+def shingle_hashes(messages, k=3):
+    """ Hashes the word k-shingles of a batch of messages.
+
+    Messages go through `tokenize_batch`, so URLs, mentions and '#' are gone
+    and templated tweets differing only in those still match. Tokens are
+    hashed once per unique token with crc32, which unlike `hash` is the same
+    in every process. Messages shorter than k words are one shingle.
+
+    Args:
+        messages (list[str]): Tweet texts.
+        k (int): Words per shingle.
+
+    Returns:
+        hashes (numpy.ndarray): uint32 hash of every shingle, in order.
+        offsets (numpy.ndarray): int64 array of len(messages) + 1, message i
+            owns hashes[offsets[i]:offsets[i + 1]].
+    """
+    tokens, token_offsets = tokenize_batch(messages)
+    if len(tokens) == 0:
+        return np.zeros(0, dtype=np.uint32), np.zeros(len(messages) + 1, dtype=np.int64)
+    uniques, inverse = np.unique(tokens.astype(str), return_inverse=True)
+    token_hashes = np.array([zlib.crc32(u.encode('utf-8')) for u in uniques],
+                            dtype=np.uint64)[inverse.ravel()]
+
+    lengths = np.diff(token_offsets)
+    counts = np.where(lengths > 0, np.maximum(lengths - k + 1, 1), 0)
+    offsets = np.zeros(len(messages) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    # First token of every shingle, and where its message ends
+    doc = np.repeat(np.arange(len(messages)), counts)
+    first = token_offsets[doc] + np.arange(offsets[-1]) - offsets[doc]
+    end = token_offsets[doc + 1]
+
+    hashes = np.zeros(len(first), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for j in range(k):
+            pos = first + j
+            part = np.where(pos < end, token_hashes[np.minimum(pos, len(tokens) - 1)], 0)
+            hashes = hashes * np.uint64(0x100000001B3) + part
+    return (hashes >> np.uint64(32)).astype(np.uint32) ^ hashes.astype(np.uint32), offsets
+
+
+class MinHasher(object):
+    """ MinHash signatures from multiply-shift hash functions.
+
+    Permutation j maps a 32 bit shingle hash x to the high 32 bits of
+    (a_j * x + b_j) mod 2^64, with a_j odd. The signature of a message is the
+    minimum over its shingles for every permutation, and the fraction of
+    equal signature values of two messages estimates their Jaccard similarity.
+
+    Args:
+        num_perm (int): Signature length.
+        seed (int): Seed of the permutations, equal seeds give equal signatures.
+    """
+    def __init__(self, num_perm=128, seed=1):
+        rng = np.random.RandomState(seed)
+        high = rng.randint(0, 2 ** 32, size=(2, num_perm), dtype=np.uint64)
+        low = rng.randint(0, 2 ** 32, size=(2, num_perm), dtype=np.uint64)
+        self.a = (high[0] << np.uint64(32)) | low[0] | np.uint64(1)
+        self.b = (high[1] << np.uint64(32)) | low[1]
+        self.num_perm = num_perm
+
+    def signatures(self, hashes, offsets):
+        """ Returns the (n, num_perm) uint32 signatures, all MAX_HASH if no shingles. """
+        n = len(offsets) - 1
+        sigs = np.full((n, self.num_perm), MAX_HASH, dtype=np.uint32)
+        has_shingles = np.diff(offsets) > 0
+        if not has_shingles.any():
+            return sigs
+        starts = offsets[:-1][has_shingles]
+        x = hashes.astype(np.uint64)
+        with np.errstate(over='ignore'):
+            for j in range(self.num_perm):
+                permuted = ((self.a[j] * x + self.b[j]) >> np.uint64(32)).astype(np.uint32)
+                sigs[has_shingles, j] = np.minimum.reduceat(permuted, starts)
+        return sigs
+
+
+def band_keys(sigs, bands):
+    """ Hashes each band of `rows = num_perm // bands` signature values to a uint64 key. """
+    rows = sigs.shape[1] // bands
+    keys = np.zeros((len(sigs), bands), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for r in range(rows):
+            keys = keys * np.uint64(0x100000001B3) + \
+                sigs[:, r:bands * rows:rows].astype(np.uint64)
+    return keys
+
+
+###############################################################################
+# LSH Clustering                                                              #
+###############################################################################
+
+def band_edges(keys):
+    """ Links every row to the first row sharing its key, O(n log n) per band.
+
+    A star per bucket instead of all pairs keeps the edge count linear in
+    the number of rows, however large a spam bucket grows.
+    """
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    starts = np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]])
+    first = order[np.flatnonzero(starts)[np.cumsum(starts) - 1]]
+    linked = first != order
+    return first[linked], order[linked]
+
+
+def similarity(sigs, src, dst, block=1000000):
+    """ Estimated Jaccard similarity of the signature pairs (src, dst). """
+    out = np.empty(len(src))
+    for s in range(0, len(src), block):
+        out[s:s + block] = (sigs[src[s:s + block]] == sigs[dst[s:s + block]]).mean(axis=1)
+    return out
+
+
+def cluster(sigs, keys, threshold=0.8):
+    """ Groups rows into near-duplicate clusters.
+
+    Candidate pairs come from LSH buckets, are kept if their estimated
+    similarity reaches `threshold` and are merged into connected components.
+
+    Args:
+        sigs (numpy.ndarray): (n, num_perm) MinHash signatures.
+        keys (numpy.ndarray): (n, bands) LSH band keys of the same rows.
+        threshold (float): Minimum estimated Jaccard similarity of an edge.
+
+    Returns:
+        labels (numpy.ndarray): Component label per row.
+        sizes (numpy.ndarray): Size of each row's component.
+    """
+    n = len(sigs)
+    src, dst = [], []
+    for band in range(keys.shape[1]):
+        s, d = band_edges(keys[:, band])
+        verified = similarity(sigs, s, d) >= threshold
+        src.append(s[verified])
+        dst.append(d[verified])
+    src, dst = np.concatenate(src), np.concatenate(dst)
+    graph = sparse.coo_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    sizes = np.bincount(labels)[labels]
+    return labels, sizes
+
+
+###############################################################################
+# Dedup Stage                                                                 #
+###############################################################################
+
+def init_worker(num_perm, seed, shingle_size, bands):
+    global worker_hasher, worker_options
+    worker_hasher = MinHasher(num_perm, seed)
+    worker_options = (shingle_size, bands)
+
+
+def sign_chunk(chunk):
+    """ Returns (ids, signatures, band keys) of an (ids, messages) chunk.
+
+    Messages without a single word (only links or mentions) are left out.
+    """
+    ids, messages = chunk
+    shingle_size, bands = worker_options
+    hashes, offsets = shingle_hashes(messages, shingle_size)
+    keep = np.diff(offsets) > 0
+    sigs = worker_hasher.signatures(hashes, offsets)[keep]
+    return np.asarray(ids, dtype=np.int64)[keep], sigs, band_keys(sigs, bands)
+
+
+def read_chunks(conn, chunk_rows):
+    for rows in stream_rows(conn, 'SELECT id, message FROM filter_tweets ORDER BY id;',
+                            itersize=chunk_rows, name='dedup_tweets'):
+        yield tuple(list(c) for c in zip(*rows))
+
+
+def check_options(threshold, num_perm, bands):
+    """ Raises click.BadParameter for option values the LSH cannot use. """
+    if not 0 <= threshold <= 1:
+        raise click.BadParameter('--threshold must be between 0 and 1')
+    if num_perm % bands:
+        raise click.BadParameter('--num-perm must be a multiple of --bands')
+
+
+@click.command()
+@click.argument('database_url', envvar='DATABASE_URL')
+@click.option('--threshold', default=0.8, type=float,
+              help='Minimum estimated Jaccard similarity of near-duplicates.')
+@click.option('--num-perm', default=128, type=click.IntRange(min=1),
+              help='MinHash signature length.')
+@click.option('--bands', default=16, type=click.IntRange(min=1),
+              help='LSH bands, each of num-perm / bands signature values.')
+@click.option('--shingle-size', default=3, type=click.IntRange(min=1),
+              help='Words per shingle.')
+@click.option('--chunk-rows', default=100000, type=click.IntRange(min=1),
+              help='Messages signed per chunk.')
+@click.option('--workers', default=1, type=click.IntRange(min=1),
+              help='Number of processes computing signatures.')
+def main(database_url, threshold, num_perm, bands, shingle_size, chunk_rows, workers):
+    """ Flags near-duplicate filtered tweets in tweet_duplicates.
+
+    Signatures and band keys are computed across a process pool and appended
+    to raw files in data/interim/minhash, which are memory mapped for the LSH
+    step, so only the edges of one band are in memory at a time.
+    """
+    logger = logging.getLogger(__name__)
+    log_sign = logger.getChild('sign')
+    check_options(threshold, num_perm, bands)
+    start = time()
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    paths = [os.path.join(work_dir, name) for name in ('ids.i64', 'sigs.u32', 'keys.u64')]
+
+    read_conn = checkout(database_url)
+    pool = Pool(workers, initializer=init_worker,
+                initargs=(num_perm, 1, shingle_size, bands))
+    n_rows = 0
+    files = [open(p, 'wb') for p in paths]
+    try:
+        for ids, sigs, keys in pool.imap(sign_chunk, read_chunks(read_conn, chunk_rows)):
+            for f, values in zip(files, (ids, sigs, keys)):
+                values.tofile(f)
+            n_rows += len(ids)
+            log_sign.info('signed {} tweets ({:.0f}/sec)'.format(n_rows, n_rows / (time() - start)))
+        pool.close()
+    except (Exception, KeyboardInterrupt):
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        release(read_conn, database_url)
+        for f in files:
+            f.close()
+
+    if n_rows == 0:
+        logger.info('no tweets to deduplicate')
+        return
+    ids = np.memmap(paths[0], dtype=np.int64, mode='r')
+    sigs = np.memmap(paths[1], dtype=np.uint32, mode='r', shape=(n_rows, num_perm))
+    keys = np.memmap(paths[2], dtype=np.uint64, mode='r', shape=(n_rows, bands))
+    labels, sizes = cluster(sigs, keys, threshold)
+
+    # Clusters are named after their smallest (first filtered) tweet id
+    dup = np.flatnonzero(sizes > 1)
+    firsts = np.full(labels.max() + 1, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(firsts, labels[dup], ids[dup])
+    buff = StringIO()
+    for i in dup:
+        buff.write('{}\t{}\t{}\n'.format(ids[i], firsts[labels[i]], sizes[i]))
+    buff.seek(0)
+
+    conn = checkout(database_url)
+    try:
+        curr = conn.cursor()
+        curr.execute('TRUNCATE tweet_duplicates;')
+        curr.copy_expert('COPY tweet_duplicates (id, cluster, cluster_size) FROM STDIN;', buff)
+        conn.commit()
+    finally:
+        release(conn, database_url)
+    logger.info('{} of {} tweets in {} near-duplicate clusters, {:.2f} secs'.format(
+        len(dup), n_rows, len(np.unique(labels[dup])), time() - start))
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO,
+                    format=log_fmt, datefmt='%H:%M:%S',
+                    filename='reports/pipeline.duplicates.log', filemode='a')
+
+    load_dotenv(find_dotenv())
+
+    main()
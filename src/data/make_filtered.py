@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
-import os
 import click
 import logging
 from dotenv import find_dotenv, load_dotenv
-import psycopg2 as pg
+
+from src.data.metrics import Run
+from src.data.database import checkout, release
+from src.data.result_cache import cached
 
 
 ###############################################################################
@@ -19,64 +21,253 @@ filters = {
     'location': '((latitude IS NOT NULL) AND (longitude IS NOT NULL))'
 }
 
+# Only raw rows above the stored high-water id are scanned, duplicate tweetIDs
+# are dropped by the unique index on filter_tweets instead of a full sort.
 filter_query = """
 INSERT INTO
     filter_tweets
 SELECT 
-    DISTINCT ON ("tweetID") 
     * 
 FROM 
     raw_tweets
 WHERE
+    (id > %(low)s) AND
+    (id <= %(high)s) AND
     (message IS NOT NULL) AND
     (retweet IS NULL) AND
     (LEFT(language, 2) LIKE 'en') AND
     (latitude IS NOT NULL) AND
-    (longitude IS NOT NULL);
+    (longitude IS NOT NULL)
+ON CONFLICT ("tweetID") DO NOTHING;
+"""
+
+# Per-user counts of the batch just filtered are folded into user_stats. Tweets
+# already scored (only after a --full rebuild) add their sentiment here, later
+# ones when predict_model scores them.
+user_stats_query = """
+INSERT INTO user_stats
+SELECT
+    f."userID", MAX(f.username), COUNT(*), MIN(f.date), MAX(f.date),
+    COUNT(s.polarity), COALESCE(SUM(s.polarity), 0)
+FROM
+    filter_tweets f LEFT JOIN tweet_sentiment s ON s.id = f.id
+WHERE
+    (f.id > %(low)s) AND
+    (f.id <= %(high)s)
+GROUP BY f."userID"
+ON CONFLICT ("userID") DO UPDATE SET
+    username = EXCLUDED.username,
+    n_tweets = user_stats.n_tweets + EXCLUDED.n_tweets,
+    first_date = LEAST(user_stats.first_date, EXCLUDED.first_date),
+    last_date = GREATEST(user_stats.last_date, EXCLUDED.last_date),
+    n_scored = user_stats.n_scored + EXCLUDED.n_scored,
+    sum_polarity = user_stats.sum_polarity + EXCLUDED.sum_polarity;
+"""
+
+high_water_query = """
+SELECT high_water FROM filter_state WHERE stage = 'filter_tweets' FOR UPDATE;
 """
 
+update_high_water_query = """
+INSERT INTO filter_state (stage, high_water) VALUES ('filter_tweets', %(high)s)
+ON CONFLICT (stage) DO UPDATE SET high_water = EXCLUDED.high_water, updated_at = now();
+"""
+
+insert_stats_query = """
+INSERT INTO filter_stats (run_id, low_id, high_id, filter, cumulative, count)
+VALUES (%s, %s, %s, %s, %s, %s);
+"""
+
+
+def funnel_query(filters):
+    """ Builds one query counting every filter and every cumulative funnel stage.
+
+    Each filter is counted on its own and ANDed with the filters before it, in
+    the order of the `filters` dict, as `COUNT(*) FILTER (WHERE ...)` aggregates
+    so the raw id range is scanned only once.
+
+    Args:
+        filters (dict): Filter name -> SQL boolean expression.
+
+    Returns:
+        query (str): SQL taking `low`/`high` id parameters, returning one row
+            with the individual counts followed by the cumulative counts.
+    """
+    names = list(filters.keys())
+    counts = ['COUNT(*) FILTER (WHERE {})'.format(filters[n]) for n in names]
+    cumulative = ['COUNT(*) FILTER (WHERE {})'.format(
+        ' AND '.join(filters[n] for n in names[:i + 1])) for i in range(len(names))]
+    return 'SELECT\n    {}\nFROM raw_tweets\nWHERE (id > %(low)s) AND (id <= %(high)s);'.format(
+        ',\n    '.join(counts + cumulative))
+
+
+@cached('filter_counts', upstream=('import',))
+def get_filter_counts(curr, low, high, filters=filters):
+    """ Counts the filter funnel for raw_tweets ids in (low, high].
+
+    Results are cached by the id range, the filters and the import manifest,
+    so rebuilding over already imported rows skips the funnel scan.
+
+    Returns:
+        counts (list[tuple]): (filter, cumulative, count) for every filter,
+            individual counts first.
+    """
+    names = list(filters.keys())
+    curr.execute(funnel_query(filters), {'low': low, 'high': high})
+    row = curr.fetchone()
+    labels = [(n, False) for n in names] + [(n, True) for n in names]
+    return [(n, cum, cnt) for (n, cum), cnt in zip(labels, row)]
+
+
+def get_filter_report(curr):
+    """ Returns the funnel over every filtered batch from the stored run stats.
+
+    Returns:
+        counts (dict): (filter, cumulative) -> count across all runs.
+    """
+    curr.execute('SELECT filter, cumulative, SUM(count) FROM filter_stats '
+                 'GROUP BY filter, cumulative;')
+    return {(f, cum): int(cnt) for f, cum, cnt in curr.fetchall()}
+
 
 ###############################################################################
 # Postgres Table Creation                                                     #
 ###############################################################################
 
-def main():
+def get_high_water(curr):
+    """ Returns the last raw_tweets id processed by the filter stage (0 if none).
+
+        The state row is locked until the transaction ends, so two filter runs
+        cannot process the same batch.
     """
+    curr.execute(high_water_query)
+    row = curr.fetchone()
+    return row[0] if row is not None else 0
+
+
+def get_committed_high(database_url):
+    """ Returns a raw_tweets id below which every import has committed.
+
+    Concurrent imports draw SERIAL ids in one order but may commit in another,
+    so a plain MAX(id) can pass over lower ids committed later. SHARE mode
+    waits for the ROW EXCLUSIVE lock of every running COPY/INSERT, and ids
+    drawn after it is granted are above the MAX(id) read under it. The lock
+    lives on its own connection and is released right away.
+    """
+    conn = checkout(database_url)
+    try:
+        curr = conn.cursor()
+        curr.execute('LOCK TABLE raw_tweets IN SHARE MODE;')
+        curr.execute('SELECT COALESCE(MAX(id), 0) FROM raw_tweets;')
+        high = curr.fetchone()[0]
+        conn.commit()
+        curr.close()
+    finally:
+        release(conn, database_url)
+    return high
+
+
+def print_filter_report(database_url):
+    """ Prints the stored funnel, each filter alone and cumulatively. """
+    conn = checkout(database_url)
+    try:
+        counts = get_filter_report(conn.cursor())
+    finally:
+        release(conn, database_url)
+    for name in filters:
+        click.echo('{:10} {:>12} {:>12}'.format(
+            name, counts.get((name, False), 0), counts.get((name, True), 0)))
+
+
+def run_filter(database_url, full=False):
+    """ Inserts new raw_tweets rows passing our filters into filter_tweets.
+
+    Only rows with an id above the stored high-water mark are processed, so a
+    run costs in proportion to the newly imported batch.
+
+    Args:
+        database_url (str): Database to filter.
+        full (bool): Reset the mark and rebuild the table from scratch.
     """
     # Logging set up
     logger = logging.getLogger(__name__)
     log_filter = logger.getChild('filter_tweets')
     logger.info('Updating filtered table from raw_tweets.')
+    run = Run('filter')
 
     # Database variables
-    database_url = os.environ.get('DATABASE_URL')
-    conn = pg.connect(database_url)
+    conn = checkout(database_url)
     curr = conn.cursor()
 
-    # Drop tweets from existing table for now
-    #curr.execute('DELETE FROM filter_tweets WHERE "tweetID" IS NOT NULL;')
+    # Drop tweets from existing table when rebuilding
+    if full:
+        log_filter.info('full rebuild, emptying filter_tweets')
+        curr.execute('TRUNCATE filter_tweets;')
+        curr.execute("DELETE FROM filter_state WHERE stage = 'filter_tweets';")
+        curr.execute('TRUNCATE filter_stats;')
+        curr.execute('TRUNCATE user_stats;')
 
-    # Get filter counts
-    log_filter.info('getting filtered counts')
-    for col in filters.keys():
-        query = 'SELECT COUNT(*) FROM raw_tweets WHERE ' + filters[col] + ';'
-        curr.execute(query)
+    # Find the new batch of raw tweets
+    low = get_high_water(curr)
+    high = get_committed_high(database_url)
+    log_filter.info('processing raw_tweets ids ({}, {}]'.format(low, high))
 
-        filter_cnt = curr.fetchone()[0]
-        log_filter.info('Filter: {}  [{}]: {}'.format(col, query, filter_cnt))
-        print ('\t{}:\t{}'.format(col, filter_cnt))
+    # Get filter counts for the batch in a single scan, stored per run
+    log_filter.info('getting filtered counts')
+    curr.execute("SELECT nextval('filter_stats_run_seq');")
+    run_id = curr.fetchone()[0]
+    with run.timer('funnel'):
+        counts = get_filter_counts(curr, low, high)
+    for col, cumulative, filter_cnt in counts:
+        curr.execute(insert_stats_query,
+                     (run_id, low, high, col, cumulative, filter_cnt))
+        label = ('+' if cumulative else '') + col
+        log_filter.info('Filter: {}: {}'.format(label, filter_cnt))
+        print ('\t{}:\t{}'.format(label, filter_cnt))
 
-    # Create filtered tweets table
+    # Insert new valid tweets and move the mark in one transaction
     logger.info('Inserting valid tweets into filter_tweets table.')
-    curr.execute(filter_query)
+    bounds = {'low': low, 'high': high}
+    with run.timer('insert'):
+        curr.execute(filter_query, bounds)
+    inserted_cnt = curr.rowcount
+    with run.timer('user_stats'):
+        curr.execute(user_stats_query, bounds)
+    run.count('users_updated', curr.rowcount)
+    log_filter.info('{} users updated in user_stats'.format(curr.rowcount))
+    curr.execute(update_high_water_query, bounds)
+    with run.timer('commit'):
+        conn.commit()
+    log_filter.info('{} tweets inserted into filter_tweets'.format(inserted_cnt))
 
-    # Grab count from table
-    curr.execute('SELECT COUNT(*) FROM filter_tweets;')
-    total_filtered_cnt = curr.fetchone()[0]
-    log_filter.info('{} tweets inserted into filter_tweets'.format(total_filtered_cnt))
+    # Rows scanned is the unfiltered total of the batch
+    totals = {(col, cumulative): cnt for col, cumulative, cnt in counts}
+    run.count('rows_scanned', totals[('total', False)])
+    run.count('rows_inserted', inserted_cnt)
+    run.finish(conn)
     
     # Close up
-    conn.close()
+    release(conn, database_url)
+
+
+@click.command()
+@click.argument('database_url', envvar='DATABASE_URL')
+@click.option('--full', is_flag=True,
+              help='Empty filter_tweets and refilter every raw tweet.')
+@click.option('--report', is_flag=True,
+              help='Print the funnel summed over every stored run, then exit.')
+def main(database_url, full, report):
+    """ Inserts new raw_tweets rows passing our filters into filter_tweets.
+
+    Only rows with an id above the stored high-water mark are processed, so a
+    run costs in proportion to the newly imported batch. `--full` resets the
+    mark and rebuilds the table from scratch. `--report` only prints the
+    funnel stored by past runs.
+    """
+    if report:
+        print_filter_report(database_url)
+    else:
+        run_filter(database_url, full=full)
     
 
 if __name__ == '__main__':
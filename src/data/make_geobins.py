@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import click
+import logging
+from dotenv import find_dotenv, load_dotenv
+from io import StringIO
+from time import time
+
+import numpy as np
+
+from src.data.database import checkout, release, stream_rows
+
+
+###############################################################################
+# Vectorized Geohash                                                          #
+###############################################################################
+
+BASE32 = np.array(list('0123456789bcdefghjkmnpqrstuvwxyz'), dtype='S1')
+
+
+def geohash_encode(latitude, longitude, precision=5):
+    """ Geohash cells of many points at once, as int64 codes.
+
+    The code holds the interleaved longitude/latitude bits of the geohash,
+    5 bits per character, so equal codes mean the same cell.
+
+    Args:
+        latitude (numpy.ndarray): Latitudes in degrees.
+        longitude (numpy.ndarray): Longitudes in degrees.
+        precision (int): Geohash length, between 1 and 12.
+
+    Returns:
+        codes (numpy.ndarray): int64 cell code per point.
+    """
+    n_bits = 5 * precision
+    lon_bits = (n_bits + 1) // 2
+    lat_bits = n_bits // 2
+
+    # Quantize each axis onto its share of the bits
+    lat = np.clip((np.asarray(latitude) + 90.0) / 180.0, 0, 1 - 1e-12)
+    lon = np.clip((np.asarray(longitude) + 180.0) / 360.0, 0, 1 - 1e-12)
+    lat_q = (lat * (1 << lat_bits)).astype(np.int64)
+    lon_q = (lon * (1 << lon_bits)).astype(np.int64)
+
+    # Interleave, longitude first, most significant bit first
+    codes = np.zeros(len(lat_q), dtype=np.int64)
+    for bit in range(n_bits):
+        if bit % 2 == 0:
+            source, shift = lon_q, lon_bits - 1 - bit // 2
+        else:
+            source, shift = lat_q, lat_bits - 1 - bit // 2
+        codes |= ((source >> shift) & 1) << (n_bits - 1 - bit)
+    return codes
+
+
+def geohash_strings(codes, precision=5):
+    """ Converts int64 cell codes from `geohash_encode` to geohash strings. """
+    codes = np.asarray(codes, dtype=np.int64)
+    shifts = 5 * np.arange(precision - 1, -1, -1)
+    chars = BASE32[(codes[:, None] >> shifts) & 31]
+    return chars.view('S{}'.format(precision)).ravel().astype(str)
+
+
+###############################################################################
+# Cell x Day Aggregates                                                       #
+###############################################################################
+
+def aggregate(cells, days, polarity):
+    """ Reduces points to per (cell, day) partial sums.
+
+    Args:
+        cells (numpy.ndarray): int64 cell codes.
+        days (numpy.ndarray): int64 days since the epoch.
+        polarity (numpy.ndarray): Sentiment per point, NaN if unscored.
+
+    Returns:
+        keys (numpy.ndarray): (n, 2) array of unique (cell, day) pairs.
+        sums (numpy.ndarray): (n, 4) array of count, scored count, sum and
+            sum of squares of polarity per key.
+    """
+    scored = ~np.isnan(polarity)
+    values = np.where(scored, polarity, 0.0)
+    return reduce_sums(np.column_stack([cells, days]),
+                       np.column_stack([np.ones(len(cells)), scored, values, values ** 2]))
+
+
+def reduce_sums(keys, sums):
+    """ Sums rows of `sums` sharing a key, used to merge partial aggregates. """
+    if len(keys) == 0:
+        return keys.reshape(0, 2), sums.reshape(0, 4)
+    unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    reduced = np.column_stack([np.bincount(inverse, weights=sums[:, j], minlength=len(unique))
+                               for j in range(sums.shape[1])])
+    return unique, reduced
+
+
+def summarize(sums):
+    """ Turns partial sums into count, scored count, mean and variance. """
+    count, n, total, squares = sums.T
+    safe_n = np.maximum(n, 1)
+    mean = total / safe_n
+    variance = np.maximum(squares / safe_n - mean ** 2, 0.0)
+    return count, n, np.where(n > 0, mean, np.nan), np.where(n > 0, variance, np.nan)
+
+
+# The date range lets an index on date narrow the scan to the pending span,
+# the day list then skips the days in between that did not change.
+geo_query = """
+SELECT f.latitude, f.longitude, (f.date::date - DATE '1970-01-01'), s.polarity
+FROM filter_tweets f LEFT JOIN tweet_sentiment s ON s.id = f.id
+WHERE f.date >= %(start)s::date AND f.date < %(end)s::date + INTERVAL '1 day'
+  AND f.date::date = ANY(%(days)s::date[]);
+"""
+
+# Days holding tweets filtered, or scored, since the last refresh. Scores
+# arrive after filtering, so the scored days are refreshed again to pick up
+# their polarity. The upper bounds are read first, so rows arriving during
+# the refresh are left to the next one.
+high_query = """
+SELECT (SELECT COALESCE(MAX(id), %(tweets)s) FROM filter_tweets),
+       (SELECT COALESCE(MAX(id), %(scores)s) FROM tweet_sentiment);
+"""
+pending_days_query = """
+SELECT date::date FROM filter_tweets
+WHERE id > %(tweets_low)s AND id <= %(tweets_high)s AND date IS NOT NULL
+UNION
+SELECT f.date::date FROM tweet_sentiment s JOIN filter_tweets f ON f.id = s.id
+WHERE s.id > %(scores_low)s AND s.id <= %(scores_high)s AND f.date IS NOT NULL
+ORDER BY 1;
+"""
+
+
+def refresh_days(conn, days, precision, itersize=200000):
+    """ Recomputes geo_bins for each of `days`, leaving every other day as is.
+
+    Tweets are streamed in chunks and reduced to partial sums, so memory
+    depends on the number of cells rather than the number of tweets.
+
+    Args:
+        conn (psycopg2.connection): Database connection.
+        days (list[datetime.date]): Days to recompute, in order.
+        precision (int): Geohash length of the cells.
+
+    Returns:
+        n_bins (int): Rows written to geo_bins.
+    """
+    keys = np.zeros((0, 2), dtype=np.int64)
+    sums = np.zeros((0, 4))
+    params = {'start': days[0], 'end': days[-1], 'days': list(days)}
+    for rows in stream_rows(conn, geo_query, params, itersize=itersize, name='geo_bins'):
+        # Unscored tweets have a NULL polarity, which becomes NaN
+        data = np.array(rows, dtype=np.float64)
+        cells = geohash_encode(data[:, 0], data[:, 1], precision)
+        chunk_keys, chunk_sums = aggregate(cells, data[:, 2].astype(np.int64), data[:, 3])
+        keys, sums = reduce_sums(np.concatenate([keys, chunk_keys]),
+                                 np.concatenate([sums, chunk_sums]))
+
+    count, n, mean, variance = summarize(sums)
+    hashes = geohash_strings(keys[:, 0], precision) if len(keys) else []
+    buff = StringIO()
+    for i in range(len(keys)):
+        buff.write('{}\t{}\t{}\t{}\t{:.0f}\t{:.0f}\t{}\t{}\n'.format(
+            precision, keys[i, 0], hashes[i],
+            np.datetime64(int(keys[i, 1]), 'D'), count[i], n[i],
+            '\\N' if np.isnan(mean[i]) else mean[i],
+            '\\N' if np.isnan(variance[i]) else variance[i]))
+    buff.seek(0)
+
+    curr = conn.cursor()
+    curr.execute('DELETE FROM geo_bins WHERE precision = %s AND day = ANY(%s::date[]);',
+                 (precision, list(days)))
+    curr.copy_expert('COPY geo_bins (precision, cell, geohash, day, count, n_scored, '
+                     'mean_polarity, var_polarity) FROM STDIN;', buff)
+    curr.close()
+    return len(keys)
+
+
+def get_high_water(curr, stage):
+    """ Returns the high-water of `stage` in filter_state, locked, or 0. """
+    curr.execute('SELECT high_water FROM filter_state WHERE stage = %s FOR UPDATE;',
+                 (stage,))
+    row = curr.fetchone()
+    return row[0] if row is not None else 0
+
+
+def set_high_water(curr, stage, high):
+    curr.execute('INSERT INTO filter_state (stage, high_water) VALUES (%s, %s) '
+                 'ON CONFLICT (stage) DO UPDATE SET high_water = EXCLUDED.high_water, '
+                 'updated_at = now();', (stage, high))
+
+
+def pending_days(curr, stages):
+    """ Returns the days with new tweets or scores and the new high-waters.
+
+    Args:
+        curr (psycopg2.cursor): Cursor inside the refresh transaction.
+        stages (dict): filter_state stage name of the tweets and the scores.
+
+    Returns:
+        days (list[datetime.date]): Pending days in order, empty if none.
+        highs (dict): Stage name -> high-water to store after the refresh.
+    """
+    lows = {source: get_high_water(curr, stage) for source, stage in stages.items()}
+    curr.execute(high_query, lows)
+    tweets_high, scores_high = curr.fetchone()
+    curr.execute(pending_days_query, {
+        'tweets_low': lows['tweets'], 'tweets_high': tweets_high,
+        'scores_low': lows['scores'], 'scores_high': scores_high})
+    days = [day for day, in curr.fetchall()]
+    return days, {stages['tweets']: tweets_high, stages['scores']: scores_high}
+
+
+@click.command()
+@click.argument('database_url', envvar='DATABASE_URL')
+@click.option('--precision', default=5, type=click.IntRange(1, 12),
+              help='Geohash length of the cells.')
+@click.option('--start', default=None, help='First day to refresh (YYYY-MM-DD).')
+@click.option('--end', default=None, help='Last day to refresh (YYYY-MM-DD).')
+def main(database_url, precision, start, end):
+    """ Refreshes the geohash cell x day sentiment aggregates in geo_bins.
+
+    Without --start/--end only the days holding tweets filtered or scored
+    since the last refresh are recomputed. With them every day of the range
+    is, a missing bound defaulting to the first or last pending day.
+    """
+    logger = logging.getLogger(__name__)
+    t0 = time()
+    conn = checkout(database_url)
+    curr = conn.cursor()
+    stages = {'tweets': 'geo_bins_{}'.format(precision),
+              'scores': 'geo_bins_{}_scores'.format(precision)}
+    try:
+        days, highs = pending_days(curr, stages)
+        incremental = start is None and end is None
+        if not incremental:
+            curr.execute("SELECT generate_series(%s::date, %s::date, INTERVAL '1 day')::date;",
+                         (start or (days[0] if days else None),
+                          end or (days[-1] if days else None)))
+            days = [day for day, in curr.fetchall()]
+        if not days:
+            logger.info('no new tweets to bin')
+            return
+
+        n_bins = refresh_days(conn, days, precision)
+        if incremental:
+            for stage, high in highs.items():
+                set_high_water(curr, stage, high)
+        conn.commit()
+        logger.info('refreshed {} bins for {} days from {} to {} in {:.2f} secs'.format(
+            n_bins, len(days), days[0], days[-1], time() - t0))
+    finally:
+        release(conn, database_url)
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO,
+                    format=log_fmt, datefmt='%H:%M:%S',
+                    filename='reports/pipeline.geobins.log', filemode='a')
+
+    load_dotenv(find_dotenv())
+
+    main()
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import click
+import logging
+from dotenv import find_dotenv, load_dotenv
+from io import StringIO
+from time import time
+
+import numpy as np
+
+from src.data.database import checkout, release, stream_rows
+
+
+###############################################################################
+# Boundary Polygons                                                           #
+###############################################################################
+
+def load_geojson(path, code_property='GEOID'):
+    """ Loads (Multi)Polygon features from a GeoJSON file.
+
+    Args:
+        path (str): GeoJSON FeatureCollection, e.g. Census cartographic boundaries.
+        code_property (str): Feature property holding the region code.
+
+    Returns:
+        codes (list[str]): Region code per region.
+        rings (list[list[numpy.ndarray]]): Per region, its rings as (n, 2)
+            lon/lat arrays. Holes are rings too, the even-odd rule skips them.
+    """
+    with open(path) as f:
+        features = json.load(f)['features']
+
+    codes, rings = [], []
+    for feature in features:
+        geometry = feature['geometry']
+        if geometry is None:
+            continue
+        polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' \
+            else [geometry['coordinates']]
+        codes.append(str(feature['properties'][code_property]))
+        rings.append([np.asarray(ring, dtype=np.float64)[:, :2]
+                      for polygon in polygons for ring in polygon])
+    return codes, rings
+
+
+class RegionIndex(object):
+    """ Uniform grid index over region polygons for batch point lookups.
+
+    Each region is registered in every grid cell its bounding box touches.
+    Points are sorted by grid cell once per batch, so a region only tests
+    the points in its own cells, first against its bounding box and then
+    with a ray-casting test vectorized over points.
+
+    Args:
+        codes (list[str]): Region code per region.
+        rings (list[list[numpy.ndarray]]): Region rings from `load_geojson`.
+        cell_size (float): Grid cell size in degrees.
+    """
+    def __init__(self, codes, rings, cell_size=0.5):
+        self.codes = np.array(codes + [''], dtype=object)
+        self.cell_size = cell_size
+        self.n_rows = int(np.ceil(180.0 / cell_size)) + 1
+        self.rings = rings
+        self.bounds = np.zeros((len(rings), 4))
+        for r, region in enumerate(rings):
+            points = np.vstack(region)
+            self.bounds[r, :2] = points.min(axis=0)
+            self.bounds[r, 2:] = points.max(axis=0)
+
+        # Region -> grid cells covered by its bounding box
+        self.cells = []
+        for x0, y0, x1, y1 in self.bounds:
+            cx = np.arange(self.cell_x(x0), self.cell_x(x1) + 1)
+            cy = np.arange(self.cell_y(y0), self.cell_y(y1) + 1)
+            self.cells.append((cx[:, None] * self.n_rows + cy[None, :]).ravel())
+
+    def cell_x(self, lon):
+        return np.floor((np.asarray(lon) + 180.0) / self.cell_size).astype(np.int64)
+
+    def cell_y(self, lat):
+        return np.floor((np.asarray(lat) + 90.0) / self.cell_size).astype(np.int64)
+
+    def cell(self, lon, lat):
+        return self.cell_x(lon) * self.n_rows + self.cell_y(lat)
+
+    def assign(self, lon, lat):
+        """ Returns the region code of each point, '' outside every region. """
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        region = np.full(len(lon), len(self.codes) - 1, dtype=np.int64)
+
+        point_cells = self.cell(lon, lat)
+        order = np.argsort(point_cells, kind='mergesort')
+        sorted_cells = point_cells[order]
+
+        for r, cells in enumerate(self.cells):
+            # Points in the region's grid cells
+            lo = np.searchsorted(sorted_cells, cells, side='left')
+            hi = np.searchsorted(sorted_cells, cells, side='right')
+            if not (hi > lo).any():
+                continue
+            candidates = np.concatenate([order[a:b] for a, b in zip(lo, hi) if b > a])
+
+            # Bounding box prefilter, then the exact test
+            x0, y0, x1, y1 = self.bounds[r]
+            x, y = lon[candidates], lat[candidates]
+            in_box = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+            candidates, x, y = candidates[in_box], x[in_box], y[in_box]
+            inside = np.zeros(len(candidates), dtype=bool)
+            for ring in self.rings[r]:
+                inside ^= points_in_ring(x, y, ring)
+            region[candidates[inside]] = r
+        return self.codes[region]
+
+
+def points_in_ring(x, y, ring):
+    """ Even-odd ray casting of many points against one ring. """
+    inside = np.zeros(len(x), dtype=bool)
+    if len(x) == 0:
+        return inside
+    x1, y1 = ring[:-1, 0], ring[:-1, 1]
+    x2, y2 = ring[1:, 0], ring[1:, 1]
+    # Blocks of edges keep the (points x edges) temporaries bounded
+    step = max(1, 2 ** 22 // len(x))
+    for s in range(0, len(x1), step):
+        ex1, ey1 = x1[s:s + step], y1[s:s + step]
+        ex2, ey2 = x2[s:s + step], y2[s:s + step]
+        crosses = (ey1 > y[:, None]) != (ey2 > y[:, None])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = ex1 + (y[:, None] - ey1) * (ex2 - ex1) / (ey2 - ey1)
+        inside ^= np.logical_xor.reduce(crosses & (x[:, None] < x_cross), axis=1)
+    return inside
+
+
+###############################################################################
+# Region Assignment                                                           #
+###############################################################################
+
+def assign_regions(conn, indexes, itersize=200000):
+    """ Assigns regions to filter_tweets rows that have none yet.
+
+    Assignments are COPYed into a temporary table and applied with a single
+    UPDATE. Points outside every region get '' so they are not retried.
+
+    Args:
+        conn (psycopg2.connection): Database connection.
+        indexes (dict): Column name ('state'/'county') -> RegionIndex.
+
+    Returns:
+        n_rows (int): Tweets assigned.
+    """
+    columns = sorted(indexes)
+    curr = conn.cursor()
+    curr.execute('CREATE TEMPORARY TABLE tweet_regions (id BIGINT, {}) ON COMMIT DROP;'.format(
+        ', '.join('"{}" TEXT'.format(c) for c in columns)))
+
+    n_rows = 0
+    query = 'SELECT id, longitude, latitude FROM filter_tweets WHERE {};'.format(
+        ' OR '.join('"{}" IS NULL'.format(c) for c in columns))
+    for rows in stream_rows(conn, query, itersize=itersize, name='tweet_regions'):
+        data = np.array(rows, dtype=np.float64)
+        assigned = [indexes[c].assign(data[:, 1], data[:, 2]) for c in columns]
+        buff = StringIO()
+        for i, row in enumerate(rows):
+            buff.write('\t'.join([str(row[0])] + [a[i] for a in assigned]) + '\n')
+        buff.seek(0)
+        curr.copy_expert('COPY tweet_regions FROM STDIN;', buff)
+        n_rows += len(rows)
+
+    curr.execute('UPDATE filter_tweets f SET {} FROM tweet_regions t WHERE f.id = t.id;'.format(
+        ', '.join('"{0}" = t."{0}"'.format(c) for c in columns)))
+    curr.close()
+    return n_rows
+
+
+@click.command()
+@click.argument('database_url', envvar='DATABASE_URL')
+@click.option('--states', 'states_file', default=os.path.join('data', 'external', 'states.geojson'),
+              type=click.Path(exists=True), help='GeoJSON of state boundaries.')
+@click.option('--counties', 'counties_file', default=os.path.join('data', 'external', 'counties.geojson'),
+              type=click.Path(exists=True), help='GeoJSON of county boundaries.')
+@click.option('--code-property', default='GEOID', help='Feature property with the region code.')
+@click.option('--cell-size', default=0.5, type=float, help='Grid index cell size in degrees.')
+def main(database_url, states_file, counties_file, code_property, cell_size):
+    """ Stores the state and county of every unassigned filtered tweet. """
+    logger = logging.getLogger(__name__)
+    start = time()
+    indexes = {
+        'state': RegionIndex(*load_geojson(states_file, code_property), cell_size=cell_size),
+        'county': RegionIndex(*load_geojson(counties_file, code_property), cell_size=cell_size),
+    }
+    logger.info('indexed boundaries in {:.2f} secs'.format(time() - start))
+
+    conn = checkout(database_url)
+    try:
+        n_rows = assign_regions(conn, indexes)
+        # Versions the assignments for cached results reading state/county
+        curr = conn.cursor()
+        curr.execute("INSERT INTO filter_state (stage, high_water) "
+                     "SELECT 'regions', COALESCE(MAX(id), 0) FROM filter_tweets "
+                     'ON CONFLICT (stage) DO UPDATE SET high_water = EXCLUDED.high_water, '
+                     'updated_at = now();')
+        curr.close()
+        conn.commit()
+    finally:
+        release(conn, database_url)
+    logger.info('assigned regions to {} tweets in {:.2f} secs'.format(n_rows, time() - start))
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO,
+                    format=log_fmt, datefmt='%H:%M:%S',
+                    filename='reports/pipeline.regions.log', filemode='a')
+
+    load_dotenv(find_dotenv())
+
+    main()
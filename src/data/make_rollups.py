@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import click
+import logging
+from dotenv import find_dotenv, load_dotenv
+from time import time
+
+from src.data.database import checkout, release
+
+
+###############################################################################
+# Rollup Queries                                                              #
+###############################################################################
+
+# Rollups keep sums rather than means so any grouping can be re-aggregated
+# exactly, e.g. all languages of a day from its per-language rows. The date
+# range narrows the scan, the day list skips the days in between that did
+# not change.
+delete_rollups_query = """
+DELETE FROM sentiment_rollups
+WHERE bucket >= %(start)s::date AND bucket < %(end)s::date + INTERVAL '1 day'
+  AND bucket::date = ANY(%(days)s::date[]);
+"""
+
+hourly_rollup_query = """
+INSERT INTO sentiment_rollups
+SELECT
+    'hour', date_trunc('hour', f.date), COALESCE(f.language, ''), COALESCE(f.state, ''),
+    COUNT(*), COUNT(s.polarity), COALESCE(SUM(s.polarity), 0), COALESCE(SUM(s.polarity ^ 2), 0)
+FROM filter_tweets f LEFT JOIN tweet_sentiment s ON s.id = f.id
+WHERE f.date >= %(start)s::date AND f.date < %(end)s::date + INTERVAL '1 day'
+  AND f.date::date = ANY(%(days)s::date[])
+GROUP BY 2, 3, 4;
+"""
+
+daily_rollup_query = """
+INSERT INTO sentiment_rollups
+SELECT
+    'day', date_trunc('day', bucket), language, state,
+    SUM(count), SUM(n_scored), SUM(sum_polarity), SUM(sum_sq_polarity)
+FROM sentiment_rollups
+WHERE grain = 'hour' AND bucket >= %(start)s::date AND bucket < %(end)s::date + INTERVAL '1 day'
+  AND bucket::date = ANY(%(days)s::date[])
+GROUP BY 2, 3, 4;
+"""
+
+# Days holding tweets filtered, scored or assigned a region since the last
+# refresh. Scores and regions arrive after filtering, so those days are
+# rebuilt again to pick up n_scored and state. A regions run assigns every
+# tweet up to the 'regions' high-water, so the ids between the high-water
+# seen by the last refresh and the current one are the newly assigned ones.
+# The upper bounds are read first, so rows arriving during the refresh are
+# left to the next one.
+high_query = """
+SELECT (SELECT COALESCE(MAX(id), %(tweets)s) FROM filter_tweets),
+       (SELECT COALESCE(MAX(id), %(scores)s) FROM tweet_sentiment),
+       COALESCE((SELECT high_water FROM filter_state WHERE stage = 'regions'), %(regions)s);
+"""
+pending_days_query = """
+SELECT date::date FROM filter_tweets
+WHERE date IS NOT NULL AND (id > %(tweets_low)s AND id <= %(tweets_high)s
+                            OR id > %(regions_low)s AND id <= %(regions_high)s)
+UNION
+SELECT f.date::date FROM tweet_sentiment s JOIN filter_tweets f ON f.id = s.id
+WHERE s.id > %(scores_low)s AND s.id <= %(scores_high)s AND f.date IS NOT NULL
+ORDER BY 1;
+"""
+
+# filter_state stage of each upstream source's high-water seen by the rollups
+stages = {'tweets': 'rollups', 'scores': 'rollups_scores', 'regions': 'rollups_regions'}
+
+
+def refresh_rollups(curr, days):
+    """ Rebuilds hourly and daily rollups for each of `days`, in order. """
+    bounds = {'start': days[0], 'end': days[-1], 'days': list(days)}
+    curr.execute(delete_rollups_query, bounds)
+    curr.execute(hourly_rollup_query, bounds)
+    curr.execute(daily_rollup_query, bounds)
+
+
+def pending_days(curr):
+    """ Returns the days with new tweets, scores or regions and the new high-waters.
+
+    Args:
+        curr (psycopg2.cursor): Cursor inside the refresh transaction.
+
+    Returns:
+        days (list[datetime.date]): Pending days in order, empty if none.
+        highs (dict): Stage name -> high-water to store after the refresh.
+    """
+    lows = {}
+    for source, stage in stages.items():
+        curr.execute('SELECT high_water FROM filter_state WHERE stage = %s FOR UPDATE;',
+                     (stage,))
+        row = curr.fetchone()
+        lows[source] = row[0] if row is not None else 0
+    curr.execute(high_query, lows)
+    highs = dict(zip(('tweets', 'scores', 'regions'), curr.fetchone()))
+    bounds = {}
+    for source in stages:
+        bounds[source + '_low'] = lows[source]
+        bounds[source + '_high'] = highs[source]
+    curr.execute(pending_days_query, bounds)
+    days = [day for day, in curr.fetchall()]
+    return days, {stages[source]: high for source, high in highs.items()}
+
+
+@click.command()
+@click.argument('database_url', envvar='DATABASE_URL')
+@click.option('--start', default=None, help='First day to refresh (YYYY-MM-DD).')
+@click.option('--end', default=None, help='Last day to refresh (YYYY-MM-DD).')
+def main(database_url, start, end):
+    """ Refreshes hourly and daily sentiment rollups in sentiment_rollups.
+
+    Without --start/--end only the days holding tweets filtered, scored or
+    assigned a region since the last refresh are rebuilt. With them every day
+    of the range is, a missing bound defaulting to the first or last pending
+    day.
+    """
+    logger = logging.getLogger(__name__)
+    t0 = time()
+    conn = checkout(database_url)
+    curr = conn.cursor()
+    try:
+        days, highs = pending_days(curr)
+        incremental = start is None and end is None
+        if not incremental:
+            curr.execute("SELECT generate_series(%s::date, %s::date, INTERVAL '1 day')::date;",
+                         (start or (days[0] if days else None),
+                          end or (days[-1] if days else None)))
+            days = [day for day, in curr.fetchall()]
+        if not days:
+            logger.info('no new tweets to roll up')
+            return
+
+        refresh_rollups(curr, days)
+        if incremental:
+            for stage, high in highs.items():
+                curr.execute('INSERT INTO filter_state (stage, high_water) VALUES (%s, %s) '
+                             'ON CONFLICT (stage) DO UPDATE SET high_water = EXCLUDED.high_water, '
+                             'updated_at = now();', (stage, high))
+        conn.commit()
+        logger.info('refreshed rollups for {} days from {} to {} in {:.2f} secs'.format(
+            len(days), days[0], days[-1], time() - t0))
+    finally:
+        release(conn, database_url)
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO,
+                    format=log_fmt, datefmt='%H:%M:%S',
+                    filename='reports/pipeline.rollups.log', filemode='a')
+
+    load_dotenv(find_dotenv())
+
+    main()
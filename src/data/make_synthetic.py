@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import os
+import click
+import logging
+
+import numpy as np
+import pandas as pd
+
+
+###############################################################################
+# Synthetic Tweets                                                            #
+###############################################################################
+
+cols = ['tweetID', 'date', 'message', 'username', 'userID', 'language',
+        'longitude', 'latitude', 'retweet']
+
+words = ['immigration', 'border', 'wall', 'refugee', 'ban', 'travel', 'visa',
+         'trump', 'muslim', 'protest', 'airport', 'great', 'terrible', 'love',
+         'hate', 'sad', 'happy', 'unfair', 'safe', 'country', 'america',
+         'people', 'families', 'law', 'court', 'judge', 'order', 'today']
+
+# Language tags as the scraper records them, roughly as mixed as the stream
+# tracked around the travel ban; regional English tags pass the 'en' filter.
+languages = ['en', 'en-gb', 'es', 'pt', 'fr', 'ar', 'ja', 'de', 'tr', 'in', 'und']
+language_p = [0.58, 0.03, 0.1, 0.04, 0.04, 0.04, 0.03, 0.02, 0.02, 0.02, 0.08]
+
+
+def make_tweets(n_rows, seed=0, dup_rate=0.02, null_rate=0.005):
+    """ Function that returns a DataFrame of fake tweets shaped like our scrapes.
+
+        Args:
+            n_rows (int): Number of tweets to generate.
+            seed (int): Seed for the random number generator.
+            dup_rate (float): Fraction of rows repeating an earlier row of the
+                same file, tweetID included, as overlapping scrape pages do.
+            null_rate (float): Fraction of missing messages, dates and languages.
+
+        Returns:
+            df (pandas.DataFrame): Tweets with the columns `import_file` expects.
+    """
+    rng = np.random.RandomState(seed)
+
+    # Spread tweets over the study window
+    start = np.datetime64('2016-12-30T04:00:00')
+    seconds = rng.randint(0, 56 * 24 * 3600, n_rows).astype('timedelta64[s]')
+
+    # Short messages drawn from a small vocabulary
+    lengths = rng.randint(3, 15, n_rows)
+    tokens = rng.choice(words, lengths.sum())
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    messages = [' '.join(tokens[bounds[i]:bounds[i + 1]]) for i in range(n_rows)]
+
+    # Sprinkle in mentions, hashtags and links
+    extras = [(0.2, '@user{}'), (0.15, '#{}'), (0.1, 'https://t.co/{}')]
+    for p, fmt in extras:
+        picks = np.flatnonzero(rng.rand(n_rows) < p)
+        values = rng.choice(words, len(picks))
+        for i, value in zip(picks, values):
+            messages[i] = '{} {}'.format(messages[i], fmt.format(value))
+
+    # A few heavy users, many light ones
+    users = rng.zipf(1.5, n_rows) % 100000
+
+    # Roughly 2% of scraped tweets are geotagged
+    geotagged = rng.rand(n_rows) < 0.02
+
+    df = pd.DataFrame({
+        'tweetID': np.arange(n_rows, dtype=np.int64) + seed * n_rows + 800000000000000000,
+        'date': start + seconds,
+        'message': messages,
+        'username': ['user{}'.format(u) for u in users],
+        'userID': users.astype(np.int64),
+        'language': rng.choice(languages, n_rows, p=language_p),
+        'longitude': np.where(geotagged, rng.uniform(-125, -67, n_rows), np.nan),
+        'latitude': np.where(geotagged, rng.uniform(25, 49, n_rows), np.nan),
+        'retweet': np.where(rng.rand(n_rows) < 0.3, 'RT', None),
+    })
+
+    # Fields the scraper failed to fill
+    for col in ['message', 'date', 'language']:
+        df.loc[rng.rand(n_rows) < null_rate, col] = None
+
+    # Repeated rows point back at a random earlier row
+    dups = np.flatnonzero(rng.rand(n_rows) < dup_rate)
+    dups = dups[dups > 0]
+    df.iloc[dups] = df.iloc[(rng.rand(len(dups)) * dups).astype(np.int64)].values
+    return df[cols]
+
+
+def write_csvs(output_dir, n_files, rows_per_file, seed=0, overlap=0.0, **options):
+    """ Function that writes synthetic scrapes as numbered CSVs.
+
+        Args:
+            output_dir (str): Directory the CSVs are written to.
+            n_files (int): Number of CSV files.
+            rows_per_file (int): Tweets per file.
+            seed (int): Seed of the first file, incremented per file.
+            overlap (float): Fraction of each file's rows repeating the last
+                rows of the previous file, like consecutive scrapes do.
+            options (dict): Passed on to `make_tweets`.
+
+        Returns:
+            paths (list[str]): Paths of the written files.
+    """
+    paths = []
+    previous = None
+    n_overlap = int(rows_per_file * overlap)
+    for i in range(n_files):
+        path = os.path.join(output_dir, 'synthetic_{:04d}.csv'.format(i))
+        df = make_tweets(rows_per_file, seed=seed + i, **options)
+        if previous is not None and n_overlap:
+            df = pd.concat([previous.iloc[-n_overlap:], df.iloc[n_overlap:]])
+        df.to_csv(path, index=False)
+        paths.append(path)
+        previous = df
+    return paths
+
+
+@click.command()
+@click.argument('output_dir', type=click.Path(exists=True, file_okay=False))
+@click.option('--files', default=10, type=click.IntRange(min=1),
+              help='Number of CSV files to write.')
+@click.option('--rows', default=100000, type=click.IntRange(min=1),
+              help='Tweets per file.')
+@click.option('--seed', default=0, type=int, help='Random seed.')
+@click.option('--dup-rate', default=0.02, type=float,
+              help='Fraction of rows repeated within a file.')
+@click.option('--null-rate', default=0.005, type=float,
+              help='Fraction of missing messages, dates and languages.')
+@click.option('--overlap', default=0.05, type=float,
+              help='Fraction of each file repeated from the previous file.')
+def main(output_dir, files, rows, seed, dup_rate, null_rate, overlap):
+    """ Writes synthetic tweet CSVs for benchmarking the pipeline. """
+    rates = [('--dup-rate', dup_rate), ('--null-rate', null_rate), ('--overlap', overlap)]
+    for name, rate in rates:
+        if not 0 <= rate <= 1:
+            raise click.BadParameter('{} must be between 0 and 1'.format(name))
+    logger = logging.getLogger(__name__)
+    paths = write_csvs(output_dir, files, rows, seed=seed, overlap=overlap,
+                       dup_rate=dup_rate, null_rate=null_rate)
+    logger.info('wrote {} synthetic csvs to {}'.format(len(paths), output_dir))
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt, datefmt='%H:%M:%S')
+
+    main()
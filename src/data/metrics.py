@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import uuid
+import click
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from dotenv import find_dotenv, load_dotenv
+from time import time
+
+import psycopg2 as pg
+
+
+###############################################################################
+# Timers & Counters                                                           #
+###############################################################################
+
+metrics_path = os.path.join('reports', 'metrics.jsonl')
+
+
+class Metrics(object):
+    """ Named counters and accumulated timers, mergeable across processes.
+
+    Counters hold quantities such as `rows_read`, `rows_copied` or `bytes`,
+    timers hold seconds spent in a kind of work such as `parse` or `db`.
+    `as_dict`/`merge` move them between pool workers and the parent.
+    """
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(float)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    @contextmanager
+    def timer(self, name):
+        """ Adds the time spent in the `with` block to timer `name`. """
+        start = time()
+        try:
+            yield
+        finally:
+            self.timers[name] += time() - start
+
+    def as_dict(self):
+        return {'counters': dict(self.counters), 'timers': dict(self.timers)}
+
+    def merge(self, other):
+        """ Adds the counters and timers of another Metrics or its `as_dict`. """
+        other = other.as_dict() if isinstance(other, Metrics) else other
+        for name, n in other['counters'].items():
+            self.counters[name] += n
+        for name, seconds in other['timers'].items():
+            self.timers[name] += seconds
+
+
+class Run(Metrics):
+    """ Metrics of one run of a pipeline stage.
+
+    Events are appended to `path` as JSON lines tagged with the stage and run
+    id, and `finish` writes the run summary to the pipeline_runs table, so
+    throughput can be compared across runs with `python -m src.data.metrics`.
+
+    Args:
+        stage (str): Stage name, e.g. 'import' or 'filter'.
+        path (str): JSON lines file, None to skip writing events.
+    """
+    def __init__(self, stage, path=metrics_path):
+        super(Run, self).__init__()
+        self.stage = stage
+        self.path = path
+        self.run_id = uuid.uuid4().hex
+        self.started_at = datetime.now()
+        self.start = time()
+
+    def emit(self, event, **fields):
+        """ Appends one JSON line for `event` with the given fields. """
+        if self.path is None:
+            return
+        record = dict(fields, ts=datetime.now().isoformat(), stage=self.stage,
+                      run_id=self.run_id, event=event)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+    def summary(self):
+        """ Returns elapsed seconds, counters, timers and per-second counter rates. """
+        elapsed = time() - self.start
+        return dict(self.as_dict(), elapsed=elapsed, rates={
+            name: n / elapsed for name, n in self.counters.items() if elapsed > 0})
+
+    def finish(self, conn=None):
+        """ Emits the run summary, storing it in pipeline_runs when `conn` is given.
+
+        The summary is committed on its own, after the stage's work, and a
+        failure to store it is logged rather than raised.
+        """
+        summary = self.summary()
+        self.emit('summary', **summary)
+        if conn is None:
+            return summary
+        try:
+            curr = conn.cursor()
+            curr.execute('INSERT INTO pipeline_runs (run_id, stage, started_at, elapsed, '
+                         'counters, timers) VALUES (%s, %s, %s, %s, %s, %s);',
+                         (self.run_id, self.stage, self.started_at, summary['elapsed'],
+                          json.dumps(summary['counters']), json.dumps(summary['timers'])))
+            conn.commit()
+            curr.close()
+        except Exception as error:
+            conn.rollback()
+            logging.getLogger(__name__).warning('could not store run summary: {}'.format(error))
+        return summary
+
+
+###############################################################################
+# Throughput Report                                                           #
+###############################################################################
+
+runs_query = """
+SELECT run_id, started_at, elapsed, counters, timers FROM (
+    SELECT *, ROW_NUMBER() OVER (ORDER BY started_at DESC) AS n
+    FROM pipeline_runs WHERE stage = %s
+) r WHERE n <= %s ORDER BY started_at;
+"""
+
+
+def similar_size(n, latest, size_ratio):
+    """ True if count `n` is within a factor `size_ratio` of the latest count. """
+    return latest / size_ratio <= n <= latest * size_ratio
+
+
+def find_regressions(runs, tolerance=0.2, size_ratio=2.0):
+    """ Compares the latest run's counter rates with the median of earlier runs.
+
+    Rates include fixed costs such as connecting and index builds, so a small
+    run is slower per row than a large one. Each counter is only compared with
+    earlier runs whose count is within `size_ratio` of the latest, and runs
+    without a positive elapsed time are skipped.
+
+    Args:
+        runs (list[tuple]): (run_id, started_at, elapsed, counters, timers),
+            oldest first.
+        tolerance (float): Allowed fractional drop below the median rate.
+        size_ratio (float): Largest factor between the counts compared.
+
+    Returns:
+        regressions (list[tuple]): (counter, latest rate, median rate) of every
+            counter whose latest rate dropped by more than `tolerance`.
+    """
+    runs = [run for run in runs if run[2] is not None and run[2] > 0]
+    if len(runs) < 2:
+        return []
+    _, _, elapsed, counters, _ = runs[-1]
+    regressions = []
+    for name, n in sorted(counters.items()):
+        history = sorted(c[name] / e for _, _, e, c, _ in runs[:-1]
+                         if name in c and similar_size(c[name], n, size_ratio))
+        if not history:
+            continue
+        median = history[len(history) // 2]
+        if n / elapsed < (1 - tolerance) * median:
+            regressions.append((name, n / elapsed, median))
+    return regressions
+
+
+def format_rates(elapsed, counters):
+    """ Formats counter rates, or raw counts for a run without elapsed time. """
+    if elapsed is None or elapsed <= 0:
+        return ', '.join('{} {}'.format(k, v) for k, v in sorted(counters.items()))
+    return ', '.join('{} {:.0f}/s'.format(k, v / elapsed) for k, v in sorted(counters.items()))
+
+
+@click.command()
+@click.argument('stages', nargs=-1, required=True)
+@click.option('--db-url', type=str, envvar='DATABASE_URL')
+@click.option('--runs', default=10, type=click.IntRange(min=2),
+              help='Number of recent runs compared.')
+@click.option('--tolerance', default=0.2, type=float,
+              help='Allowed drop of a rate below its median.')
+@click.option('--size-ratio', default=2.0, type=float,
+              help='Only compare runs whose counts are within this factor.')
+def main(stages, db_url, runs, tolerance, size_ratio):
+    """ Prints recent run throughput of each stage and flags regressions. """
+    if not 0 <= tolerance <= 1:
+        raise click.BadParameter('--tolerance must be between 0 and 1')
+    if size_ratio < 1:
+        raise click.BadParameter('--size-ratio must be at least 1')
+    conn = pg.connect(db_url)
+    curr = conn.cursor()
+    failed = False
+    try:
+        for stage in stages:
+            curr.execute(runs_query, (stage, runs))
+            rows = curr.fetchall()
+            click.echo(click.style(stage, bold=True))
+            for run_id, started_at, elapsed, counters, timers in rows:
+                rates = format_rates(elapsed, counters)
+                split = ', '.join('{} {:.1f}s'.format(k, v) for k, v in sorted(timers.items()))
+                click.echo('\t{:%Y-%m-%d %H:%M} {:8.2f}s  {}  [{}]'.format(
+                    started_at, elapsed or 0, rates, split))
+            for name, latest, median in find_regressions(rows, tolerance, size_ratio):
+                failed = True
+                click.echo(click.style('\tregression: {} {:.0f}/s vs. median {:.0f}/s'.format(
+                    name, latest, median), fg='red'))
+    finally:
+        conn.close()
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    load_dotenv(find_dotenv())
+
+    main()
@@ -0,0 +1,3 @@
+INSERT INTO "raw_tweets" SELECT * FROM "raw_tweets_heap";
+SELECT setval(pg_get_serial_sequence('raw_tweets', 'id'), COALESCE(MAX("id"), 1)) FROM "raw_tweets";
+DROP TABLE "raw_tweets_heap";
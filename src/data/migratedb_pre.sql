@@ -0,0 +1,3 @@
+ALTER TABLE "filter_tweets" DROP CONSTRAINT IF EXISTS "filter_fk0";
+ALTER TABLE "raw_tweets" RENAME TO "raw_tweets_heap";
+ALTER INDEX "raw_tweets_pk" RENAME TO "raw_tweets_heap_pk";
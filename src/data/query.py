@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+import struct
+
+import numpy as np
+import pandas as pd
+
+from src.data.database import checkout, release
+from src.data.result_cache import cached
+from src.data.schema import apply_schema
+
+
+###############################################################################
+# Binary COPY Decoder                                                         #
+###############################################################################
+
+# Wire format of each PostgreSQL type in binary COPY: (numpy dtype of the big
+# endian value, struct code), text columns are variable length UTF-8.
+wire_types = {
+    'int4': ('>i4', 'i'),
+    'int8': ('>i8', 'q'),
+    'float8': ('>f8', 'd'),
+    'bool': ('?', '?'),
+    'timestamp': ('>i8', 'q'),
+    'text': (None, None),
+}
+
+copy_signature = b'PGCOPY\n\xff\r\n\x00'
+
+# Binary timestamps count microseconds from 2000-01-01
+pg_epoch_us = 946684800 * 10 ** 6
+nat = np.iinfo(np.int64).min
+
+
+class BinaryCopyReader(object):
+    """ File-like sink for `COPY ... TO STDOUT (FORMAT BINARY)` building columns.
+
+        psycopg2 writes the COPY data into it, and every `chunk_bytes` the
+        complete rows are decoded into typed NumPy arrays, so only one chunk of
+        raw bytes is held besides the result. Runs of rows without NULLs in a
+        result of fixed width types have the same layout, and are decoded at
+        once through a structured dtype; other rows are decoded one by one.
+
+        Args:
+            types (list[str]): `wire_types` key of each result column.
+            chunk_bytes (int): Raw bytes buffered before decoding.
+    """
+    def __init__(self, types, chunk_bytes=1 << 22):
+        self.types = types
+        self.chunk_bytes = chunk_bytes
+        self.buffer = bytearray()
+        self.header = False
+        self.done = False
+        self.chunks = [[] for _ in types]
+        self.pending = [[] for _ in types]
+
+        self.fixed = all(t != 'text' for t in types)
+        fields = [('n', '>i2')]
+        for i, t in enumerate(types):
+            if self.fixed:
+                fields += [('l{}'.format(i), '>i4'), ('v{}'.format(i), wire_types[t][0])]
+        self.row_dtype = np.dtype(fields)
+        self.sizes = [np.dtype(wire_types[t][0]).itemsize if self.fixed else None for t in types]
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_bytes:
+            self._decode()
+
+    def close(self):
+        """ Decodes the rest of the data, which must end with the trailer. """
+        self._decode()
+        if not self.done:
+            raise IOError('binary COPY ended without its trailer')
+
+    def columns(self):
+        """ Returns one array per result column. """
+        self._flush_pending()
+        return [np.concatenate(c) if c else self._convert([], t)
+                for c, t in zip(self.chunks, self.types)]
+
+    def _decode(self):
+        pos = 0
+        if not self.header:
+            if len(self.buffer) < 19:
+                return
+            if bytes(self.buffer[:11]) != copy_signature:
+                raise IOError('not a binary COPY stream')
+            pos = 19 + struct.unpack_from('>i', self.buffer, 15)[0]
+            self.header = True
+        while not self.done:
+            rows = self._decode_fixed(pos) if self.fixed else 0
+            if rows:
+                pos += rows * self.row_dtype.itemsize
+                continue
+            # Text or a NULL vary the row layout, decode a batch one by one
+            for _ in range(256):
+                end = self._decode_row(pos)
+                if end is None or self.done:
+                    break
+                pos = end
+            if end is None:
+                break
+            pos = end
+        del self.buffer[:pos]
+
+    def _decode_fixed(self, pos, max_rows=1 << 16):
+        """ Decodes the leading rows at `pos` that have no NULL, returns their number. """
+        n = min((len(self.buffer) - pos) // self.row_dtype.itemsize, max_rows)
+        if n == 0:
+            return 0
+        rows = np.frombuffer(self.buffer, self.row_dtype, count=n, offset=pos)
+        ok = rows['n'] == len(self.types)
+        for i, size in enumerate(self.sizes):
+            ok &= rows['l{}'.format(i)] == size
+        n = n if ok.all() else int(np.argmin(ok))
+        if n == 0:
+            return 0
+        self._flush_pending()
+        for i, t in enumerate(self.types):
+            values = rows['v{}'.format(i)][:n]
+            if t == 'timestamp':
+                values = (values.astype(np.int64) + pg_epoch_us).view('datetime64[us]')
+            else:
+                values = values.astype(values.dtype.newbyteorder('='))
+            self.chunks[i].append(values)
+        return n
+
+    def _decode_row(self, pos):
+        """ Decodes the row at `pos` into `pending`, returns its end or None if incomplete. """
+        buf = self.buffer
+        if len(buf) - pos < 2:
+            return None
+        n = struct.unpack_from('>h', buf, pos)[0]
+        if n == -1:
+            self.done = True
+            return pos + 2
+        end = pos + 2
+        values = []
+        for t in self.types:
+            if len(buf) - end < 4:
+                return None
+            length = struct.unpack_from('>i', buf, end)[0]
+            end += 4
+            if length == -1:
+                values.append(None)
+                continue
+            if len(buf) - end < length:
+                return None
+            if t == 'text':
+                values.append(bytes(buf[end:end + length]).decode('utf-8'))
+            else:
+                values.append(struct.unpack_from('>' + wire_types[t][1], buf, end)[0])
+            end += length
+        for column, value in zip(self.pending, values):
+            column.append(value)
+        return end
+
+    def _flush_pending(self):
+        if not self.pending[0]:
+            return
+        for i, t in enumerate(self.types):
+            self.chunks[i].append(self._convert(self.pending[i], t))
+            self.pending[i] = []
+
+    @staticmethod
+    def _convert(values, t):
+        """ Converts decoded values, None for NULL, to an array of type `t`. """
+        if t == 'text':
+            return np.array(values, dtype=object)
+        if t == 'timestamp':
+            us = np.array([nat if v is None else v + pg_epoch_us for v in values], dtype=np.int64)
+            return us.view('datetime64[us]')
+        if t in ('int4', 'int8') and None not in values:
+            return np.array(values, dtype=np.dtype(wire_types[t][0]).newbyteorder('='))
+        if t == 'bool' and None not in values:
+            return np.array(values, dtype=bool)
+        # NULLs in integer and boolean columns become NaN, as in pandas
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+
+@cached('query', upstream=('filter_tweets', 'regions'))
+def copy_columns(sql, params, types, conn=None, chunk_bytes=1 << 22):
+    """ Runs a SELECT through binary COPY, returning one array per column.
+
+    Args:
+        sql (str): The SELECT, with psycopg2 placeholders.
+        params (list): Its parameters, inlined since COPY takes none.
+        types (list[str]): `wire_types` key of each result column.
+        conn (psycopg2.connection): Database connection, DATABASE_URL if None.
+        chunk_bytes (int): COPY data decoded at a time.
+    """
+    reader = BinaryCopyReader(types, chunk_bytes)
+    own_conn = conn is None
+    conn = checkout() if own_conn else conn
+    try:
+        curr = conn.cursor()
+        select = curr.mogrify(sql, params)
+        select = select.decode('utf-8') if isinstance(select, bytes) else select
+        curr.copy_expert('COPY ({}) TO STDOUT WITH (FORMAT BINARY)'.format(select), reader)
+        curr.close()
+    finally:
+        if own_conn:
+            release(conn)
+    reader.close()
+    return reader.columns()
+
+
+###############################################################################
+# Lazy Queries                                                                #
+###############################################################################
+
+# Columns of filter_tweets and the type each is sent as
+filter_columns = [
+    ('id', 'int4'),
+    ('tweetID', 'int8'),
+    ('date', 'timestamp'),
+    ('message', 'text'),
+    ('username', 'text'),
+    ('userID', 'int8'),
+    ('language', 'text'),
+    ('longitude', 'float8'),
+    ('latitude', 'float8'),
+    ('retweet', 'text'),
+    ('state', 'text'),
+    ('county', 'text'),
+]
+
+# Lookups of `where`, as in `where(date__gte='2017-01-01')`
+lookups = {
+    'eq': '{} = %s',
+    'ne': '{} <> %s',
+    'lt': '{} < %s',
+    'lte': '{} <= %s',
+    'gt': '{} > %s',
+    'gte': '{} >= %s',
+    'in': '{} = ANY(%s)',
+    'range': '{0} >= %s AND {0} < %s',
+    'contains': "{} ILIKE %s ESCAPE '\\'",
+}
+
+# Aggregates of `agg`, with their result type (None keeps the column's type)
+aggregates = {
+    'count': ('COUNT({})', 'int8'),
+    'nunique': ('COUNT(DISTINCT {})', 'int8'),
+    'sum': ('SUM({})::float8', 'float8'),
+    'mean': ('AVG({})::float8', 'float8'),
+    'min': ('MIN({})', None),
+    'max': ('MAX({})', None),
+}
+
+grains = ['hour', 'day', 'week', 'month']
+
+
+def quote(column):
+    return '"{}"'.format(column)
+
+
+class Query(object):
+    """ A lazy query over filter_tweets, compiled to one SQL statement.
+
+        Every method returns a new Query, nothing runs until `collect`, which
+        sends a single SELECT with the projection, filters, grouping, order
+        and limit pushed down, so only the requested columns (or aggregates)
+        leave the server. Results arrive through binary COPY and are decoded
+        straight into typed columns, see `BinaryCopyReader`.
+
+        >>> q = tweets().where(language='en', date__gte='2017-06-01')
+        >>> q.group_by('state', grain='day').agg(n='count').collect()
+
+        Args:
+            table (str): Table queried.
+            schema (list[tuple]): (column, `wire_types` key) of the table.
+    """
+    def __init__(self, table='filter_tweets', schema=filter_columns):
+        self.table = table
+        self.schema = schema
+        self.types = dict(schema)
+        self.projection = None
+        self.filters = []
+        self.keys = None
+        self.grain = None
+        self.aggs = []
+        self.order = []
+        self.n = None
+
+    def _copy(self, **changes):
+        query = Query(self.table, self.schema)
+        query.__dict__.update(self.__dict__)
+        query.filters = list(self.filters)
+        query.__dict__.update(changes)
+        return query
+
+    def _check(self, column):
+        if column not in self.types:
+            raise ValueError('unknown column {} of {}'.format(column, self.table))
+        return column
+
+    def select(self, *columns):
+        """ Projects the result onto `columns`. """
+        return self._copy(projection=[self._check(c) for c in columns])
+
+    def where(self, **conditions):
+        """ Keeps rows matching every condition, given as column__lookup=value.
+
+            Lookups are those of `lookups` (eq when omitted) and `isnull`, e.g.
+            language='en', date__range=(start, end), message__contains='flu',
+            state__in=['CA', 'NY'] or county__isnull=False.
+        """
+        filters = []
+        for name, value in sorted(conditions.items()):
+            column, _, lookup = name.partition('__')
+            column = quote(self._check(column))
+            lookup = lookup or 'eq'
+            if lookup == 'isnull' or (lookup == 'eq' and value is None):
+                is_null = value if lookup == 'isnull' else True
+                filters.append(('{} IS {}NULL'.format(column, '' if is_null else 'NOT '), ()))
+            elif lookup == 'in':
+                values = list(value)
+                filters.append((lookups['in'].format(column), (values,)) if values
+                               else ('FALSE', ()))
+            elif lookup == 'range':
+                filters.append((lookups['range'].format(column), tuple(value)))
+            elif lookup == 'contains':
+                pattern = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                filters.append((lookups['contains'].format(column), ('%' + pattern + '%',)))
+            elif lookup in lookups:
+                filters.append((lookups[lookup].format(column), (value,)))
+            else:
+                raise ValueError('unknown lookup {}'.format(lookup))
+        return self._copy(filters=self.filters + filters)
+
+    def group_by(self, *columns, **options):
+        """ Groups by `columns`, with `grain='day'` (hour, week, month) truncating dates. """
+        grain = options.pop('grain', None)
+        if options:
+            raise TypeError('unexpected options {}'.format(', '.join(options)))
+        if grain is not None and grain not in grains:
+            raise ValueError('grain must be one of {}'.format(', '.join(grains)))
+        if grain is not None and 'date' not in columns:
+            columns = ('date',) + columns
+        return self._copy(keys=[self._check(c) for c in columns], grain=grain)
+
+    def agg(self, **outputs):
+        """ Aggregates each group (or the whole table), e.g. n='count' or
+            polarity=('mean', 'polarity'), with the functions of `aggregates`.
+        """
+        aggs = list(self.aggs)
+        for name, spec in outputs.items():
+            func, column = (spec, None) if isinstance(spec, str) else spec
+            if func not in aggregates:
+                raise ValueError('unknown aggregate {}'.format(func))
+            if column is None and func != 'count':
+                raise ValueError('{} needs a column'.format(func))
+            aggs.append((name, func, column and self._check(column)))
+        return self._copy(aggs=aggs)
+
+    def sort(self, *columns):
+        """ Orders the result by output columns, descending when prefixed by '-'. """
+        return self._copy(order=self.order + list(columns))
+
+    def limit(self, n):
+        return self._copy(n=int(n))
+
+    def outputs(self):
+        """ Returns (name, SQL expression, wire type) of every result column. """
+        if self.keys is None and not self.aggs:
+            return [(c, quote(c) + ('::text' if t == 'text' else ''), t)
+                    for c, t in self.schema if self.projection is None or c in self.projection]
+        outputs = []
+        for c in self.keys or []:
+            expr = quote(c)
+            if c == 'date' and self.grain is not None:
+                expr = "date_trunc('{}', {})".format(self.grain, expr)
+            outputs.append((c, expr + ('::text' if self.types[c] == 'text' else ''), self.types[c]))
+        for name, func, column in self.aggs or [('n', 'count', None)]:
+            template, t = aggregates[func]
+            expr = template.format(quote(column) if column else '*')
+            t = t or self.types[column]
+            outputs.append((name, expr + ('::text' if t == 'text' else ''), t))
+        return outputs
+
+    def compile(self):
+        """ Returns the (sql, params) of the query. """
+        outputs = self.outputs()
+        names = [name for name, _, _ in outputs]
+        sql = 'SELECT {} FROM {}'.format(
+            ', '.join('{} AS {}'.format(expr, quote(name)) for name, expr, _ in outputs),
+            quote(self.table))
+        params = []
+        if self.filters:
+            sql += ' WHERE ' + ' AND '.join(f for f, _ in self.filters)
+            for _, values in self.filters:
+                params.extend(values)
+        if self.keys is not None:
+            sql += ' GROUP BY ' + ', '.join(str(i + 1) for i in range(len(self.keys)))
+        if self.order:
+            order = []
+            for column in self.order:
+                name = column.lstrip('-')
+                if name not in names:
+                    raise ValueError('cannot sort by {}, not in the result'.format(name))
+                order.append(quote(name) + (' DESC' if column.startswith('-') else ''))
+            sql += ' ORDER BY ' + ', '.join(order)
+        if self.n is not None:
+            sql += ' LIMIT {:d}'.format(self.n)
+        return sql, params
+
+    def sql(self, conn=None):
+        """ Returns the SQL sent by `collect`, parameters inlined. """
+        own_conn = conn is None
+        conn = checkout() if own_conn else conn
+        try:
+            curr = conn.cursor()
+            sql = curr.mogrify(*self.compile())
+            curr.close()
+        finally:
+            if own_conn:
+                release(conn)
+        return sql.decode('utf-8') if isinstance(sql, bytes) else sql
+
+    def collect(self, conn=None, chunk_bytes=1 << 22, cache=False):
+        """ Runs the query.
+
+        Args:
+            conn (psycopg2.connection): Database connection, DATABASE_URL if None.
+            chunk_bytes (int): COPY data decoded at a time.
+            cache (bool): Reuse the result of the same query while
+                filter_tweets and its regions are unchanged.
+
+        Returns:
+            df (pandas.DataFrame): The result, typed by `src.data.schema.tweet_dtypes`
+                where a column is one of the tweet columns.
+        """
+        outputs = self.outputs()
+        sql, params = self.compile()
+        fetch = copy_columns if cache else copy_columns.uncached
+        columns = fetch(sql, params, [t for _, _, t in outputs], conn, chunk_bytes)
+        names = [name for name, _, _ in outputs]
+        return apply_schema(pd.DataFrame(dict(zip(names, columns)), columns=names))
+
+    def count(self, conn=None):
+        """ Returns the number of matching rows, counted by the server. """
+        df = self._copy(keys=None, grain=None, aggs=[('n', 'count', None)],
+                        order=[], n=None).collect(conn)
+        return int(df['n'].iloc[0])
+
+
+def tweets():
+    """ Returns a lazy Query over all of filter_tweets. """
+    return Query()
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import click
+import fcntl
+import pickle
+import hashlib
+import inspect
+import functools
+from contextlib import contextmanager
+from dotenv import find_dotenv, load_dotenv
+from time import time
+
+from src.data.database import checkout, release
+
+
+###############################################################################
+# Result Keys                                                                 #
+###############################################################################
+
+# Results of cached stages, one pickle per key, with the LRU index beside them
+results_dir = os.path.join('data', 'interim', 'results')
+default_max_bytes = 2 << 30
+
+manifest_version_query = 'SELECT COUNT(*), MAX(loaded_at) FROM import_manifest;'
+scores_version_query = 'SELECT COALESCE(MAX(id), 0) FROM tweet_sentiment;'
+stage_version_query = 'SELECT high_water, updated_at FROM filter_state WHERE stage = %s;'
+
+
+def code_version(func):
+    """ Returns a hash of the source file defining `func` and its name.
+
+    The whole module is hashed rather than the function alone, so a change to
+    a helper or a module-level query also invalidates the stage's results.
+    """
+    sha = hashlib.sha1(func.__qualname__.encode('utf-8'))
+    with open(inspect.getsourcefile(func), 'rb') as f:
+        sha.update(f.read())
+    return sha.hexdigest()
+
+
+def data_version(curr, upstream):
+    """ Returns the current version of each upstream data source.
+
+    Args:
+        curr (psycopg2.cursor): Database cursor.
+        upstream (list[str]): 'import' (the import manifest), 'scores'
+            (tweet_sentiment) or a filter_state stage such as 'filter_tweets'.
+
+    Returns:
+        version (dict): Source -> JSON-able version.
+    """
+    version = {}
+    for source in upstream:
+        if source == 'import':
+            curr.execute(manifest_version_query)
+        elif source == 'scores':
+            curr.execute(scores_version_query)
+        else:
+            curr.execute(stage_version_query, (source,))
+        row = curr.fetchone()
+        version[source] = [str(v) for v in row] if row is not None else None
+    return version
+
+
+def result_key(code, params, version):
+    """ Returns the content address of a result: a hash of code, params and data. """
+    blob = json.dumps([code, params, version], default=repr)
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+
+###############################################################################
+# Result Store                                                                #
+###############################################################################
+
+class ResultCache(object):
+    """ Pickled stage results on disk, evicted least recently used first.
+
+    `_index.json` holds every entry's stage, size, compute time and last use,
+    and per stage hit, miss and saved-seconds counters. It is only changed
+    under an exclusive lock, so pipeline processes can share the cache.
+
+    Args:
+        root (str): Cache directory.
+        max_bytes (int): Total size of stored results kept after a `put`,
+            RESULT_CACHE_BYTES if None. 0 disables the cache.
+    """
+    def __init__(self, root=results_dir, max_bytes=None):
+        self.root = root
+        self.max_bytes = int(os.environ.get('RESULT_CACHE_BYTES', default_max_bytes)) \
+            if max_bytes is None else max_bytes
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.pkl')
+
+    @contextmanager
+    def index(self):
+        """ Yields the index for update under the cache lock, then saves it. """
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        with open(os.path.join(self.root, '_lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self.read_index()
+            yield index
+            tmp = os.path.join(self.root, '_index.json.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp, os.path.join(self.root, '_index.json'))
+
+    def read_index(self):
+        try:
+            with open(os.path.join(self.root, '_index.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'entries': {}, 'stages': {}}
+
+    @staticmethod
+    def stage_stats(index, stage):
+        return index['stages'].setdefault(stage, {'hits': 0, 'misses': 0, 'saved': 0.0,
+                                                  'computed': 0.0})
+
+    def get(self, key, stage):
+        """ Returns (True, result) if `key` is stored, else (False, None). """
+        try:
+            with open(self.path(key), 'rb') as f:
+                value = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            with self.index() as index:
+                self.stage_stats(index, stage)['misses'] += 1
+            return False, None
+        with self.index() as index:
+            entry = index['entries'].get(key)
+            stats = self.stage_stats(index, stage)
+            stats['hits'] += 1
+            if entry is not None:
+                entry['used'] = time()
+                stats['saved'] += entry['secs']
+        return True, value
+
+    def put(self, key, stage, value, secs):
+        """ Stores a result that took `secs` to compute and evicts old ones. """
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        tmp = '{}.{}.tmp'.format(self.path(key), os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        size = os.path.getsize(tmp)
+        with self.index() as index:
+            self.stage_stats(index, stage)['computed'] += secs
+            if size > self.max_bytes:
+                os.remove(tmp)
+                return
+            os.replace(tmp, self.path(key))
+            index['entries'][key] = {'stage': stage, 'bytes': size, 'secs': secs,
+                                     'created': time(), 'used': time()}
+            self.evict(index)
+
+    def evict(self, index):
+        """ Removes least recently used entries until the total fits `max_bytes`. """
+        entries = index['entries']
+        total = sum(e['bytes'] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]['used']):
+            if total <= self.max_bytes:
+                break
+            total -= entries.pop(key)['bytes']
+            if os.path.exists(self.path(key)):
+                os.remove(self.path(key))
+
+    def clear(self, stage=None):
+        """ Removes every entry, or those of one stage, and their counters. """
+        with self.index() as index:
+            for key, entry in list(index['entries'].items()):
+                if stage is None or entry['stage'] == stage:
+                    del index['entries'][key]
+                    if os.path.exists(self.path(key)):
+                        os.remove(self.path(key))
+            if stage is None:
+                index['stages'].clear()
+            else:
+                index['stages'].pop(stage, None)
+
+
+def cached(stage, upstream=(), cache=None):
+    """ Decorator caching a function's result by code, arguments and data version.
+
+    A `conn` or `curr` argument is left out of the key and used to read the
+    upstream versions, with a pooled DATABASE_URL connection if it is None.
+    The undecorated function stays available as `.uncached`.
+
+    Args:
+        stage (str): Name the results and counters are reported under.
+        upstream (list[str]): Data sources the result depends on, see
+            `data_version`.
+        cache (ResultCache): Store used, a default `ResultCache` if None.
+    """
+    def decorate(func):
+        signature = inspect.signature(func)
+        code = code_version(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            store = cache if cache is not None else ResultCache()
+            if not store.enabled:
+                return func(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = {k: v for k, v in bound.arguments.items() if k not in ('conn', 'curr')}
+
+            version = {}
+            if upstream:
+                curr = bound.arguments.get('curr')
+                conn = bound.arguments.get('conn')
+                own_conn = curr is None and conn is None
+                conn = checkout() if own_conn else conn
+                version_curr = curr if curr is not None else conn.cursor()
+                try:
+                    version = data_version(version_curr, upstream)
+                finally:
+                    if version_curr is not curr:
+                        version_curr.close()
+                    if own_conn:
+                        release(conn)
+
+            key = result_key(code, params, version)
+            hit, value = store.get(key, stage)
+            if hit:
+                return value
+            start = time()
+            value = func(*args, **kwargs)
+            store.put(key, stage, value, time() - start)
+            return value
+
+        wrapper.uncached = func
+        return wrapper
+    return decorate
+
+
+###############################################################################
+# Cache CLI                                                                   #
+###############################################################################
+
+@click.group()
+@click.option('--root', default=results_dir, type=click.Path(), help='Cache directory.')
+@click.pass_context
+def main(ctx, root):
+    """ Inspects the stage result cache. """
+    ctx.obj = ResultCache(root)
+
+
+@main.command()
+@click.pass_obj
+def stats(cache):
+    """ Prints hits, misses and time saved per stage. """
+    index = cache.read_index()
+    sizes = {}
+    for entry in index['entries'].values():
+        n, size = sizes.get(entry['stage'], (0, 0))
+        sizes[entry['stage']] = (n + 1, size + entry['bytes'])
+
+    click.echo('{:20} {:>7} {:>9} {:>6} {:>6} {:>9} {:>10}'.format(
+        'stage', 'entries', 'MB', 'hits', 'misses', 'hit rate', 'saved'))
+    for stage, s in sorted(index['stages'].items()):
+        n, size = sizes.get(stage, (0, 0))
+        calls = s['hits'] + s['misses']
+        click.echo('{:20} {:7d} {:9.1f} {:6d} {:6d} {:8.0%} {:9.1f}s'.format(
+            stage, n, size / 2.0 ** 20, s['hits'], s['misses'],
+            s['hits'] / calls if calls else 0, s['saved']))
+    total = sum(e['bytes'] for e in index['entries'].values())
+    click.echo('{:.1f} of {:.1f} MB used'.format(total / 2.0 ** 20, cache.max_bytes / 2.0 ** 20))
+
+
+@main.command()
+@click.option('--stage', default=None, help='Only clear this stage.')
+@click.pass_obj
+def clear(cache, stage):
+    """ Removes cached results and their counters. """
+    cache.clear(stage)
+
+
+if __name__ == '__main__':
+    load_dotenv(find_dotenv())
+
+    main()
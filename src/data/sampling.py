@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+
+from src.data.database import checkout, release
+from src.data.result_cache import cached
+from src.data.schema import apply_schema
+
+
+###############################################################################
+# Per-User Statistics                                                         #
+###############################################################################
+
+def fetch_frame(conn, query, params=None):
+    """ Runs a query on `conn`, or on a new DATABASE_URL connection if None. """
+    own_conn = conn is None
+    conn = checkout() if own_conn else conn
+    try:
+        curr = conn.cursor()
+        curr.execute(query, params)
+        columns = [c[0] for c in curr.description]
+        rows = curr.fetchall()
+        curr.close()
+    finally:
+        if own_conn:
+            release(conn)
+    return pd.DataFrame(rows, columns=columns)
+
+
+@cached('top_users', upstream=('filter_tweets', 'scores'))
+def top_users(conn=None, n=20, min_tweets=1):
+    """ Returns the `n` heaviest posters from user_stats, no filter_tweets scan.
+
+    Returns:
+        df (pandas.DataFrame): userID, username, n_tweets, first_date,
+            last_date, n_scored and mean_polarity, most tweets first.
+    """
+    return fetch_frame(conn, """
+        SELECT "userID", username, n_tweets, first_date, last_date, n_scored,
+               sum_polarity / NULLIF(n_scored, 0) AS mean_polarity
+        FROM user_stats WHERE n_tweets >= %s
+        ORDER BY n_tweets DESC LIMIT %s;""", (min_tweets, n))
+
+
+###############################################################################
+# Capped Sampling                                                             #
+###############################################################################
+
+@cached('user_sample', upstream=('filter_tweets', 'regions'))
+def sample_per_user(conn=None, cap=10, columns=None, seed=0):
+    """ Returns filtered tweets with at most `cap` tweets per user.
+
+    user_stats tells which users exceed the cap, so only their tweets are
+    ranked (in a seeded pseudo-random order); everyone else's tweets are
+    returned as they are, without a sort or GROUP BY over filter_tweets.
+
+    Args:
+        conn (psycopg2.connection): Database connection, DATABASE_URL if None.
+        cap (int): Maximum number of tweets kept per user.
+        columns (list[str]): filter_tweets columns to return, all if None.
+        seed (int): Changes which tweets of heavy users are kept.
+
+    Returns:
+        df (pandas.DataFrame): The sampled tweets, typed by
+            `src.data.schema.tweet_dtypes`.
+    """
+    select = ', '.join('f."{}"'.format(c) for c in columns) if columns else 'f.*'
+    query = """
+        SELECT {} FROM filter_tweets f
+        JOIN user_stats u ON u."userID" = f."userID"
+        WHERE u.n_tweets <= %(cap)s OR f.id IN (
+            SELECT id FROM (
+                SELECT h.id, ROW_NUMBER() OVER (
+                    PARTITION BY h."userID" ORDER BY md5(h.id::text || %(seed)s)) AS rank
+                FROM filter_tweets h
+                JOIN user_stats hu ON hu."userID" = h."userID" AND hu.n_tweets > %(cap)s
+            ) ranked WHERE rank <= %(cap)s);""".format(select)
+    return apply_schema(fetch_frame(conn, query, {'cap': cap, 'seed': str(seed)}))
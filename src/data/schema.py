@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+
+
+###############################################################################
+# Tweet Frame Schema                                                          #
+###############################################################################
+
+# Declared dtypes of every tweet frame. Low cardinality text is categorical,
+# coordinates are float32 (under a metre of error at US longitudes), dates are
+# datetime64 and usernames are interned so repeated names share one object.
+tweet_dtypes = {
+    'id': np.int64,
+    'tweetID': np.int64,
+    'date': 'datetime64[ns]',
+    'message': object,
+    'username': object,
+    'userID': np.int64,
+    'language': 'category',
+    'longitude': np.float32,
+    'latitude': np.float32,
+    'retweet': 'category',
+    'state': 'category',
+    'county': 'category',
+}
+interned_cols = ['username']
+
+# Ingest only re-serialises short-lived chunks for COPY, so only the ids are
+# declared. Text stays object: categoricals cut memory but make `to_csv`
+# slower, dates would be parsed and formatted again and float32 coordinates
+# would lose digits in raw_tweets.
+ingest_dtypes = {'tweetID': np.int64, 'userID': np.int64}
+
+
+def csv_options(columns, dtypes=tweet_dtypes):
+    """ Returns `pd.read_csv` keyword arguments reading `columns` with the schema.
+
+    Args:
+        columns (list[str]): Columns to read.
+        dtypes (dict): `tweet_dtypes`, or `ingest_dtypes` for the COPY path.
+
+    Returns:
+        options (dict): usecols, dtype and parse_dates arguments.
+    """
+    dates = [c for c in columns if str(dtypes.get(c)).startswith('datetime64')]
+    return {'usecols': columns,
+            'dtype': {c: dtypes[c] for c in columns if c in dtypes and c not in dates},
+            'parse_dates': dates}
+
+
+def intern_strings(values):
+    """ Returns an object array where equal strings are one shared object.
+
+    Values are factorized once and the uniques taken back by code, so the
+    frame holds references to a single copy of each distinct string.
+    """
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    if len(uniques) == 0:
+        # Every value is missing, there is nothing to share
+        return np.full(len(codes), None, dtype=object)
+    interned = np.asarray(uniques, dtype=object).take(np.maximum(codes, 0))
+    interned[codes < 0] = None
+    return interned
+
+
+def apply_schema(df, dtypes=tweet_dtypes):
+    """ Casts the schema columns present in `df` to their declared dtypes.
+
+    Args:
+        df (pandas.DataFrame): Tweets, e.g. from the cache or a query.
+        dtypes (dict): Declared dtypes, `tweet_dtypes` by default.
+
+    Returns:
+        df (pandas.DataFrame): The same frame, converted in place.
+    """
+    for col in df.columns:
+        dtype = dtypes.get(col)
+        if dtype is None:
+            continue
+        if col in interned_cols:
+            df[col] = pd.Series(intern_strings(df[col].values), index=df.index, dtype=object)
+        elif str(dtype).startswith('datetime64'):
+            if not pd.api.types.is_datetime64_any_dtype(df[col]):
+                df[col] = pd.to_datetime(df[col])
+            # Newer pandas may parse or read dates at another unit, e.g. [us]
+            if df[col].dtype != dtype:
+                df[col] = df[col].astype(dtype)
+        elif dtype == 'category':
+            if not pd.api.types.is_categorical_dtype(df[col]):
+                df[col] = df[col].astype('category')
+        elif dtype is not object and df[col].dtype != dtype:
+            df[col] = df[col].astype(dtype)
+    return df
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import json
+import click
+import shutil
+import logging
+from datetime import timedelta
+from dotenv import find_dotenv, load_dotenv
+from time import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+
+from src.data.make_cache import load_null_dates, load_tweets, read_meta
+from src.data.database import checkout, release
+
+
+###############################################################################
+# Batch Normalization & Tokenization                                          #
+###############################################################################
+
+# Messages are joined with newlines so every regex below runs once per batch
+# instead of once per message.
+SEP = '\n'
+
+URL_RE = re.compile(r'https?://\S+|www\.\S+')
+MENTION_RE = re.compile(r'@\w+')
+HASHTAG_RE = re.compile(r'#(\w+)')
+TOKEN_RE = re.compile(r"\n|[a-z0-9]+(?:['-][a-z0-9]+)*")
+
+
+def join_batch(messages):
+    """ Lowercases a batch of messages and joins them by `SEP`.
+
+    Anything but a string, such as None or the NaN of a missing message in a
+    DataFrame, counts as an empty message.
+    """
+    return SEP.join(m.replace(SEP, ' ') if isinstance(m, str) else ''
+                    for m in messages).lower()
+
+
+def normalize_batch(messages):
+    """ Lowercases a batch of messages and strips URLs, mentions and '#'.
+
+    Args:
+        messages (list[str]): Tweet texts, non-strings are treated as empty.
+
+    Returns:
+        text (str): The normalized messages joined by `SEP`.
+    """
+    text = URL_RE.sub(' ', join_batch(messages))
+    text = MENTION_RE.sub(' ', text)
+    return HASHTAG_RE.sub(r'\1', text)
+
+
+def tokenize_batch(messages, token_re=TOKEN_RE, normalize=normalize_batch):
+    """ Normalizes and tokenizes a batch of messages.
+
+    Args:
+        messages (list[str]): Tweet texts.
+        token_re (re.Pattern): Token pattern, it must also match `SEP`.
+        normalize (callable): Turns the messages into one `SEP` joined text.
+
+    Returns:
+        tokens (numpy.ndarray): Every token of the batch, in order.
+        offsets (numpy.ndarray): int64 array of len(messages) + 1, message i
+            owns tokens[offsets[i]:offsets[i + 1]].
+    """
+    tokens = np.array(token_re.findall(SEP + normalize(messages)), dtype=object)
+    is_sep = tokens == SEP
+    counts = np.bincount(np.cumsum(is_sep)[~is_sep] - 1, minlength=len(messages))
+    offsets = np.zeros(len(messages) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return tokens[~is_sep], offsets
+
+
+###############################################################################
+# Token Store                                                                 #
+###############################################################################
+
+store_dir = os.path.join('data', 'interim', 'tokens')
+
+
+class TokenStore(object):
+    """ Tokenized tweets as int32 token ids with per-tweet offsets.
+
+    Tweet i (with filter_tweets id `doc_ids[i]`) has the token ids
+    `token_ids[offsets[i]:offsets[i + 1]]`, and `vocab[j]` is the text of token
+    id j. Stores are written by `build_store` and memory mapped on `load`.
+    """
+    def __init__(self, vocab, token_ids, offsets, doc_ids):
+        self.vocab = vocab
+        self.token_ids = token_ids
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __getitem__(self, i):
+        return self.token_ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def tokens(self, i):
+        """ Returns the token strings of tweet i. """
+        return [self.vocab[t] for t in self[i]]
+
+    def save(self, path=store_dir):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'vocab.txt'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.vocab))
+        np.save(os.path.join(path, 'token_ids.npy'), self.token_ids)
+        np.save(os.path.join(path, 'offsets.npy'), self.offsets)
+        np.save(os.path.join(path, 'doc_ids.npy'), self.doc_ids)
+
+    @classmethod
+    def load(cls, path=store_dir):
+        with open(os.path.join(path, 'vocab.txt'), encoding='utf-8') as f:
+            vocab = f.read().split('\n')
+        return cls(vocab,
+                   np.load(os.path.join(path, 'token_ids.npy'), mmap_mode='r'),
+                   np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r'),
+                   np.load(os.path.join(path, 'doc_ids.npy'), mmap_mode='r'))
+
+
+class Vocabulary(object):
+    """ Growing token -> int32 id mapping, assigned in order of first use. """
+    def __init__(self):
+        self.index = {}
+        self.words = []
+
+    def encode(self, tokens):
+        """ Maps an array of tokens to int32 ids, adding unseen tokens. """
+        if len(tokens) == 0:
+            return np.zeros(0, dtype=np.int32)
+        uniques, inverse = np.unique(tokens.astype(str), return_inverse=True)
+        ids = np.empty(len(uniques), dtype=np.int32)
+        for i, u in enumerate(uniques):
+            if u not in self.index:
+                self.index[u] = len(self.words)
+                self.words.append(str(u))
+            ids[i] = self.index[u]
+        return ids[inverse]
+
+
+def build_store(batches):
+    """ Builds a TokenStore from (doc_ids, messages) batches.
+
+    Args:
+        batches (iterable): (doc_ids, messages) pairs of equal length.
+
+    Returns:
+        store (TokenStore): All batches in order.
+    """
+    vocab = Vocabulary()
+    token_ids, offsets, doc_ids = [], [np.zeros(1, dtype=np.int64)], []
+    n_tokens = 0
+    for ids, messages in batches:
+        tokens, batch_offsets = tokenize_batch(messages)
+        token_ids.append(vocab.encode(tokens))
+        offsets.append(batch_offsets[1:] + n_tokens)
+        doc_ids.append(np.asarray(ids, dtype=np.int64))
+        n_tokens += len(tokens)
+
+    return TokenStore(vocab.words,
+                      np.concatenate(token_ids) if token_ids else np.zeros(0, np.int32),
+                      np.concatenate(offsets),
+                      np.concatenate(doc_ids) if doc_ids else np.zeros(0, np.int64))
+
+
+def cache_batches():
+    """ Yields (ids, messages) per day of the filtered tweet cache, undated tweets last. """
+    for day in read_meta()['days']:
+        start = pd.Timestamp(day)
+        df = load_tweets(['id', 'message'], start=start, end=start + timedelta(days=1))
+        yield df['id'].values, list(df['message'].values)
+    df = load_null_dates(['id', 'message'])
+    if len(df):
+        yield df['id'].values, list(df['message'].values)
+
+
+###############################################################################
+# Hashed Feature Shards                                                       #
+###############################################################################
+
+shard_dir = os.path.join('data', 'interim', 'hashed')
+
+
+def make_vectorizer(n_features=2 ** 20):
+    """ Stateless bag-of-words vectorizer, the same for every chunk and run. """
+    return HashingVectorizer(n_features=n_features, preprocessor=lambda x: x,
+                             token_pattern=r"[a-z0-9]+(?:['-][a-z0-9]+)*",
+                             alternate_sign=False, norm='l2', dtype=np.float32)
+
+
+class HashedShards(object):
+    """ CSR feature shards written by `write_shards`, loaded lazily.
+
+    Each shard is a directory holding the `data`, `indices` and `indptr` arrays
+    of one CSR matrix plus the filter_tweets `ids` of its rows. Shards are
+    memory mapped one at a time, so iterating never holds more than a shard.
+    """
+    def __init__(self, path=shard_dir):
+        self.path = path
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.isfile(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {'n_features': None, 'shards': []}
+
+    def __len__(self):
+        return len(self.meta['shards'])
+
+    @property
+    def n_rows(self):
+        return sum(s['rows'] for s in self.meta['shards'])
+
+    @property
+    def max_id(self):
+        return max([s['max_id'] for s in self.meta['shards']] or [0])
+
+    def shard(self, i):
+        """ Returns (ids, csr_matrix) of shard i, backed by memory maps. """
+        info = self.meta['shards'][i]
+        path = os.path.join(self.path, info['name'])
+        load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        X = sparse.csr_matrix((load('data'), load('indices'), load('indptr')),
+                              shape=(info['rows'], self.meta['n_features']), copy=False)
+        return load('ids'), X
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.shard(i)
+
+    def concatenate(self, shards=None):
+        """ Stacks the given shards (all by default) into one CSR matrix. """
+        shards = range(len(self)) if shards is None else shards
+        parts = [self.shard(i) for i in shards]
+        if not parts:
+            return np.zeros(0, np.int64), sparse.csr_matrix((0, self.meta['n_features'] or 0))
+        return (np.concatenate([ids for ids, _ in parts]),
+                sparse.vstack([X for _, X in parts], format='csr'))
+
+    def append(self, ids, X):
+        """ Writes a new shard and records it in the metadata.
+
+        The arrays are written to a temporary directory that is renamed into
+        place once complete, and meta.json is replaced in one step, so a crash
+        never leaves a recorded shard half written. A directory left by a
+        crash before meta.json was updated is not in the metadata and is
+        overwritten.
+        """
+        name = 'shard_{:05d}'.format(len(self))
+        path = os.path.join(self.path, name)
+        tmp = path + '.tmp'
+        for stale in (tmp, path):
+            if os.path.exists(stale):
+                shutil.rmtree(stale)
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, 'data.npy'), X.data)
+        np.save(os.path.join(tmp, 'indices.npy'), X.indices)
+        np.save(os.path.join(tmp, 'indptr.npy'), X.indptr)
+        np.save(os.path.join(tmp, 'ids.npy'), np.asarray(ids, dtype=np.int64))
+        os.rename(tmp, path)
+
+        self.meta['n_features'] = X.shape[1]
+        self.meta['shards'].append({'name': name, 'rows': X.shape[0],
+                                    'max_id': int(max(ids))})
+        meta_path = os.path.join(self.path, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+
+def write_shards(conn, shards, chunk_rows=100000, n_features=2 ** 20):
+    """ Hashes filter_tweets rows newer than the last shard into new shards.
+
+    Rows are streamed through a server-side cursor, one chunk per shard, so
+    memory stays flat however large the corpus grows.
+
+    Returns:
+        n_rows (int): Rows hashed.
+    """
+    if shards.meta['n_features'] not in (None, n_features):
+        raise ValueError('shards in {} were hashed with {} features'.format(
+            shards.path, shards.meta['n_features']))
+    if not os.path.isdir(shards.path):
+        os.makedirs(shards.path)
+
+    vectorizer = make_vectorizer(n_features)
+    curr = conn.cursor(name='hash_tweets')
+    curr.itersize = chunk_rows
+    curr.execute('SELECT id, message FROM filter_tweets WHERE id > %s ORDER BY id;',
+                 (shards.max_id,))
+    n_rows = 0
+    while True:
+        rows = curr.fetchmany(chunk_rows)
+        if not rows:
+            break
+        ids, messages = zip(*rows)
+        text = normalize_batch(messages).split(SEP)
+        shards.append(ids, vectorizer.transform(text).tocsr())
+        n_rows += len(rows)
+    curr.close()
+    return n_rows
+
+
+###############################################################################
+# Feature CLI                                                                 #
+###############################################################################
+
+@click.group()
+def main():
+    """ Builds features from filtered tweets. """
+
+
+@main.command()
+def tokens():
+    """ Tokenizes the filtered tweet cache into the token store in data/interim. """
+    logger = logging.getLogger(__name__)
+    start = time()
+    store = build_store(cache_batches())
+    store.save()
+    logger.info('{} tweets, {} tokens, {} words in {:.2f} secs'.format(
+        len(store), len(store.token_ids), len(store.vocab), time() - start))
+
+
+@main.command()
+@click.argument('database_url', envvar='DATABASE_URL')
+@click.option('--chunk-rows', default=100000, type=click.IntRange(min=1),
+              help='Tweets per shard.')
+@click.option('--n-features', default=2 ** 20, type=click.IntRange(min=1),
+              help='Number of hashed feature columns.')
+def hashed(database_url, chunk_rows, n_features):
+    """ Appends hashed bag-of-words CSR shards for new tweets to data/interim. """
+    logger = logging.getLogger(__name__)
+    start = time()
+    conn = checkout(database_url)
+    try:
+        n_rows = write_shards(conn, HashedShards(), chunk_rows, n_features)
+    finally:
+        release(conn, database_url)
+    logger.info('hashed {} tweets in {:.2f} secs'.format(n_rows, time() - start))
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO,
+                    format=log_fmt, datefmt='%H:%M:%S',
+                    filename='reports/pipeline.features.log', filemode='a')
+
+    load_dotenv(find_dotenv())
+
+    main()
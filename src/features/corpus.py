@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+
+import numpy as np
+
+from src.data.database import checkout, release, stream_rows
+from src.data.make_cache import get_version
+from src.features.build_features import Vocabulary, tokenize_batch
+
+
+class TweetCorpus(object):
+    """ Restartable iterable of tokenized tweets for gensim.
+
+    Every iteration is one epoch. Messages are streamed from Postgres through
+    a named cursor, `itersize` rows per round trip, and tokenized a batch at a
+    time. With `cache_path` the first complete epoch is also written as int32
+    token ids with int64 offsets, and later epochs are read back from those
+    files sequentially instead of querying the database. The cache records
+    the filter_tweets version (high-water mark and rebuild time) it was
+    built from, and is rebuilt once filter_tweets has moved on.
+
+    Args:
+        db_url (str): Database URL, DATABASE_URL if None.
+        query (str): Query returning one message per row.
+        itersize (int): Rows fetched per round trip.
+        cache_path (str): Prefix of the token cache files, no caching if None.
+    """
+    def __init__(self, db_url=None, query='SELECT message FROM filter_tweets ORDER BY id;',
+                 itersize=10000, cache_path=None):
+        self.db_url = db_url
+        self.query = query
+        self.itersize = itersize
+        self.cache_path = cache_path
+
+    def cache_files(self, suffix=''):
+        return [self.cache_path + ext + suffix
+                for ext in ('.vocab', '.ids', '.offsets', '.version')]
+
+    def data_version(self):
+        conn = checkout(self.db_url)
+        try:
+            return list(get_version(conn.cursor()))
+        finally:
+            release(conn, self.db_url)
+
+    def is_cached(self):
+        if self.cache_path is None or \
+                not all(os.path.isfile(f) for f in self.cache_files()):
+            return False
+        with open(self.cache_files()[3]) as f:
+            return json.load(f) == self.data_version()
+
+    def __iter__(self):
+        if self.is_cached():
+            return self.iter_cache()
+        return self.iter_database()
+
+    def iter_database(self):
+        writing = self.cache_path is not None
+        if writing:
+            vocab = Vocabulary()
+            # Read before streaming, rows added meanwhile only make it stale
+            version = self.data_version()
+            tmp_files = self.cache_files('.tmp')
+            ids_file = open(tmp_files[1], 'wb')
+            offsets_file = open(tmp_files[2], 'wb')
+            np.zeros(1, dtype=np.int64).tofile(offsets_file)
+            n_tokens = 0
+
+        conn = checkout(self.db_url)
+        try:
+            for rows in stream_rows(conn, self.query, itersize=self.itersize,
+                                    name='tweet_corpus'):
+                tokens, offsets = tokenize_batch([r[0] for r in rows])
+                if writing:
+                    vocab.encode(tokens).tofile(ids_file)
+                    (offsets[1:] + n_tokens).tofile(offsets_file)
+                    n_tokens += len(tokens)
+                for i in range(len(rows)):
+                    yield list(tokens[offsets[i]:offsets[i + 1]])
+        finally:
+            release(conn, self.db_url)
+            if writing:
+                ids_file.close()
+                offsets_file.close()
+
+        # Only a complete epoch becomes the cache
+        if writing:
+            with open(tmp_files[0], 'w', encoding='utf-8') as f:
+                f.write('\n'.join(vocab.words))
+            with open(tmp_files[3], 'w') as f:
+                json.dump(version, f)
+            for tmp, final in zip(tmp_files, self.cache_files()):
+                os.replace(tmp, final)
+
+    def iter_cache(self):
+        vocab_file, ids_file, offsets_file, _ = self.cache_files()
+        with open(vocab_file, encoding='utf-8') as f:
+            vocab = np.array(f.read().split('\n'), dtype=object)
+        ids = np.memmap(ids_file, dtype=np.int32, mode='r') \
+            if os.path.getsize(ids_file) else np.zeros(0, dtype=np.int32)
+        offsets = np.memmap(offsets_file, dtype=np.int64, mode='r')
+        for i in range(len(offsets) - 1):
+            yield list(vocab[ids[offsets[i]:offsets[i + 1]]])
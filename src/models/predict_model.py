@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+import re
+import click
+import logging
+from dotenv import find_dotenv, load_dotenv
+from io import StringIO
+from multiprocessing import Pool
+from time import time
+
+import numpy as np
+
+from src.data.database import checkout, release
+from src.features.build_features import SEP, join_batch, tokenize_batch
+
+
+###############################################################################
+# Lexicon Scorer                                                              #
+###############################################################################
+
+# Punctuation TextBlob's `find_tokens` splits from the ends of words.
+PUNCTUATION = ".,;:!?()[]{}`\"@#$^&*+-|=~_"
+
+
+def make_token_re(emoticons=()):
+    """ Returns a pattern approximating TextBlob's `find_tokens` on lowercased text.
+
+    Words keep inner punctuation, so URLs stay one (unknown) token, while
+    punctuation at either end and every apostrophe is a token of its own, as
+    TextBlob splits them. Sarcasm marks "(!)" and `emoticons` followed by the
+    end of a word are single tokens.
+
+    Args:
+        emoticons (list[str]): Lowercased emoticons, e.g. ':-)' or '<3'.
+    """
+    punct = re.escape(PUNCTUATION)
+    faces = sorted(emoticons, key=len, reverse=True)
+    # Emoticons are only tried at their possible first characters
+    firsts = re.escape(''.join(sorted(set(e[0] for e in faces))))
+    face_re = '|'.join(' ?'.join(re.escape(c) for c in e) for e in faces)
+    face_re = r"(?=[" + firsts + r"])(?:" + face_re + r")" if faces else '(?!)'
+    return re.compile(
+        SEP + r"|\( ?! ?\)"
+        r"|" + face_re + r"(?=[" + punct + r"]*(?:[\s']|$))"
+        r"|[^\s'" + punct + r"](?:[^\s']*[^\s'" + punct + r"])?"
+        r"|[" + punct + r"']")
+
+
+class LexiconScorer(object):
+    """ Vectorized version of TextBlob's pattern sentiment analyzer.
+
+    TextBlob scores a message one word at a time. Here every word of the
+    lexicon, and every emoticon, is given an id and its polarity, subjectivity
+    and intensity are kept in arrays, so a batch of messages is scored with
+    array lookups and a per-message sum. Modifiers ("very good") and negations
+    ("not good") are handled when they directly precede a word, which covers
+    most tweets; `compare_textblob` measures the error and `make check-sentiment`
+    fails when it exceeds its tolerance.
+
+    Args:
+        lexicon (textblob._text.Sentiment): Loaded lexicon, TextBlob's English
+            lexicon if None.
+        emoticons (dict): (mood, polarity) -> emoticons, TextBlob's if None.
+    """
+    def __init__(self, lexicon=None, emoticons=None):
+        if lexicon is None:
+            from textblob.en import sentiment as lexicon
+            lexicon.load()
+        if emoticons is None:
+            from textblob._text import EMOTICONS as emoticons
+
+        # TextBlob only checks non-alphabetic emoticons, lowercased. "(!)"
+        # marks sarcasm, a neutral but fully subjective assessment.
+        moods = {'(!)': (0.0, 1.0)}
+        for (_, polarity), faces in emoticons.items():
+            for face in faces:
+                face = face.lower()
+                if not face.isalpha() and len(face) <= 5 and face not in PUNCTUATION:
+                    moods.setdefault(face, (polarity, 1.0))
+        self.token_re = make_token_re([m for m in moods if m != '(!)'])
+
+        words = sorted(w for w in lexicon.keys() if ' ' not in w)
+        self.n_words = len(words)
+        self.vocab = {w: i for i, w in enumerate(words + sorted(moods))}
+        scores = np.array([lexicon[w][None] for w in words] +
+                          [moods[m] + (1.0,) for m in sorted(moods)], dtype=np.float64)
+        self.polarity = scores[:, 0]
+        self.subjectivity = scores[:, 1]
+        self.intensity = scores[:, 2]
+        self.modifier = np.array([any(m in lexicon[w] for m in lexicon.modifiers)
+                                  for w in words] + [False] * len(moods), dtype=bool)
+        self.negations = [n for n in lexicon.negations]
+
+    def token_ids(self, tokens):
+        """ Maps tokens to lexicon ids, -1 for unknown words. """
+        if len(tokens) == 0:
+            return np.zeros(0, dtype=np.int64)
+        uniques, inverse = np.unique(tokens.astype(str), return_inverse=True)
+        # Emoticons may be typed with spaces, ": )", as TextBlob accepts
+        ids = np.array([self.vocab.get(u.replace(' ', ''), -1) for u in uniques],
+                       dtype=np.int64)
+        return ids[inverse.ravel()]
+
+    def score(self, messages):
+        """ Scores a batch of messages.
+
+        Args:
+            messages (list[str]): Tweet texts.
+
+        Returns:
+            polarity (numpy.ndarray): Polarity per message, between -1 and 1.
+            subjectivity (numpy.ndarray): Subjectivity per message, between 0 and 1.
+        """
+        n_docs = len(messages)
+        tokens, offsets = tokenize_batch(messages, self.token_re, join_batch)
+        docs = np.repeat(np.arange(n_docs), np.diff(offsets))
+        ids = self.token_ids(tokens)
+        known = ids >= 0
+        safe = np.where(known, ids, 0)
+        # Emoticons are assessed on their own, never modified or negated
+        word = known & (ids < self.n_words)
+
+        # Neighbour lookups, only valid within the same message
+        same_prev = np.zeros(len(ids), dtype=bool)
+        same_prev[1:] = docs[1:] == docs[:-1]
+
+        # A known word after a known modifier extends the modifier's assessment
+        prev_modifier = np.zeros(len(ids), dtype=bool)
+        prev_modifier[1:] = known[:-1] & self.modifier[safe[:-1]]
+        continues = word & same_prev & prev_modifier
+        next_continues = np.zeros(len(ids), dtype=bool)
+        next_continues[:-1] = continues[1:]
+
+        # Each chain of modifiers ends in one assessment
+        ends = known & ~next_continues
+        prev_intensity = np.ones(len(ids))
+        prev_intensity[1:] = np.where(continues[1:], self.intensity[safe[:-1]], 1.0)
+        p = np.clip(self.polarity[safe] * prev_intensity, -1.0, 1.0)
+        s = np.clip(self.subjectivity[safe] * prev_intensity, -1.0, 1.0)
+
+        # Negation before the start of the chain flips and halves it, it is
+        # carried over one-letter words and apostrophes ("not a good")
+        is_negation = np.isin(tokens, self.negations)
+        short = ~known & (np.array([len(t.strip("'")) for t in tokens]) <= 1) \
+            if len(tokens) else np.zeros(0, dtype=bool)
+        starts = known & ~continues
+        word_starts = starts & word
+        negated_start = np.zeros(len(ids), dtype=bool)
+        negated_start[1:] = word_starts[1:] & is_negation[:-1] & same_prev[1:]
+        negated_start[2:] |= word_starts[2:] & short[1:-1] & is_negation[:-2] & \
+            same_prev[2:] & same_prev[1:-1]
+        chain = np.cumsum(starts)
+        negated = negated_start[np.flatnonzero(starts)][chain[ends] - 1]
+
+        # Every exclamation mark boosts the latest assessment of its message
+        position = np.arange(len(ids))
+        last_end = np.maximum.accumulate(np.where(ends, position, -1)) \
+            if len(ids) else position
+        bangs = np.flatnonzero(tokens == '!')
+        targets = last_end[bangs]
+        valid = targets >= 0
+        valid[valid] = docs[targets[valid]] == docs[bangs[valid]]
+        excited = np.bincount(targets[valid], minlength=len(ids))
+
+        p_end = np.clip(p[ends] * 1.25 ** excited[ends], -1.0, 1.0)
+        p_end = np.where(negated, p_end * -0.5, p_end)
+
+        # Average the assessments of each message
+        end_docs = docs[ends]
+        count = np.bincount(end_docs, minlength=n_docs)
+        polarity = np.bincount(end_docs, weights=p_end, minlength=n_docs)
+        subjectivity = np.bincount(end_docs, weights=s[ends], minlength=n_docs)
+        count = np.maximum(count, 1)
+        return polarity / count, subjectivity / count
+
+
+def compare_textblob(messages, scorer=None):
+    """ Compares the vectorized scorer against TextBlob on a sample.
+
+    Returns:
+        errors (numpy.ndarray): Absolute polarity error per message.
+    """
+    from textblob import TextBlob
+    scorer = scorer or LexiconScorer()
+    polarity, _ = scorer.score(messages)
+    expected = np.array([TextBlob(m if isinstance(m, str) else '').sentiment.polarity
+                         for m in messages])
+    return np.abs(polarity - expected)
+
+
+###############################################################################
+# Batch Scoring                                                               #
+###############################################################################
+
+# Per-process scorer, built once by `init_worker`.
+worker_scorer = None
+
+
+def init_worker():
+    global worker_scorer
+    worker_scorer = LexiconScorer()
+
+
+def score_chunk(chunk):
+    """ Scores an (ids, tweetIDs, messages) chunk, returns the ids and TSV rows for COPY. """
+    ids, tweet_ids, messages = chunk
+    polarity, subjectivity = worker_scorer.score(messages)
+    buff = StringIO()
+    for row in zip(ids, tweet_ids, polarity, subjectivity):
+        buff.write('{}\t{}\t{:.6f}\t{:.6f}\n'.format(*row))
+    return ids, buff.getvalue()
+
+
+# Newly scored tweets add their polarity to their user's running sums
+user_sentiment_query = """
+UPDATE user_stats u SET
+    n_scored = u.n_scored + s.n_scored,
+    sum_polarity = u.sum_polarity + s.sum_polarity
+FROM (
+    SELECT f."userID", COUNT(*) AS n_scored, SUM(t.polarity) AS sum_polarity
+    FROM tweet_sentiment t JOIN filter_tweets f ON f.id = t.id
+    WHERE t.id = ANY(%s)
+    GROUP BY f."userID"
+) s
+WHERE u."userID" = s."userID";
+"""
+
+
+def read_chunks(conn, low, chunk_rows):
+    """ Yields (ids, tweetIDs, messages) chunks of filter_tweets above id `low`.
+
+    Rows come in id order, so after a crash every id below MAX(id) of
+    tweet_sentiment has been scored and resuming above it skips nothing.
+    """
+    curr = conn.cursor(name='score_tweets')
+    curr.itersize = chunk_rows
+    curr.execute('SELECT id, "tweetID", message FROM filter_tweets WHERE id > %s ORDER BY id;',
+                 (low,))
+    while True:
+        rows = curr.fetchmany(chunk_rows)
+        if not rows:
+            break
+        yield tuple(list(c) for c in zip(*rows))
+    curr.close()
+
+
+@click.command()
+@click.argument('database_url', envvar='DATABASE_URL')
+@click.option('--chunk-rows', default=200000, type=click.IntRange(min=1),
+              help='Messages scored per chunk.')
+@click.option('--workers', default=1, type=click.IntRange(min=1),
+              help='Number of processes scoring chunks.')
+def main(database_url, chunk_rows, workers):
+    """ Scores sentiment of filtered tweets not yet in tweet_sentiment.
+
+    Messages are read in chunks through a server-side cursor, scored with
+    `LexiconScorer` across a process pool and written back with COPY.
+    """
+    logger = logging.getLogger(__name__)
+    log_score = logger.getChild('score')
+    start = time()
+
+    read_conn = checkout(database_url)
+    write_conn = checkout(database_url)
+    write_curr = write_conn.cursor()
+    write_curr.execute('SELECT COALESCE(MAX(id), 0) FROM tweet_sentiment;')
+    low = write_curr.fetchone()[0]
+    log_score.info('scoring filter_tweets above id {}'.format(low))
+
+    pool = Pool(workers, initializer=init_worker)
+    total = 0
+    try:
+        chunks = read_chunks(read_conn, low, chunk_rows)
+        for ids, tsv in pool.imap(score_chunk, chunks):
+            write_curr.copy_expert('COPY tweet_sentiment (id, "tweetID", polarity, subjectivity) '
+                                   'FROM STDIN;', StringIO(tsv))
+            write_curr.execute(user_sentiment_query, (ids,))
+            write_conn.commit()
+            total += len(ids)
+            log_score.info('scored {} tweets ({:.0f}/sec)'.format(
+                total, total / (time() - start)))
+        pool.close()
+    except (Exception, KeyboardInterrupt):
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        release(read_conn, database_url)
+        release(write_conn, database_url)
+
+    logger.info('{} tweets scored in {:.2f} secs'.format(total, time() - start))
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO,
+                    format=log_fmt, datefmt='%H:%M:%S',
+                    filename='reports/pipeline.predict.log', filemode='a')
+
+    load_dotenv(find_dotenv())
+
+    main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import os
+import click
+import pickle
+import logging
+import resource
+from dotenv import find_dotenv, load_dotenv
+from time import time
+
+import numpy as np
+
+from src.features.build_features import HashedShards
+from src.data.database import checkout, release
+
+
+###############################################################################
+# Models                                                                      #
+###############################################################################
+
+checkpoint_dir = os.path.join('models', 'train')
+
+# Tweets whose lexicon polarity is within this band are too neutral to label
+NEUTRAL_BAND = 0.1
+CLASSES = np.array([-1, 1])
+
+
+def make_model(name, n_topics=20, n_features=None):
+    """ Returns a new, untrained model supporting incremental updates. """
+    if name == 'sgd':
+        from sklearn.linear_model import SGDClassifier
+        return SGDClassifier(loss='log', alpha=1e-6)
+    if name == 'nb':
+        from sklearn.naive_bayes import MultinomialNB
+        return MultinomialNB(alpha=0.01)
+    if name == 'lda':
+        from gensim.models import LdaModel
+        from gensim.utils import FakeDict
+        # Hashed columns have no words, FakeDict maps each id to itself
+        return LdaModel(num_topics=n_topics, id2word=FakeDict(n_features),
+                        update_every=1, chunksize=10000, passes=1)
+    raise ValueError('unknown model {}'.format(name))
+
+
+def get_labels(conn, ids):
+    """ Distant sentiment labels (-1/1) from lexicon scores, 0 where neutral/unscored. """
+    curr = conn.cursor()
+    curr.execute('SELECT id, polarity FROM tweet_sentiment WHERE id = ANY(%s);',
+                 (list(map(int, ids)),))
+    scores = dict(curr.fetchall())
+    curr.close()
+    polarity = np.array([scores.get(int(i), 0.0) for i in ids])
+    labels = np.zeros(len(ids), dtype=np.int64)
+    labels[polarity > NEUTRAL_BAND] = 1
+    labels[polarity < -NEUTRAL_BAND] = -1
+    return labels
+
+
+def update(name, model, X, conn, ids):
+    """ Updates the model with one chunk, returning the documents used. """
+    if name == 'lda':
+        from gensim.matutils import Sparse2Corpus
+        model.update(Sparse2Corpus(X, documents_columns=False))
+        return X.shape[0]
+
+    labels = get_labels(conn, ids)
+    labeled = labels != 0
+    if labeled.any():
+        model.partial_fit(X[labeled], labels[labeled], classes=CLASSES)
+    return int(labeled.sum())
+
+
+###############################################################################
+# Checkpoints                                                                 #
+###############################################################################
+
+def checkpoint_path(name):
+    return os.path.join(checkpoint_dir, name + '.pkl')
+
+
+def save_checkpoint(name, model, state):
+    """ Writes model and progress, replacing the previous checkpoint atomically.
+
+    Both go into one file swapped in with a single rename, so a crash never
+    leaves a model paired with another checkpoint's progress.
+    """
+    if not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    path = checkpoint_path(name)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump({'model': model, 'state': state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def load_checkpoint(name):
+    """ Returns (model, state) of the last checkpoint, or (None, None). """
+    path = checkpoint_path(name)
+    if not os.path.isfile(path):
+        return None, None
+    with open(path, 'rb') as f:
+        checkpoint = pickle.load(f)
+    return checkpoint['model'], checkpoint['state']
+
+
+def peak_rss_mb():
+    """ Peak resident memory of this process in MB (ru_maxrss is KB on Linux). """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+###############################################################################
+# Training Loop                                                               #
+###############################################################################
+
+@click.command()
+@click.argument('database_url', envvar='DATABASE_URL')
+@click.option('--model', 'name', default='sgd', type=click.Choice(['sgd', 'nb', 'lda']),
+              help='Classifier to fit with partial_fit, or online LDA.')
+@click.option('--checkpoint-every', default=10, type=click.IntRange(min=1),
+              help='Save a checkpoint after this many chunks.')
+@click.option('--topics', default=20, type=click.IntRange(min=1),
+              help='Number of LDA topics.')
+@click.option('--restart', is_flag=True, help='Ignore existing checkpoints.')
+def main(database_url, name, checkpoint_every, topics, restart):
+    """ Trains a model one hashed feature shard at a time.
+
+    Only one shard is in memory at once. Progress is checkpointed to
+    models/train every few chunks, and a rerun resumes after the last
+    checkpointed shard.
+    """
+    logger = logging.getLogger(__name__)
+    log_train = logger.getChild(name)
+    shards = HashedShards()
+    if len(shards) == 0:
+        raise click.ClickException('no hashed feature shards in {}, run '
+                                   'build_features hashed first'.format(shards.path))
+
+    model, state = (None, None) if restart else load_checkpoint(name)
+    if model is None:
+        model = make_model(name, n_topics=topics, n_features=shards.meta['n_features'])
+        state = {'next_shard': 0, 'docs': 0}
+    else:
+        log_train.info('resuming at shard {}'.format(state['next_shard']))
+
+    conn = checkout(database_url)
+    start = time()
+    prior_docs = state['docs']
+    docs = 0
+    try:
+        for i in range(state['next_shard'], len(shards)):
+            ids, X = shards.shard(i)
+            docs += update(name, model, X, conn, ids)
+            state = {'next_shard': i + 1, 'docs': prior_docs + docs}
+
+            log_train.info('shard {}: {:.0f} docs/sec, peak rss {:.0f} MB'.format(
+                i, docs / (time() - start), peak_rss_mb()))
+            if (i + 1) % checkpoint_every == 0:
+                save_checkpoint(name, model, state)
+                log_train.info('checkpoint at shard {}'.format(i + 1))
+    finally:
+        release(conn, database_url)
+
+    save_checkpoint(name, model, state)
+    logger.info('trained {} on {} docs in {:.2f} secs, peak rss {:.0f} MB'.format(
+        name, docs, time() - start, peak_rss_mb()))
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO,
+                    format=log_fmt, datefmt='%H:%M:%S',
+                    filename='reports/pipeline.train.log', filemode='a')
+
+    load_dotenv(find_dotenv())
+
+    main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import os
+import click
+import logging
+from dotenv import find_dotenv, load_dotenv
+from time import time
+
+from src.features.corpus import TweetCorpus
+
+
+class TaggedCorpus(object):
+    """ Wraps a corpus for doc2vec, tagging each tweet with its position. """
+    def __init__(self, corpus):
+        self.corpus = corpus
+
+    def __iter__(self):
+        from gensim.models.doc2vec import TaggedDocument
+        for i, words in enumerate(self.corpus):
+            yield TaggedDocument(words, [i])
+
+
+@click.command()
+@click.argument('database_url', envvar='DATABASE_URL')
+@click.option('--model', 'name', default='word2vec',
+              type=click.Choice(['word2vec', 'doc2vec']), help='Embedding model.')
+@click.option('--size', default=100, type=click.IntRange(min=1), help='Vector size.')
+@click.option('--epochs', default=5, type=click.IntRange(min=1), help='Training epochs.')
+@click.option('--workers', default=os.cpu_count() or 1, type=click.IntRange(min=1),
+              help='Training threads.')
+@click.option('--itersize', default=10000, type=click.IntRange(min=1),
+              help='Rows fetched per round trip from the server-side cursor.')
+@click.option('--no-cache', is_flag=True, help='Read every epoch from the database.')
+def main(database_url, name, size, epochs, workers, itersize, no_cache):
+    """ Trains word2vec or doc2vec on filtered tweets.
+
+    The first pass streams from Postgres and caches the tokenized corpus in
+    data/interim, later passes read the cache.
+    """
+    from gensim.models import Doc2Vec, Word2Vec
+    logger = logging.getLogger(__name__)
+    start = time()
+
+    cache_path = None if no_cache else os.path.join('data', 'interim', 'corpus')
+    corpus = TweetCorpus(database_url, itersize=itersize, cache_path=cache_path)
+    if name == 'word2vec':
+        model = Word2Vec(corpus, size=size, iter=epochs, workers=workers, min_count=5)
+    else:
+        model = Doc2Vec(TaggedCorpus(corpus), vector_size=size, epochs=epochs,
+                        workers=workers, min_count=5)
+
+    model.save(os.path.join('models', '{}.tweets.{}d'.format(name, size)))
+    logger.info('trained {} in {:.2f} secs with {} workers'.format(
+        name, time() - start, workers))
+
+
+if __name__ == '__main__':
+    # Configure logging
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO,
+                    format=log_fmt, datefmt='%H:%M:%S',
+                    filename='reports/pipeline.word2vec.log', filemode='a')
+
+    load_dotenv(find_dotenv())
+
+    main()
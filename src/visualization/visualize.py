@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+
+from src.data.database import checkout, release
+from src.data.result_cache import cached
+
+
+###############################################################################
+# Rollup Series                                                               #
+###############################################################################
+
+GROUPS = ('language', 'state')
+
+
+@cached('series', upstream=('rollups',))
+def load_series(conn=None, grain='day', by=None, start=None, end=None,
+                languages=None, states=None):
+    """ Loads a sentiment/volume time series from sentiment_rollups.
+
+    Rollups hold sums per (bucket, language, state), so any coarser grouping
+    is an exact SUM over a few thousand rows instead of a scan of the tweets.
+
+    Args:
+        conn (psycopg2.connection): Database connection, DATABASE_URL if None.
+        grain (str): 'hour' or 'day'.
+        by (str): Optional 'language' or 'state' to split the series by.
+        start (str): First bucket to include (YYYY-MM-DD), inclusive.
+        end (str): Last day to include (YYYY-MM-DD), inclusive.
+        languages (list[str]): Only count these languages.
+        states (list[str]): Only count these state codes ('' is unassigned).
+
+    Returns:
+        df (pandas.DataFrame): One row per bucket (and group) with count,
+            n_scored, mean_polarity and std_polarity.
+    """
+    if grain not in ('hour', 'day'):
+        raise ValueError('unknown grain {}'.format(grain))
+    if by is not None and by not in GROUPS:
+        raise ValueError('cannot group rollups by {}'.format(by))
+
+    where, params = ['grain = %(grain)s'], {'grain': grain}
+    if start is not None:
+        where.append('bucket >= %(start)s')
+        params['start'] = start
+    if end is not None:
+        where.append("bucket < %(end)s::date + INTERVAL '1 day'")
+        params['end'] = end
+    if languages is not None:
+        where.append('language = ANY(%(languages)s)')
+        params['languages'] = list(languages)
+    if states is not None:
+        where.append('state = ANY(%(states)s)')
+        params['states'] = list(states)
+
+    keys = ['bucket'] + ([by] if by else [])
+    query = ('SELECT {0}, SUM(count), SUM(n_scored), SUM(sum_polarity), SUM(sum_sq_polarity) '
+             'FROM sentiment_rollups WHERE {1} GROUP BY {0} ORDER BY {0};').format(
+                 ', '.join(keys), ' AND '.join(where))
+
+    own_conn = conn is None
+    conn = checkout() if own_conn else conn
+    try:
+        curr = conn.cursor()
+        curr.execute(query, params)
+        rows = curr.fetchall()
+        curr.close()
+    finally:
+        if own_conn:
+            release(conn)
+
+    df = pd.DataFrame(rows, columns=keys + ['count', 'n_scored', 'sum', 'sum_sq'])
+    df[['count', 'n_scored']] = df[['count', 'n_scored']].astype(np.int64)
+    n = df['n_scored'].where(df['n_scored'] > 0)
+    df['mean_polarity'] = df['sum'].astype(float) / n
+    df['std_polarity'] = np.sqrt(np.maximum(df['sum_sq'].astype(float) / n - df['mean_polarity'] ** 2, 0))
+    return df.drop(['sum', 'sum_sq'], axis=1)
+
+
+###############################################################################
+# Plots                                                                       #
+###############################################################################
+
+def plot_series(df, by=None, ax=None, top=5):
+    """ Plots mean polarity with tweet volume underneath.
+
+    Args:
+        df (pandas.DataFrame): Output of `load_series`.
+        by (str): The grouping `df` was loaded with, if any.
+        ax (tuple): Optional (polarity, volume) matplotlib axes.
+        top (int): With `by`, only the groups with the most tweets are drawn.
+
+    Returns:
+        ax (tuple): The (polarity, volume) axes.
+    """
+    import matplotlib.pyplot as plt
+
+    if ax is None:
+        _, ax = plt.subplots(2, 1, sharex=True, figsize=(12, 6),
+                             gridspec_kw={'height_ratios': [2, 1]})
+    ax_polarity, ax_volume = ax
+
+    if by is None:
+        groups = [(None, df)]
+    else:
+        totals = df.groupby(by)['count'].sum().sort_values(ascending=False)
+        groups = [(g, df[df[by] == g]) for g in totals.index[:top]]
+
+    for name, group in groups:
+        label = name if name else None
+        ax_polarity.plot(group['bucket'], group['mean_polarity'], label=label)
+        ax_volume.plot(group['bucket'], group['count'], label=label)
+
+    ax_polarity.axhline(0, color='grey', linewidth=0.5)
+    ax_polarity.set_ylabel('mean polarity')
+    ax_volume.set_ylabel('tweets')
+    if by is not None:
+        ax_polarity.legend(title=by)
+    return ax